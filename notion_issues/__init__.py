@@ -1,42 +1,250 @@
+import time
+import asyncio
+import contextlib
 from pprint import pformat
-from dateutil import parser
 from datetime import datetime, timedelta, timezone
 
 from notion_issues.logger import Logger
+from notion_issues.helpers.executor import (
+        KeyLocks, WriteExecutor, WriteOperation)
+from notion_issues.sources import as_async_source, Issue, iso_to_epoch
 
 log = Logger('notion_issues.issue_sync')
 unassigned_user = "unassigned"
 
+class IssueJoin:
+    """Match a source's issues with Notion's as the two scans stream in.
+
+    An issue is held until the issue with the same key arrives from the
+    other side, then the writes for the pair are planned and start
+    immediately.  Issues still unmatched when both scans have finished are
+    resolved by looking them up on the other side.
+
+    :param syncer: the sync settings and planner.
+    :type syncer: IssueSync
+    :param since: ignore Notion issues updated at or before this epoch time.
+    :type since: int
+    """
+
+    def __init__(self, syncer, notion_source, other_source, since,
+                 threshold):
+        self.syncer = syncer
+        self.notion_source = notion_source
+        self.other_source = other_source
+        self.since = since
+        self.threshold = threshold
+        self.executor = WriteExecutor(syncer.write_concurrency,
+                                      syncer.key_locks)
+        self.unmatched_notion = {}
+        self.unmatched_other = {}
+
+    def _plan(self, key, issue_dict, notion_issue):
+        self.syncer._plan_issue(self.executor, self.notion_source,
+                                self.other_source, key, issue_dict,
+                                notion_issue, self.threshold)
+
+    def add_notion(self, key, notion_issue):
+        if self.since and (notion_issue.updated or 0) <= self.since:
+            return
+        issue_dict = self.unmatched_other.pop(key, None)
+        if issue_dict is None:
+            self.unmatched_notion[key] = notion_issue
+        else:
+            self._plan(key, issue_dict, notion_issue)
+
+    def add_other(self, key, issue_dict):
+        notion_issue = self.unmatched_notion.pop(key, None)
+        if notion_issue is None:
+            self.unmatched_other[key] = issue_dict
+        else:
+            self._plan(key, issue_dict, notion_issue)
+
+    async def resolve(self):
+        """Look up the unmatched issues on the other side and plan them."""
+        log.debug(f"notion_source missing keys: {set(self.unmatched_other)}")
+        log.debug(f"other_source missing keys: {set(self.unmatched_notion)}")
+        found_notion, found_other = await asyncio.gather(
+                self.syncer._timed(
+                    f"{self.notion_source} lookups",
+                    self.notion_source.get_issues_for_keys(
+                        self.unmatched_other)),
+                self.syncer._timed(
+                    f"{self.other_source} lookups",
+                    self.syncer._lookup_issues(
+                        self.other_source, self.unmatched_notion)))
+
+        for key, issue_dict in self.unmatched_other.items():
+            self._plan(key, issue_dict, found_notion.get(key))
+        for key, issue_dict in found_other.items():
+            self._plan(key, issue_dict, self.unmatched_notion[key])
+        self.unmatched_notion = {}
+        self.unmatched_other = {}
+
 class IssueSync:
 
-    ignore_fields = ['updated_on', 'opened_on', 'reporter', 'link']
+    ignore_fields = Issue.ignore_fields
 
     def __init__(self, create_closed=False, create_assignee='',
-            since="", archive_aged=7):
+            since="", archive_aged=7, write_concurrency=10, pipelined=False):
         self.create_closed = create_closed
         self.create_assignee = create_assignee
         self.archive_aged = archive_aged
         self.since = since
+        self.write_concurrency = write_concurrency
+        self.pipelined = pipelined
+        self.failures = 0
+        self.timings = {}
+        # monotonic time the first write started, across all syncs.
+        self.first_write = None
+        # serializes writes to a key across concurrent syncs.
+        self.key_locks = KeyLocks()
 
     def issues_equal(self, notion_issue, other_issue):
+        if isinstance(notion_issue, Issue) and isinstance(other_issue, Issue) \
+                and self.ignore_fields == Issue.ignore_fields:
+            return notion_issue.fingerprint == other_issue.fingerprint
         notion_filtered = {k: v for k, v in notion_issue.items()
                                 if k not in self.ignore_fields}
         other_filtered = {k: v for k, v in other_issue.items()
                                if k not in self.ignore_fields}
         return sorted(notion_filtered.items()) == sorted(other_filtered.items())
 
-    def _source_kwargs(self):
+    def changed_fields(self, notion_issue, other_issue):
+        """The fields to write when syncing two issues that differ."""
+        if self.ignore_fields == Issue.ignore_fields:
+            return notion_issue.diff(other_issue)
+        return [field for field in Issue.fields
+                if field not in self.ignore_fields
+                and notion_issue[field] != other_issue[field]]
+
+    def _since_epoch(self, notion_source, since):
+        return iso_to_epoch(notion_source.normalize_date(since))
+
+    def _source_kwargs(self, since=None):
         kwargs = {}
+        since = since or self.since
         if self.create_assignee:
             kwargs['assignee'] = self.create_assignee
-        if self.since:
-            kwargs['since'] = self.since
+        if since:
+            kwargs['since'] = since
         return kwargs
 
-    async def sync_sources(self, notion_source, other_source, issue_key_filter=""):
-        source_kwargs = self._source_kwargs()
-        source_issues = other_source.get_issues(**source_kwargs)
-        notion_issues = await notion_source.get_issues(issue_key_filter, since=self.since)
+    async def _timed(self, name, coro):
+        start = time.monotonic()
+        try:
+            return await coro
+        finally:
+            elapsed = time.monotonic() - start
+            self.timings[name] = elapsed
+            log.info(f"{name}: took {elapsed:.2f}s")
+
+    async def _lookup_issue(self, source, key):
+        _id = await source.key_to_id(key)
+        if _id:
+            return await source.get_issue(_id)
+        return None
+
+    async def _lookup_issues(self, source, keys):
+        """Get the issues for keys that weren't in the source scan."""
+        keys = list(keys)
+        issues = await asyncio.gather(
+                *[self._lookup_issue(source, key) for key in keys])
+        return {key: issue for key, issue in zip(keys, issues) if issue}
+
+    def _partition_issues(self, issues, issue_key_filters):
+        """Split issues by the longest issue key filter they start with."""
+        partitions = {_filter: {} for _filter in issue_key_filters}
+        longest_first = sorted(issue_key_filters, key=len, reverse=True)
+        for key, issue in issues.items():
+            for _filter in longest_first:
+                if key.startswith(_filter):
+                    partitions[_filter][key] = issue
+                    break
+        return partitions
+
+    async def sync_many(self, notion_source, sources):
+        """Sync many sources against a single scan of the Notion database.
+
+        The Notion issues are split between the sources by issue key filter
+        and the sources are synced concurrently.
+
+        :param notion_source: the notion source to sync with.
+        :type notion_source: notion_issues.sources.notion.NotionSource
+        :param sources: (source, issue_key_filter, since) for each source.
+                        since may be None to use the syncer default.
+        :type sources: list
+        :returns: operations, or the exception raised, for each source.
+        :rtype: list
+        """
+        if self.pipelined:
+            return await self._sync_many_pipelined(notion_source, sources)
+
+        filters = [_filter for _, _filter, _ in sources]
+        sinces = [since or self.since for _, _, since in sources]
+        notion_since = min(sinces) if all(sinces) else None
+        notion_issues = await self._timed(
+                f"{notion_source} scan",
+                notion_source.get_issues(filters, since=notion_since))
+        partitions = self._partition_issues(notion_issues, filters)
+
+        syncs = []
+        for source, _filter, since in sources:
+            partition = partitions[_filter]
+            since = since or self.since
+            if since and since != notion_since:
+                since_epoch = self._since_epoch(notion_source, since)
+                partition = {k: v for k, v in partition.items()
+                             if (v.updated or 0) > since_epoch}
+            syncs.append(self.sync_sources(
+                    notion_source, source, _filter,
+                    notion_issues=partition, since=since))
+
+        results = await asyncio.gather(*syncs, return_exceptions=True)
+        for (source, _, _), result in zip(sources, results):
+            if isinstance(result, Exception):
+                log.error(f"sync {source} failed: {result}", exc_info=result)
+                self.failures += 1
+        return results
+
+    async def sync_sources(self, notion_source, other_source, issue_key_filter="",
+                           notion_issues=None, since=None):
+        """Sync the issues in a source with the issues in Notion.
+
+        :param notion_issues: issues already fetched from notion, if None,
+                              the notion database is scanned.
+        :type notion_issues: dict
+        :param since: sync issues changed since, default self.since.
+        :type since: datetime.datetime
+        :returns: the write operations executed.
+        :rtype: list
+        """
+        if self.pipelined and notion_issues is None:
+            results = await self._sync_many_pipelined(
+                    notion_source, [(other_source, issue_key_filter, since)],
+                    raise_errors=True)
+            return results[0]
+
+        async with self._async_source(other_source) as other_source:
+            return await self._sync_sources(
+                    notion_source, other_source, issue_key_filter,
+                    notion_issues, since)
+
+    async def _sync_sources(self, notion_source, other_source,
+                            issue_key_filter, notion_issues, since):
+        since = since or self.since
+        source_kwargs = self._source_kwargs(since)
+        scans = [self._timed(f"{other_source} scan",
+                             other_source.get_issues(**source_kwargs))]
+        if notion_issues is None:
+            scans.append(self._timed(
+                    f"{notion_source} scan",
+                    notion_source.get_issues(issue_key_filter, since=since)))
+        results = await asyncio.gather(*scans)
+        source_issues = results[0]
+        if notion_issues is None:
+            notion_issues = results[1]
+        else:
+            notion_issues = dict(notion_issues)
 
         threshold = datetime.now(timezone.utc) - timedelta(seconds=60*60*24*self.archive_aged)
 
@@ -46,66 +254,235 @@ class IssueSync:
         log.debug(f"notion_source missing keys: {missing_notion}")
         log.debug(f"other_source missing keys: {missing_other}")
 
-        for key in missing_notion:
-            _id = await notion_source.key_to_id(key)
-            if _id:
-                issue = await notion_source.get_issue(_id)
-                if issue:
-                    notion_issues[key] = issue
-
-        for key in missing_other:
-            _id = other_source.key_to_id(key)
-            if _id:
-                issue = other_source.get_issue(_id)
-                if issue:
-                    source_issues[key] = issue
+        found_notion, found_other = await asyncio.gather(
+                self._timed(f"{notion_source} lookups",
+                            notion_source.get_issues_for_keys(missing_notion)),
+                self._timed(f"{other_source} lookups",
+                            self._lookup_issues(other_source, missing_other)))
+        notion_issues.update(found_notion)
+        source_issues.update(found_other)
 
         log.info(f"sync {notion_source}({issue_key_filter}) and {other_source}")
         log.debug(f"notion({len(notion_issues)}), other({len(source_issues)})")
         log.debug(f"Notion: {pformat(notion_issues)}")
         log.debug(f"Other: {pformat(source_issues)}")
 
+        executor = WriteExecutor(self.write_concurrency, self.key_locks)
         for key, issue_dict in source_issues.items():
-            log.debug(f"{key}: assessing.")
-            if key in notion_issues:
-                log.debug(f"{key}: exists in notion")
-                notion_issue = notion_issues[key]
-                if not self.issues_equal(notion_issue, issue_dict):
-                    if issue_dict['updated_on'] > notion_issue['updated_on']:
-                        log.debug(f"{key}: other source is newer")
-                        log.debug(f"{key}: updating with {pformat(issue_dict)}")
-                        await notion_source.update_issue(key, issue_dict)
-                        log.info(f"{key}: notion updated successfully.")
-                    else:
-                        log.debug(f"{key}: notion source is newer")
-                        log.debug(f"{key}: updating with {pformat(notion_issue)}")
-                        other_source.update_issue(key, notion_issue)
-                        log.info(f"{key}: other source updated successfully.")
+            self._plan_issue(executor, notion_source, other_source, key,
+                             issue_dict, notion_issues.get(key), threshold)
+
+        return await self._execute(executor, notion_source, other_source)
+
+    @contextlib.asynccontextmanager
+    async def _async_source(self, source):
+        """Use a source as an AsyncIssueSource for the block.
+
+        A blocking source is wrapped in a ThreadedIssueSource whose thread
+        pool is shut down when the block exits.
+        """
+        async_source = as_async_source(source)
+        try:
+            yield async_source
+        finally:
+            if async_source is not source:
+                await async_source.close()
+
+    async def _sync_many_pipelined(self, notion_source, sources,
+                                   raise_errors=False):
+        """Wrap blocking sources for _sync_many_streaming."""
+        async with contextlib.AsyncExitStack() as stack:
+            sources = [(await stack.enter_async_context(
+                            self._async_source(source)), _filter, since)
+                       for source, _filter, since in sources]
+            return await self._sync_many_streaming(
+                    notion_source, sources, raise_errors)
+
+    async def _sync_many_streaming(self, notion_source, sources,
+                                   raise_errors=False):
+        """Sync sources while the Notion and source scans are streaming.
+
+        Issues from each side are matched by key as they arrive, and writes
+        for matched pairs start right away.  Only unmatched issues are held,
+        and they are resolved with lookups once the scans finish.
+
+        :param raise_errors: raise the first job error instead of returning
+                             it, for a single source.
+        :type raise_errors: bool
+        :returns: operations, or the exception raised, for each source.
+        :rtype: list
+        """
+        threshold = datetime.now(timezone.utc) - timedelta(seconds=60*60*24*self.archive_aged)
+        filters = [_filter for _, _filter, _ in sources]
+        sinces = [since or self.since for _, _, since in sources]
+        notion_since = min(sinces) if all(sinces) else None
+        joins = []
+        for (source, _filter, _), since in zip(sources, sinces):
+            since_epoch = None
+            if since and since != notion_since:
+                since_epoch = self._since_epoch(notion_source, since)
+            joins.append(IssueJoin(self, notion_source, source, since_epoch,
+                                   threshold))
+        joins_by_filter = dict(zip(filters, joins))
+        longest_first = sorted(filters, key=len, reverse=True)
+
+        for join in joins:
+            join.executor.start()
+
+        async def scan_notion():
+            async for key, issue in notion_source.stream_issues(
+                    filters, since=notion_since):
+                for _filter in longest_first:
+                    if key.startswith(_filter):
+                        joins_by_filter[_filter].add_notion(key, issue)
+                        break
+
+        async def scan_other(join, since):
+            async for key, issue_dict in join.other_source.stream_issues(
+                    **self._source_kwargs(since)):
+                join.add_other(key, issue_dict)
+
+        async def sync(join, since, notion_scan):
+            try:
+                await self._timed(f"{join.other_source} scan",
+                                  scan_other(join, since))
+                await asyncio.shield(notion_scan)
+                await join.resolve()
+            finally:
+                operations = await self._timed(
+                        f"{notion_source} and {join.other_source} writes",
+                        join.executor.join())
+                self._note_first_write(join.executor)
+            for operation in operations:
+                self._report(operation, notion_source)
+            return operations
+
+        notion_scan = asyncio.ensure_future(self._timed(
+                f"{notion_source} scan", scan_notion()))
+        results = await asyncio.gather(
+                *[sync(join, since, notion_scan)
+                  for join, since in zip(joins, sinces)],
+                return_exceptions=True)
+        if not notion_scan.done():
+            notion_scan.cancel()
+        await asyncio.gather(notion_scan, return_exceptions=True)
+
+        for (source, _, _), result in zip(sources, results):
+            if isinstance(result, Exception):
+                if raise_errors:
+                    raise result
+                log.error(f"sync {source} failed: {result}", exc_info=result)
+                self.failures += 1
+        return results
+
+    async def sync_issue(self, notion_source, other_source, key):
+        """Sync a single issue by key, i.e. when notified of a change.
+
+        :param key: the issue key.
+        :type key: str
+        :returns: the write operations executed.
+        :rtype: list
+        """
+        async with self._async_source(other_source) as other_source:
+            return await self._sync_issue(notion_source, other_source, key)
+
+    async def _sync_issue(self, notion_source, other_source, key):
+        threshold = datetime.now(timezone.utc) - timedelta(seconds=60*60*24*self.archive_aged)
+        found_other, found_notion = await asyncio.gather(
+                self._lookup_issues(other_source, [key]),
+                notion_source.get_issues_for_keys([key]))
+
+        executor = WriteExecutor(self.write_concurrency, self.key_locks)
+        if key in found_other:
+            self._plan_issue(executor, notion_source, other_source, key,
+                             found_other[key], found_notion.get(key),
+                             threshold)
+        else:
+            log.warning(f"{key}: not found in {other_source}.")
+
+        return await self._execute(executor, notion_source, other_source)
+
+    def _plan_issue(self, executor, notion_source, other_source, key,
+                    issue_dict, notion_issue, threshold):
+        """Add the writes needed to sync an issue to the executor."""
+        log.debug(f"{key}: assessing.")
+        issue_dict = Issue.coerce(issue_dict)
+        notion_issue = Issue.coerce(notion_issue)
+        if notion_issue:
+            log.debug(f"{key}: exists in notion")
+            if not self.issues_equal(notion_issue, issue_dict):
+                changed = self.changed_fields(notion_issue, issue_dict)
+                if (issue_dict.updated or 0) > (notion_issue.updated or 0):
+                    log.debug(f"{key}: other source is newer")
+                    log.debug(f"{key}: updating {changed} with "
+                              f"{pformat(issue_dict)}")
+                    executor.add(WriteOperation(
+                            key, notion_source, 'update_issue', issue_dict,
+                            changed))
                 else:
-                    log.info(f"{key} in sync.")
+                    log.debug(f"{key}: notion source is newer")
+                    log.debug(f"{key}: updating {changed} with "
+                              f"{pformat(notion_issue)}")
+                    executor.add(WriteOperation(
+                            key, other_source, 'update_issue', notion_issue,
+                            changed))
+            else:
+                log.info(f"{key} in sync.")
 
-                if self.archive_aged:
-                    if issue_dict['status'] in other_source.closed_statuses:
-                        last_edit = parser.isoparse(notion_issue['updated_on'])
-                        if last_edit < threshold:
-                            log.info(f"{key}: archiving aged issue.")
-                            await notion_source.archive_issue(key)
+            if self.archive_aged:
+                if issue_dict.status in other_source.closed_statuses:
+                    if (notion_issue.updated or 0) < threshold.timestamp():
+                        log.debug(f"{key}: archiving aged issue.")
+                        executor.add(WriteOperation(
+                                key, notion_source, 'archive_issue'))
 
+        else:
+            log.debug(f"{key}: does not exist in notion")
+            if not self.create_closed:
+                if issue_dict.status in other_source.closed_statuses:
+                    log.debug(f'{key}: not creating closed issue.')
+                    return
+
+            if self.create_assignee:
+                if issue_dict.assignee != self.create_assignee:
+                    log.debug(f'{key}: not for {self.create_assignee}')
+                    return
+
+            executor.add(WriteOperation(
+                    key, notion_source, 'create_issue', issue_dict))
+
+    async def _execute(self, executor, notion_source, other_source):
+        operations = await self._timed(
+                f"{notion_source} and {other_source} writes", executor.execute())
+        self._note_first_write(executor)
+        for operation in operations:
+            self._report(operation, notion_source)
+        return operations
+
+    def _note_first_write(self, executor):
+        if executor.first_write is not None:
+            self.first_write = min(self.first_write or executor.first_write,
+                                   executor.first_write)
+
+    def _report(self, operation, notion_source):
+        key = operation.key
+        if operation.error:
+            if operation.action == 'create_issue':
+                log.error(f"{key}: failed to create in notion: "
+                          f"{operation.error}")
             else:
-                log.debug(f"{key}: does not exist in notion")
-                if not self.create_closed:
-                    if issue_dict['status'] in other_source.closed_statuses:
-                        log.debug(f'{key}: not creating closed issue.')
-                        continue
-
-                if self.create_assignee:
-                    if issue_dict['assignee'] != self.create_assignee:
-                        log.debug(f'{key}: not for {self.create_assignee}')
-                        continue
-
-                resp = await notion_source.create_issue(key, issue_dict)
-                log.debug(f"{key}: {pformat(resp)}")
-                if 'status' in resp:
-                    log.error(f'failed to create in notion: {pformat(resp)}')
-                else:
-                    log.info(f"{key}: created in notion.")
+                log.error(f"{key}: {operation.action} failed on "
+                          f"{operation.target}: {operation.error}")
+            self.failures += 1
+        elif not operation.done:
+            log.warning(f"{key}: {operation.action} skipped after failure.")
+            self.failures += 1
+        elif operation.action == 'create_issue':
+            log.debug(f"{key}: {pformat(operation.result)}")
+            log.info(f"{key}: created in notion.")
+        elif operation.action == 'archive_issue':
+            log.info(f"{key}: archived aged issue.")
+        elif operation.target is notion_source:
+            log.info(f"{key}: notion updated successfully.")
+        else:
+            log.info(f"{key}: other source updated successfully.")
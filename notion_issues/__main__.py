@@ -8,34 +8,60 @@ from dateutil import parser as date_parser
 from datetime import datetime, timedelta, timezone
 
 from notion_issues import IssueSync
+from notion_issues.sources import ThreadedIssueSource
 from notion_issues.sources._github import GithubSource
 from notion_issues.sources._jira import JiraSource
 from notion_issues.sources.bitbucket import BitbucketSource
 from notion_issues.sources.notion import NotionSource
+from notion_issues.helpers import metrics
+from notion_issues.helpers.state import SyncWatermarks, DatabaseMetadataCache
+from notion_issues.helpers.httpcache import HTTPCache
+from notion_issues.helpers.watch import AdaptiveInterval, Watcher
+from notion_issues.helpers.webhook import WebhookReceiver
 from notion_issues.logger import Logger
 
 log = Logger('notion_issues')
 THIRTY_DAYS = timedelta(seconds=60*60*24*30)
 
+def env_list(name):
+    return [v.strip() for v in os.environ.get(name, "").split(",") if v.strip()]
+
 defaults = {
         'since': datetime.now(timezone.utc) - THIRTY_DAYS,
         'jira_token': os.environ.get("JIRA_TOKEN"),
         'jira_server': os.environ.get("JIRA_SERVER"),
-        'jira_project': os.environ.get("JIRA_PROJECT"),
+        'jira_project': env_list("JIRA_PROJECT"),
         'github_token': os.environ.get("GITHUB_TOKEN"),
-        'github_repo': os.environ.get("GITBUH_REPO"),
+        'github_repo': env_list("GITBUH_REPO"),
         'notion_token': os.environ.get("NOTION_TOKEN"),
         'notion_database': os.environ.get("NOTION_DATABASE"),
+        'notion_mirror': os.environ.get("NOTION_MIRROR"),
+        'notion_rate_limit': 3,
+        'notion_max_rate_limit': 6,
+        'notion_metadata_cache': os.environ.get("NOTION_ISSUES_METADATA_CACHE"),
+        'notion_metadata_ttl': 3600,
+        'watermark_file': os.environ.get("NOTION_ISSUES_WATERMARK_FILE"),
+        'watermark_overlap': 300,
+        'write_concurrency': 10,
+        'watch_min_interval': 60,
+        'watch_max_interval': 900,
+        'webhook_host': '127.0.0.1',
+        'webhook_port': None,
+        'webhook_secret': os.environ.get("NOTION_ISSUES_WEBHOOK_SECRET"),
+        'webhook_queue_size': 100,
+        'metrics_json': os.environ.get("NOTION_ISSUES_METRICS_JSON"),
+        'metrics_prometheus': os.environ.get("NOTION_ISSUES_METRICS_PROM"),
+        'http_cache': os.environ.get("NOTION_ISSUES_HTTP_CACHE"),
         'bitbucket_app_password': os.environ.get("BITBUCKET_APP_PASSWORD"),
         'bitbucket_user': os.environ.get("BITBUCKET_USER"),
-        'bitbucket_repo': os.environ.get("BITBUCKET_REPO"),
+        'bitbucket_repo': env_list("BITBUCKET_REPO"),
         'bitbucket_server': os.environ.get("BITBUCKET_SERVER",
                                            "https://api.bitbucket.org")
         }
 
 def load_since(path):
     with Path(path).open('r') as f:
-        return parser.parse(f.read())
+        return date_parser.parse(f.read())
 
 def parse_args():
     parser = argparse.ArgumentParser('notion_issues')
@@ -45,12 +71,91 @@ def parse_args():
     parser.add_argument('-nd', '--notion-database', type=str,
             default=defaults['notion_database'],
             help=f"Notion database ID. Default: {defaults['notion_database']}")
+    parser.add_argument('-nm', '--notion-mirror', metavar='PATH', type=str,
+            default=defaults['notion_mirror'],
+            help=(f"Mirror the Notion database in a local SQLite file and "
+                  f"refresh it incrementally. "
+                  f"Default: {defaults['notion_mirror']}"))
+    parser.add_argument('--notion-rate-limit', metavar='REQ/S', type=float,
+            default=defaults['notion_rate_limit'],
+            help=(f"Starting Notion request rate, it slows down when Notion "
+                  f"throttles and speeds up when it doesn't. "
+                  f"Default: {defaults['notion_rate_limit']}"))
+    parser.add_argument('--notion-max-rate-limit', metavar='REQ/S',
+            type=float, default=defaults['notion_max_rate_limit'],
+            help=(f"Highest Notion request rate to try. "
+                  f"Default: {defaults['notion_max_rate_limit']}"))
+    parser.add_argument('--notion-metadata-cache', metavar='PATH', type=str,
+            default=defaults['notion_metadata_cache'],
+            help=(f"Cache the Notion database id and schema in a json file "
+                  f"so runs start without searching for the database. "
+                  f"Default: {defaults['notion_metadata_cache']}"))
+    parser.add_argument('--notion-metadata-ttl', metavar='SECONDS', type=int,
+            default=defaults['notion_metadata_ttl'],
+            help=(f"Check the cached schema against Notion after this many "
+                  f"seconds. Default: {defaults['notion_metadata_ttl']}"))
     since = parser.add_mutually_exclusive_group(required=False)
     since.add_argument('-s', '--since', metavar='YYYYmmddTHHMMSS',
-            default=defaults['since'], type=date_parser.parse,
+            type=date_parser.parse,
             help=f"Sync issues since date time. Default: {defaults['since']}")
     since.add_argument('-sf', '--since-file', metavar='PATH',
             type=load_since, help=f"Sync issues since date time in file.")
+    since.add_argument('-wf', '--watermark-file', metavar='PATH',
+            default=defaults['watermark_file'],
+            help=(f"Sync issues since the last successful run of the job "
+                  f"recorded in file. "
+                  f"Default: {defaults['watermark_file']}"))
+    parser.add_argument('--watermark-overlap', metavar='SECONDS', type=int,
+            default=defaults['watermark_overlap'],
+            help=(f"Sync from this many seconds before the watermark. "
+                  f"Default: {defaults['watermark_overlap']}"))
+    parser.add_argument('--write-concurrency', metavar='N', type=int,
+            default=defaults['write_concurrency'],
+            help=(f"Maximum concurrent writes during a sync. "
+                  f"Default: {defaults['write_concurrency']}"))
+    parser.add_argument('--pipelined', action='store_true',
+            help=(f"Match and write issues while the Notion and source "
+                  f"scans are still running."))
+    parser.add_argument('-w', '--watch', action='store_true',
+            help=(f"Keep running and sync repeatedly, polling more often "
+                  f"when changes are found. Stop with SIGTERM."))
+    parser.add_argument('--watch-min-interval', metavar='SECONDS', type=int,
+            default=defaults['watch_min_interval'],
+            help=(f"Shortest time between watch cycles. "
+                  f"Default: {defaults['watch_min_interval']}"))
+    parser.add_argument('--watch-max-interval', metavar='SECONDS', type=int,
+            default=defaults['watch_max_interval'],
+            help=(f"Longest time between watch cycles. "
+                  f"Default: {defaults['watch_max_interval']}"))
+    parser.add_argument('--webhook-port', metavar='PORT', type=int,
+            default=defaults['webhook_port'],
+            help=(f"Listen for issue webhooks on PORT and sync the changed "
+                  f"issues. Default: {defaults['webhook_port']}"))
+    parser.add_argument('--webhook-host', metavar='HOST', type=str,
+            default=defaults['webhook_host'],
+            help=f"Address to listen on. Default: {defaults['webhook_host']}")
+    parser.add_argument('--webhook-secret', metavar='SECRET', type=str,
+            default=defaults['webhook_secret'],
+            help=(f"Secret used to sign webhook payloads. "
+                  f"Default: $NOTION_ISSUES_WEBHOOK_SECRET"))
+    parser.add_argument('--webhook-queue-size', metavar='N', type=int,
+            default=defaults['webhook_queue_size'],
+            help=(f"Maximum issues waiting to sync before webhooks are "
+                  f"rejected. Default: {defaults['webhook_queue_size']}"))
+    parser.add_argument('--metrics-json', metavar='PATH', type=str,
+            default=defaults['metrics_json'],
+            help=(f"Record per endpoint request metrics and write a json "
+                  f"summary to PATH. Default: {defaults['metrics_json']}"))
+    parser.add_argument('--metrics-prometheus', metavar='PATH', type=str,
+            default=defaults['metrics_prometheus'],
+            help=(f"Record per endpoint request metrics and write them to "
+                  f"PATH in the Prometheus text format. "
+                  f"Default: {defaults['metrics_prometheus']}"))
+    parser.add_argument('--http-cache', metavar='PATH', type=str,
+            default=defaults['http_cache'],
+            help=(f"Cache issue source responses in a SQLite file and "
+                  f"revalidate them with conditional requests. "
+                  f"Default: {defaults['http_cache']}"))
     parser.add_argument('-v', '--verbose', action='store_true',
             help=f"Turn on verbose logging")
     parser.add_argument('--create-closed', action='store_true',
@@ -70,11 +175,18 @@ def parse_args():
     github_parser.add_argument('-gt', '--github-token',
             type=str, default=defaults['github_token'],
             help=f"Github Token. Default: {defaults['github_token']}")
-    github_parser.add_argument('-gr', '--github-repo',
+    github_parser.add_argument('-gr', '--github-repo', nargs='+',
             type=str, default=defaults['github_repo'],
-            help=f"Github Repo Name. Default: {defaults['github_repo']}")
+            help=f"Github Repo Names. Default: {defaults['github_repo']}")
     github_parser.add_argument('-gp', '--github-use-path', action='store_true',
             help=f"Use full repository path for issue key instead of name.")
+    github_parser.add_argument('--github-graphql', action='store_true',
+            help=(f"Fetch issues with the GraphQL API, 100 per request "
+                  f"and only the fields synced."))
+    github_parser.add_argument('--github-threads', metavar='N', type=int,
+            default=GithubSource.thread_pool_size,
+            help=(f"Threads for Github requests. "
+                  f"Default: {GithubSource.thread_pool_size}"))
     github_parser.set_defaults(func=github_sync)
 
     jira_parser = subparsers.add_parser('jira', help='Sync Jira Issues')
@@ -84,9 +196,16 @@ def parse_args():
     jira_parser.add_argument('-js', '--jira-server', type=str,
             default=defaults['jira_server'],
             help=f"Jira server address. Default: {defaults['jira_server']}")
-    jira_parser.add_argument('-jp', '--jira-project', type=str,
+    jira_parser.add_argument('-jp', '--jira-project', type=str, nargs='+',
             default=defaults['jira_project'],
-            help=f"Jira Project Key. Default: {defaults['jira_project']}")
+            help=f"Jira Project Keys. Default: {defaults['jira_project']}")
+    jira_parser.add_argument('--jira-no-notify', action='store_true',
+            help=(f"Don't notify watchers of field edits made by the sync. "
+                  f"Needs project admin permission."))
+    jira_parser.add_argument('--jira-threads', metavar='N', type=int,
+            default=JiraSource.thread_pool_size,
+            help=(f"Threads for Jira requests. "
+                  f"Default: {JiraSource.thread_pool_size}"))
     jira_parser.set_defaults(func=jira_sync)
 
     bitbucket_parser = subparsers.add_parser(
@@ -101,11 +220,15 @@ def parse_args():
             default=defaults['bitbucket_server'],
             help=f"Bitbucket Server. Default: {defaults['bitbucket_server']}")
     bitbucket_parser.add_argument('-br', '--bitbucket-repo', type=str,
-            default=defaults['bitbucket_repo'],
-            help=f"Bitbucket Repo Path. Default: {defaults['bitbucket_repo']}")
+            nargs='+', default=defaults['bitbucket_repo'],
+            help=f"Bitbucket Repo Paths. Default: {defaults['bitbucket_repo']}")
     bitbucket_parser.add_argument('-bp', '--bitbucket-use-path',
             action='store_true',
             help=f"Use full repository path for issue key instead of name.")
+    bitbucket_parser.add_argument('--bitbucket-threads', metavar='N',
+            type=int, default=BitbucketSource.thread_pool_size,
+            help=(f"Threads for Bitbucket requests. "
+                  f"Default: {BitbucketSource.thread_pool_size}"))
     bitbucket_parser.set_defaults(func=bitbucket_sync)
 
     notion_parser = subparsers.add_parser(
@@ -118,10 +241,32 @@ def parse_args():
             help=f"Archive issues with keys that begin with PATTERN.")
     notion_parser.set_defaults(func=notion_maintain)
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.watermark_file and (args.since or args.since_file):
+        # the watermark file came from the environment, an explicit
+        # since on the command line wins.
+        log.warning(f"--since given, ignoring watermark file "
+                    f"{args.watermark_file}.")
+        args.watermark_file = None
+    return args
+
+def build_notion_source(args):
+    metadata_cache = DatabaseMetadataCache(args.notion_metadata_cache,
+                                           args.notion_metadata_ttl)
+    return NotionSource(args.notion_token, args.notion_database,
+                        args.notion_mirror,
+                        rate_limit=args.notion_rate_limit,
+                        max_rate_limit=args.notion_max_rate_limit,
+                        metadata_cache=metadata_cache)
 
 async def notion_maintain(args, syncer):
-    notion_source = NotionSource(args.notion_token, args.notion_database)
+    notion_source = build_notion_source(args)
+    try:
+        await archive_issues(args, notion_source)
+    finally:
+        await notion_source.close()
+
+async def archive_issues(args, notion_source):
     if args.archive_key:
         log.info(f"{args.archive_key}: archive issue requested.")
         issues = await notion_source.get_issues()
@@ -140,29 +285,159 @@ async def notion_maintain(args, syncer):
                 log.info(f"{key}: archive issue.")
                 await notion_source.archive_issue(key)
 
+class JobRunner:
+    """Sync jobs against a single scan of the Notion database.
+
+    The Notion source, source clients, and their caches are kept for the
+    life of the runner so watch cycles start warm.
+
+    :param jobs: (job key, source, issue key filter) for each job.
+    :type jobs: list
+    """
+
+    def __init__(self, args, syncer, jobs):
+        self.args = args
+        self.syncer = syncer
+        self.jobs = jobs
+        self.notion_source = build_notion_source(args)
+        self.watermarks = None
+        if args.watermark_file:
+            self.watermarks = SyncWatermarks(
+                    args.watermark_file, args.watermark_overlap)
+        self.overlap = timedelta(seconds=args.watermark_overlap)
+        self.last_started = {}
+
+    def since(self, job):
+        if self.watermarks:
+            return self.watermarks.since(job, default=defaults['since'])
+        if job in self.last_started:
+            return self.last_started[job] - self.overlap
+        return None
+
+    async def run(self):
+        """Run one sync of all jobs.
+
+        :returns: number of successful changes.
+        :rtype: int
+        """
+        started = datetime.now(timezone.utc)
+        sources = [(source, _filter, self.since(job))
+                   for job, source, _filter in self.jobs]
+        results = await self.syncer.sync_many(self.notion_source, sources)
+
+        changes = 0
+        for (job, _, _), result in zip(self.jobs, results):
+            if isinstance(result, Exception):
+                log.warning(f"{job}: sync failed, watermark not updated.")
+                continue
+            failures = [op for op in result if op.failed]
+            changes += len(result) - len(failures)
+            if failures:
+                log.warning(f"{job}: {len(failures)} failures, "
+                            f"watermark not updated.")
+                continue
+            self.last_started[job] = started
+            if self.watermarks:
+                self.watermarks.record(job, started)
+        write_metrics(self.args)
+        return changes
+
+    async def close(self):
+        await self.notion_source.close()
+        for _, source, _ in self.jobs:
+            await source.close()
+
+async def run_jobs(args, syncer, jobs):
+    runner = JobRunner(args, syncer, jobs)
+    receiver = None
+    try:
+        if args.webhook_port:
+            receiver = WebhookReceiver(
+                    syncer, runner.notion_source,
+                    [source for _, source, _ in jobs],
+                    args.webhook_secret, args.webhook_queue_size)
+            await receiver.start(args.webhook_host, args.webhook_port)
+
+        interval = AdaptiveInterval(
+                args.watch_min_interval, args.watch_max_interval)
+        watcher = Watcher(runner.run, interval)
+        if args.watch:
+            await watcher.run()
+        else:
+            await runner.run()
+            if receiver:
+                await watcher.wait()
+    finally:
+        if receiver:
+            await receiver.stop()
+        await runner.close()
+
+def job_key(args, target):
+    return SyncWatermarks.job_key(args.source, target, args.notion_database)
+
+def build_http_cache(args):
+    if not args.http_cache:
+        return None
+    return HTTPCache(args.http_cache)
+
 async def github_sync(args, syncer):
-    notion_source = NotionSource(args.notion_token, args.notion_database)
-    github_source = GithubSource(args.github_token, args.github_repo)
-    _filter = args.github_repo
-    if not args.github_use_path:
-        _filter = args.github_repo.rsplit('/', 1)[1]
-    await syncer.sync_sources(notion_source, github_source, _filter)
+    repos = args.github_repo
+    http_cache = build_http_cache(args)
+    clients = await asyncio.gather(*[
+            asyncio.to_thread(GithubSource, args.github_token, repo,
+                              args.github_use_path, args.github_graphql,
+                              http_cache)
+            for repo in repos])
+    jobs = []
+    for repo, client in zip(repos, clients):
+        _filter = repo
+        if not args.github_use_path:
+            _filter = repo.rsplit('/', 1)[1]
+        source = ThreadedIssueSource(client, args.github_threads)
+        jobs.append((job_key(args, repo), source, _filter))
+    await run_jobs(args, syncer, jobs)
 
 async def jira_sync(args, syncer):
-    notion_source = NotionSource(args.notion_token, args.notion_database)
-    jira_source = JiraSource(args.jira_token, args.jira_project,
-                             args.jira_server)
-    await syncer.sync_sources(notion_source, jira_source, args.jira_project)
+    projects = args.jira_project
+    http_cache = build_http_cache(args)
+    clients = await asyncio.gather(*[
+            asyncio.to_thread(JiraSource, args.jira_token, project,
+                              args.jira_server, http_cache,
+                              not args.jira_no_notify)
+            for project in projects])
+    jobs = []
+    for project, client in zip(projects, clients):
+        source = ThreadedIssueSource(client, args.jira_threads)
+        jobs.append((job_key(args, project), source, project))
+    await run_jobs(args, syncer, jobs)
 
 async def bitbucket_sync(args, syncer):
-    notion_source = NotionSource(args.notion_token, args.notion_database)
-    bitbucket_source = BitbucketSource(
-            args.bitbucket_user, args.bitbucket_app_password,
-            args.bitbucket_repo, args.bitbucket_server)
-    _filter = args.bitbucket_repo
-    if not args.bitbucket_use_path:
-        _filter = args.bitbucket_repo.rsplit('/', 1)[1]
-    await syncer.sync_sources(notion_source, bitbucket_source, _filter)
+    repos = args.bitbucket_repo
+    http_cache = build_http_cache(args)
+    clients = await asyncio.gather(*[
+            asyncio.to_thread(BitbucketSource, args.bitbucket_user,
+                              args.bitbucket_app_password, repo,
+                              args.bitbucket_server, args.bitbucket_use_path,
+                              http_cache)
+            for repo in repos])
+    jobs = []
+    for repo, client in zip(repos, clients):
+        # bitbucket keys start with the workspace/repo path either way.
+        _filter = repo
+        source = ThreadedIssueSource(client, args.bitbucket_threads)
+        jobs.append((job_key(args, repo), source, _filter))
+    await run_jobs(args, syncer, jobs)
+
+def write_metrics(args):
+    if metrics.recorder is None:
+        return
+    try:
+        if args.metrics_json:
+            metrics.recorder.write_json(args.metrics_json)
+        if args.metrics_prometheus:
+            metrics.recorder.write_prometheus(args.metrics_prometheus)
+    except OSError as e:
+        log.error(f"failed to write metrics: {e}")
 
 def validate(args):
     errors = []
@@ -197,9 +472,14 @@ async def async_main():
         sys.exit(1)
     syncer = IssueSync(
             args.create_closed, args.create_assignee,
-            args.since_file or args.since,
-            args.archive_aged)
-    await args.func(args, syncer)
+            args.since_file or args.since or defaults['since'],
+            args.archive_aged, args.write_concurrency, args.pipelined)
+    if args.metrics_json or args.metrics_prometheus:
+        metrics.enable()
+    try:
+        await args.func(args, syncer)
+    finally:
+        write_metrics(args)
 
 def main():
     try:
@@ -0,0 +1,107 @@
+import time
+import random
+from datetime import datetime, timedelta, timezone
+
+from notion_issues import unassigned_user
+from notion_issues.sources import IssueSource, Issue, ISO_UTC_FMT, ISO_UTC_MIN_FMT
+from notion_issues.logger import Logger
+
+log = Logger('notion_issues.benchmark')
+
+NOTION_TIMEFMT = "%Y-%m-%dT%H:%M:00.000Z"
+
+def synthetic_issues(count, now, existing=0.9, changed=0.1, prefix="bench",
+                     seed=0):
+    """Build matching source issues and Notion pages for a benchmark.
+
+    A fraction of the source issues exist in Notion, and a fraction of those
+    differ: half are newer in the source, half newer in Notion.
+
+    :param count: number of source issues.
+    :type count: int
+    :param now: the time the benchmark starts.
+    :type now: datetime.datetime
+    :param existing: fraction of the issues already in Notion.
+    :type existing: float
+    :param changed: fraction of the existing issues that differ.
+    :type changed: float
+    :returns: source issues by key, and (key, issue, last edited time) for
+              the Notion pages.
+    :rtype: tuple
+    """
+    rand = random.Random(seed)
+    statuses = ['open', 'open', 'open', 'closed']
+    assignees = ['alice', 'bob', 'carol', unassigned_user]
+    source_updated = now - timedelta(days=2)
+    source_issues = {}
+    notion_pages = []
+    for number in range(1, count + 1):
+        key = f"{prefix}#{number}"
+        issue_dict = {
+              "title": f"Synthetic issue {number}",
+              "status": rand.choice(statuses),
+              "assignee": rand.choice(assignees),
+              "reporter": rand.choice(assignees[:-1]),
+              "labels": rand.sample(['bug', 'feature', 'major', 'minor'], 2),
+              "due_on": "",
+              "opened_on": (now - timedelta(days=10)).strftime(ISO_UTC_MIN_FMT),
+              "updated_on": source_updated.strftime(ISO_UTC_FMT),
+              "link": f"https://example.com/{prefix}/issues/{number}",
+        }
+        source_issues[key] = issue_dict
+        if rand.random() >= existing:
+            continue
+        notion_issue = dict(issue_dict)
+        last_edited = now - timedelta(days=3)
+        if rand.random() < changed:
+            notion_issue['title'] = f"{issue_dict['title']} (edited)"
+            if rand.random() < 0.5:
+                last_edited = now - timedelta(days=1)
+        notion_pages.append(
+                (key, notion_issue, last_edited.strftime(NOTION_TIMEFMT)))
+    return source_issues, notion_pages
+
+class SyntheticSource(IssueSource):
+    """An in memory issue source with optional latency per call.
+
+    :param issues: issue dicts by key, returned as Issues.
+    :type issues: dict
+    :param latency: seconds each call blocks for.
+    :type latency: float
+    """
+
+    closed_statuses = ['closed']
+
+    write_concurrency = 10
+
+    def __init__(self, issues, latency=0, prefix="bench"):
+        self.issues = {key: Issue.coerce(issue)
+                       for key, issue in issues.items()}
+        self.latency = latency
+        self.prefix = prefix
+        self.calls = {'get_issues': 0, 'get_issue': 0, 'update_issue': 0}
+
+    def _call(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def id_to_key(self, _id):
+        return f"{self.prefix}#{_id}"
+
+    def key_to_id(self, key):
+        return int(key.split('#')[-1])
+
+    def get_issue(self, _id):
+        self._call('get_issue')
+        return self.issues.get(self.id_to_key(_id))
+
+    def get_issues(self, since=None, assignee=None):
+        self._call('get_issues')
+        return dict(self.issues)
+
+    def update_issue(self, key, issue_dict, fields=None):
+        self._call('update_issue')
+
+    def __str__(self):
+        return f"Synthetic Source: {self.prefix}"
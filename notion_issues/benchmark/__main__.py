@@ -0,0 +1,190 @@
+"""Benchmark IssueSync.sync_sources against a local fake Notion API.
+
+    python -m notion_issues.benchmark --issues 1000 10000 50000
+"""
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import resource
+import tracemalloc
+import aiohttp
+from datetime import datetime, timedelta, timezone
+
+from notion_issues import IssueSync
+from notion_issues.benchmark import synthetic_issues, SyntheticSource
+from notion_issues.benchmark.server import start_server_process
+from notion_issues.sources.notion import NotionSource
+from notion_issues.helpers import metrics
+from notion_issues.logger import Logger
+
+log = Logger('notion_issues.benchmark')
+
+defaults = {
+        'issues': [1000, 10000, 50000],
+        'existing': 0.9,
+        'changed': 0.1,
+        'latency': 0.05,
+        'rate_limit': 0,
+        'error_rate': 0,
+        'client_rate_limit': 100,
+        'client_burst_limit': 100,
+        'source_latency': 0,
+        'write_concurrency': 10,
+        }
+
+def parse_args():
+    parser = argparse.ArgumentParser('notion_issues.benchmark')
+    parser.add_argument('-n', '--issues', type=int, nargs='+',
+            default=defaults['issues'],
+            help=f"Issue counts to benchmark. Default: {defaults['issues']}")
+    parser.add_argument('--existing', type=float,
+            default=defaults['existing'],
+            help=(f"Fraction of issues already in Notion. "
+                  f"Default: {defaults['existing']}"))
+    parser.add_argument('--changed', type=float,
+            default=defaults['changed'],
+            help=(f"Fraction of existing issues that differ. "
+                  f"Default: {defaults['changed']}"))
+    parser.add_argument('--latency', metavar='SECONDS', type=float,
+            default=defaults['latency'],
+            help=(f"Fake Notion latency per request. "
+                  f"Default: {defaults['latency']}"))
+    parser.add_argument('--rate-limit', metavar='REQ/S', type=float,
+            default=defaults['rate_limit'],
+            help=(f"Fake Notion rate limit, 0 for none. "
+                  f"Default: {defaults['rate_limit']}"))
+    parser.add_argument('--error-rate', metavar='FRACTION', type=float,
+            default=defaults['error_rate'],
+            help=(f"Fraction of fake Notion requests that fail with a 502. "
+                  f"Default: {defaults['error_rate']}"))
+    parser.add_argument('--client-rate-limit', metavar='REQ/S', type=float,
+            default=defaults['client_rate_limit'],
+            help=(f"AioNotion starting client rate limit. "
+                  f"Default: {defaults['client_rate_limit']}"))
+    parser.add_argument('--client-burst-limit', metavar='N', type=int,
+            default=defaults['client_burst_limit'],
+            help=(f"AioNotion client burst limit. "
+                  f"Default: {defaults['client_burst_limit']}"))
+    parser.add_argument('--source-latency', metavar='SECONDS', type=float,
+            default=defaults['source_latency'],
+            help=(f"Synthetic source latency per call. "
+                  f"Default: {defaults['source_latency']}"))
+    parser.add_argument('--write-concurrency', metavar='N', type=int,
+            default=defaults['write_concurrency'],
+            help=(f"Maximum concurrent writes. "
+                  f"Default: {defaults['write_concurrency']}"))
+    parser.add_argument('--pipelined', action='store_true',
+            help=f"Write while the scans are still running.")
+    parser.add_argument('--trace-memory', action='store_true',
+            help=f"Measure peak Python allocations with tracemalloc (slow).")
+    parser.add_argument('--json', action='store_true',
+            help=f"Print results as json lines.")
+    parser.add_argument('-v', '--verbose', action='store_true',
+            help=f"Turn on verbose logging")
+    return parser.parse_args()
+
+async def server_stats(url):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{url}_stats") as resp:
+            return await resp.json()
+
+async def run_benchmark(args, count):
+    now = datetime.now(timezone.utc)
+    source_issues, notion_pages = synthetic_issues(
+            count, now, args.existing, args.changed)
+    process, conn, url = start_server_process(
+            "Benchmark", notion_pages, args.latency, args.rate_limit,
+            error_rate=args.error_rate)
+
+    if args.trace_memory:
+        tracemalloc.start()
+    recorder = metrics.enable()
+    try:
+        notion_source = NotionSource(
+                "benchmark", "Benchmark",
+                rate_limit=args.client_rate_limit,
+                burst_limit=args.client_burst_limit, api_base=url)
+        other_source = SyntheticSource(source_issues, args.source_latency)
+        syncer = IssueSync(since=now - timedelta(days=30), archive_aged=0,
+                           write_concurrency=args.write_concurrency,
+                           pipelined=args.pipelined)
+        start = time.monotonic()
+        operations = await syncer.sync_sources(
+                notion_source, other_source, "bench")
+        wall = time.monotonic() - start
+        await notion_source.close()
+        stats = await server_stats(url)
+    finally:
+        metrics.disable()
+        peak = None
+        if args.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        conn.close()
+        process.join(5)
+
+    first_write = None
+    if syncer.first_write is not None:
+        first_write = round(syncer.first_write - start, 3)
+    notion_metrics = recorder.summary()['services'].get('notion', {})
+    return {
+        'issues': count,
+        'wall_seconds': round(wall, 3),
+        'first_write_seconds': first_write,
+        'writes': len(operations),
+        'failures': len([op for op in operations if op.failed]),
+        'notion_requests': sum(stats['requests'].values()),
+        'notion_requests_by_endpoint': stats['requests'],
+        'notion_statuses': stats['statuses'],
+        'duplicate_keys': stats['duplicate_keys'],
+        'notion_retries': sum(endpoint['retries'] for endpoint
+                              in notion_metrics['endpoints'].values()),
+        'notion_throttled_seconds': notion_metrics['throttled_seconds'],
+        'notion_latency_by_endpoint': {
+            name: endpoint['latency']
+            for name, endpoint in notion_metrics['endpoints'].items()},
+        'source_calls': other_source.calls,
+        'timings': {k: round(v, 3) for k, v in syncer.timings.items()},
+        'peak_traced_bytes': peak,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+def report(result):
+    print(f"{result['issues']:>7} issues  {result['wall_seconds']:>9.2f}s  "
+          f"{result['notion_requests']:>7} notion requests  "
+          f"{result['writes']:>6} writes  {result['failures']} failures  "
+          f"maxrss {result['max_rss_kb'] / 1024:.0f}MiB", end="")
+    if result['peak_traced_bytes'] is not None:
+        print(f"  peak {result['peak_traced_bytes'] / 2**20:.1f}MiB", end="")
+    print()
+    if result['first_write_seconds'] is not None:
+        print(f"        first write after {result['first_write_seconds']:.2f}s")
+    print(f"        by endpoint: {result['notion_requests_by_endpoint']}")
+    print(f"        statuses: {result['notion_statuses']}  "
+          f"duplicate keys: {result['duplicate_keys']}")
+    print(f"        retries: {result['notion_retries']}  "
+          f"throttled: {result['notion_throttled_seconds']:.2f}s")
+    for name, latency in result['notion_latency_by_endpoint'].items():
+        print(f"        {name}: mean {latency['mean'] * 1000:.1f}ms "
+              f"max {latency['max'] * 1000:.1f}ms")
+
+async def main():
+    args = parse_args()
+    if args.verbose:
+        Logger.verbose()
+    else:
+        Logger.silent()
+        logging.getLogger('aio_api_sm').setLevel(logging.ERROR)
+    for count in args.issues:
+        result = await run_benchmark(args, count)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            report(result)
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,410 @@
+import json
+import time
+import uuid
+import random
+import asyncio
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from aiohttp import web
+
+from notion_issues.logger import Logger
+
+log = Logger('notion_issues.benchmark.server')
+
+NOTION_TIMEFMT = "%Y-%m-%dT%H:%M:00.000Z"
+
+# the issue database schema used by NotionSource.
+SCHEMA = {
+        "Title": "title",
+        "Issue Key": "rich_text",
+        "Status": "select",
+        "Assignee": "select",
+        "Reporter": "select",
+        "Labels": "multi_select",
+        "Due Date": "date",
+        "Opened On": "date",
+        "Updated On": "date",
+        "Link": "url",
+        }
+
+def notion_now():
+    return datetime.now(timezone.utc).strftime(NOTION_TIMEFMT)
+
+def rich_text(content):
+    return [{"type": "text", "text": {"content": content, "link": None},
+             "plain_text": content, "href": None}]
+
+class FakeDatabase:
+    """An in memory Notion database.
+
+    :param name: the database title.
+    :type name: str
+    """
+
+    def __init__(self, name):
+        self.id = str(uuid.uuid4())
+        self.name = name
+        self.properties = {name: {"id": f"p{i}", "name": name, "type": _type,
+                                  _type: {}}
+                           for i, (name, _type) in enumerate(SCHEMA.items())}
+        self.property_names = {p["id"]: name
+                               for name, p in self.properties.items()}
+        self.pages = {}
+        self.version = 0
+        self._query_cache = {}
+
+    def to_json(self):
+        return {"object": "database", "id": self.id,
+                "title": rich_text(self.name),
+                "last_edited_time": notion_now(),
+                "properties": self.properties}
+
+    def property_value(self, page, name):
+        prop = page["properties"].get(name)
+        if not prop:
+            return None
+        _type = prop["type"]
+        value = prop.get(_type)
+        if _type in ("title", "rich_text"):
+            return "".join(i["plain_text"] for i in value)
+        if _type == "select":
+            return value["name"] if value else None
+        if _type == "multi_select":
+            return [i["name"] for i in value]
+        if _type == "date":
+            return value["start"] if value else None
+        return value
+
+    def set_properties(self, page, properties):
+        for name, value in properties.items():
+            _type = self.properties[name]["type"]
+            prop = {"id": self.properties[name]["id"], "type": _type}
+            if _type in ("title", "rich_text"):
+                content = "".join(i["text"]["content"] for i in value[_type])
+                prop[_type] = rich_text(content)
+            elif _type == "select":
+                prop[_type] = value[_type] and {"name": value[_type]["name"]}
+            elif _type == "multi_select":
+                prop[_type] = [{"name": i["name"]} for i in value[_type]]
+            else:
+                prop[_type] = value[_type]
+            page["properties"][name] = prop
+        page["last_edited_time"] = notion_now()
+        self.version += 1
+
+    def create_page(self, properties, created_time=None):
+        now = created_time or notion_now()
+        page = {"object": "page", "id": str(uuid.uuid4()),
+                "created_time": now, "last_edited_time": now,
+                "archived": False,
+                "parent": {"type": "database_id", "database_id": self.id},
+                "properties": {}}
+        for name, prop in self.properties.items():
+            _type = prop["type"]
+            empty = [] if _type in ("title", "rich_text", "multi_select") \
+                    else None
+            page["properties"][name] = {"id": prop["id"], "type": _type,
+                                        _type: empty}
+        self.set_properties(page, properties)
+        if created_time:
+            page["last_edited_time"] = created_time
+        self.pages[page["id"]] = page
+        return page
+
+    def add_issue(self, key, issue_dict, last_edited_time):
+        """Add a page for an issue dict without counting a request."""
+        properties = {
+                "Title": {"title": [{"text": {"content": issue_dict['title']}}]},
+                "Issue Key": {"rich_text": [{"text": {"content": key}}]},
+                "Status": {"select": {"name": issue_dict['status']}},
+                "Assignee": {"select": {"name": issue_dict['assignee']}},
+                "Reporter": {"select": {"name": issue_dict['reporter']}},
+                "Labels": {"multi_select": [{"name": l}
+                                            for l in issue_dict['labels']]},
+                "Opened On": {"date": {"start": issue_dict['opened_on']}},
+                "Link": {"url": issue_dict['link']},
+                }
+        if issue_dict['due_on']:
+            properties["Due Date"] = {"date": {"start": issue_dict['due_on']}}
+        return self.create_page(properties, created_time=last_edited_time)
+
+    def matches(self, page, _filter):
+        if not _filter:
+            return True
+        if "and" in _filter:
+            return all(self.matches(page, f) for f in _filter["and"])
+        if "or" in _filter:
+            return any(self.matches(page, f) for f in _filter["or"])
+        if _filter.get("timestamp") == "last_edited_time":
+            condition = _filter["last_edited_time"]
+            edited = page["last_edited_time"][:16]
+            if "after" in condition:
+                return edited > condition["after"][:16]
+            if "on_or_after" in condition:
+                return edited >= condition["on_or_after"][:16]
+            return True
+        value = self.property_value(page, _filter["property"])
+        (_, condition), = [(k, v) for k, v in _filter.items()
+                           if k != "property"]
+        if "equals" in condition:
+            return value == condition["equals"]
+        if "starts_with" in condition:
+            return (value or "").startswith(condition["starts_with"])
+        return True
+
+    def query(self, _filter):
+        """Get the ids of matching pages, cached until the next write."""
+        cache_key = json.dumps(_filter, sort_keys=True)
+        cached = self._query_cache.get(cache_key)
+        if cached and cached[0] == self.version:
+            return cached[1]
+        ids = [page_id for page_id, page in self.pages.items()
+               if not page["archived"] and self.matches(page, _filter)]
+        self._query_cache[cache_key] = (self.version, ids)
+        return ids
+
+class FakeNotionServer:
+    """A local stand-in for the Notion API endpoints used by the sync.
+
+    Serves search, database, database query, page create, get and update,
+    page property, and comments endpoints from in memory databases, with
+    optional latency per request and a token bucket rate limit that answers
+    with 429 and Retry-After when exceeded.
+
+    A fraction of requests can fail with a 502, half of them after the
+    request was handled, like a response lost on the way back.
+
+    :param latency: seconds to wait before answering each request.
+    :type latency: float
+    :param rate_limit: requests per second before 429s, 0 for no limit.
+    :type rate_limit: float
+    :param burst_limit: token bucket size. Default 10.
+    :type burst_limit: int
+    :param error_rate: fraction of requests that fail with a 502.
+    :type error_rate: float
+    """
+
+    def __init__(self, latency=0, rate_limit=0, burst_limit=10,
+                 error_rate=0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self.rate_limit = rate_limit
+        self.burst_limit = burst_limit
+        self.databases = {}
+        self.requests = Counter()
+        self.statuses = Counter()
+        self._tokens = burst_limit
+        self._last_fill = time.monotonic()
+
+    def add_database(self, name):
+        database = FakeDatabase(name)
+        self.databases[database.id] = database
+        return database
+
+    def _page(self, page_id):
+        for database in self.databases.values():
+            if page_id in database.pages:
+                return database, database.pages[page_id]
+        raise web.HTTPNotFound()
+
+    def _take_token(self):
+        if not self.rate_limit:
+            return True
+        now = time.monotonic()
+        self._tokens = min(self.burst_limit, self._tokens +
+                           (now - self._last_fill) * self.rate_limit)
+        self._last_fill = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        name = request.match_info.route.name or "unknown"
+        if name != "stats":
+            self.requests[name] += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if not self._take_token():
+                self.statuses[429] += 1
+                return web.json_response(
+                        {"object": "error", "status": 429,
+                         "code": "rate_limited"},
+                        status=429, headers={"Retry-After": "1"})
+            if self._random.random() < self.error_rate:
+                if self._random.random() < 0.5:
+                    await handler(request)
+                self.statuses[502] += 1
+                return web.json_response(
+                        {"object": "error", "status": 502,
+                         "code": "bad_gateway"}, status=502)
+        response = await handler(request)
+        if name != "stats":
+            self.statuses[response.status] += 1
+        return response
+
+    def _paginate(self, items, params):
+        page_size = min(int(params.get("page_size", 100)), 100)
+        start = int(params.get("start_cursor") or 0)
+        end = start + page_size
+        has_more = end < len(items)
+        return web.json_response({
+                "object": "list", "results": items[start:end],
+                "has_more": has_more,
+                "next_cursor": str(end) if has_more else None})
+
+    async def search(self, request):
+        body = await request.json()
+        query = body.get("query", "").lower()
+        results = [db.to_json() for db in self.databases.values()
+                   if query in db.name.lower()]
+        return web.json_response({"object": "list", "results": results,
+                                  "has_more": False, "next_cursor": None})
+
+    async def get_database(self, request):
+        database = self.databases.get(request.match_info["database_id"])
+        if not database:
+            raise web.HTTPNotFound()
+        return web.json_response(database.to_json())
+
+    async def query_database(self, request):
+        database = self.databases.get(request.match_info["database_id"])
+        if not database:
+            raise web.HTTPNotFound()
+        body = await request.json() if request.can_read_body else {}
+        ids = database.query(body.get("filter", {}))
+        start = int(body.get("start_cursor") or 0)
+        page_size = min(int(body.get("page_size", 100)), 100)
+        pages = [database.pages[i] for i in ids[start:start + page_size]]
+        has_more = start + page_size < len(ids)
+        return web.json_response({
+                "object": "list", "results": pages, "has_more": has_more,
+                "next_cursor": str(start + page_size) if has_more else None})
+
+    async def create_page(self, request):
+        body = await request.json()
+        database = self.databases.get(body["parent"]["database_id"])
+        if not database:
+            raise web.HTTPNotFound()
+        page = database.create_page(body.get("properties", {}))
+        return web.json_response(page)
+
+    async def get_page(self, request):
+        _, page = self._page(request.match_info["page_id"])
+        return web.json_response(page)
+
+    async def update_page(self, request):
+        database, page = self._page(request.match_info["page_id"])
+        body = await request.json()
+        database.set_properties(page, body.get("properties", {}))
+        if body.get("archived"):
+            page["archived"] = True
+        return web.json_response(page)
+
+    async def get_property(self, request):
+        database, page = self._page(request.match_info["page_id"])
+        name = database.property_names[request.match_info["property_id"]]
+        prop = page["properties"][name]
+        _type = prop["type"]
+        if _type in ("title", "rich_text"):
+            items = [{"object": "property_item", "type": _type, _type: item}
+                     for item in prop[_type]]
+            response = self._paginate(items, request.query)
+            body = json.loads(response.body)
+            body["property_item"] = {"id": prop["id"], "type": _type}
+            return web.json_response(body)
+        return web.json_response({"object": "property_item", **prop})
+
+    async def get_comments(self, request):
+        return self._paginate([], request.query)
+
+    def duplicate_keys(self):
+        """Count issue keys with more than one live page."""
+        duplicates = 0
+        for database in self.databases.values():
+            keys = Counter(database.property_value(page, "Issue Key")
+                           for page in database.pages.values()
+                           if not page["archived"])
+            duplicates += len([k for k, count in keys.items() if count > 1])
+        return duplicates
+
+    async def stats(self, request):
+        return web.json_response({
+                "requests": dict(self.requests),
+                "statuses": {str(k): v for k, v in self.statuses.items()},
+                "duplicate_keys": self.duplicate_keys()})
+
+    def app(self):
+        app = web.Application(middlewares=[self.middleware],
+                              client_max_size=2**24)
+        r = app.router
+        r.add_post("/v1/search", self.search, name="search")
+        r.add_get("/v1/databases/{database_id}", self.get_database,
+                  name="database")
+        r.add_post("/v1/databases/{database_id}/query", self.query_database,
+                   name="database.query")
+        r.add_post("/v1/pages", self.create_page, name="pages")
+        r.add_get("/v1/pages/{page_id}", self.get_page, name="page")
+        r.add_patch("/v1/pages/{page_id}", self.update_page,
+                    name="page.update")
+        r.add_get("/v1/pages/{page_id}/properties/{property_id}",
+                  self.get_property, name="page.property")
+        r.add_get("/v1/comments", self.get_comments, name="comments")
+        r.add_get("/_stats", self.stats, name="stats")
+        return app
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Start serving, returns the base url of the server."""
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        log.debug(f"fake notion listening on http://{host}:{port}/")
+        return f"http://{host}:{port}/"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+def _serve(conn, database_name, issues, latency, rate_limit, burst_limit,
+           error_rate):
+    async def run():
+        server = FakeNotionServer(latency, rate_limit, burst_limit,
+                                  error_rate)
+        database = server.add_database(database_name)
+        for key, issue_dict, last_edited_time in issues:
+            database.add_issue(key, issue_dict, last_edited_time)
+        url = await server.start()
+        conn.send(url)
+        # serve until the parent closes the pipe.
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, conn.recv)
+
+    try:
+        asyncio.run(run())
+    except EOFError:
+        pass
+
+def start_server_process(database_name, issues, latency=0, rate_limit=0,
+                         burst_limit=10, error_rate=0):
+    """Run a FakeNotionServer in a child process.
+
+    Keeps the server's CPU and memory out of the measurements.
+
+    :param issues: (key, issue dict, last edited time) to add to the database.
+    :type issues: list
+    :returns: the process, a connection to stop it, and the server url.
+    :rtype: tuple
+    """
+    import multiprocessing
+    ctx = multiprocessing.get_context('spawn')
+    parent_conn, child_conn = ctx.Pipe()
+    process = ctx.Process(
+            target=_serve, daemon=True,
+            args=(child_conn, database_name, issues, latency, rate_limit,
+                  burst_limit, error_rate))
+    process.start()
+    url = parent_conn.recv()
+    return process, parent_conn, url
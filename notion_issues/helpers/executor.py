@@ -0,0 +1,174 @@
+import time
+import weakref
+import asyncio
+import inspect
+
+from notion_issues.logger import Logger
+
+log = Logger('notion_issues.helpers.executor')
+
+class WriteOperation:
+    """A write to one side of a sync.
+
+    Calls ``target.<action>(key, *args)`` when run.  The result or the
+    exception raised is kept on the operation.
+
+    :param key: issue key.
+    :type key: str
+    :param target: the source to write to.
+    :type target: notion_issues.sources.IssueSource
+    :param action: name of the method to call, i.e. update_issue.
+    :type action: str
+    :param args: additional arguments for the method.
+    """
+
+    def __init__(self, key, target, action, *args):
+        self.key = key
+        self.target = target
+        self.action = action
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = False
+
+    async def run(self):
+        method = getattr(self.target, self.action)
+        try:
+            result = method(self.key, *self.args)
+            if inspect.isawaitable(result):
+                result = await result
+            self.result = result
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+        return self.result
+
+    @property
+    def failed(self):
+        return bool(self.error) or not self.done
+
+    def __str__(self):
+        return f"{self.key}: {self.action} on {self.target}"
+
+class KeyLocks:
+    """Locks by issue key, shared by the executors of concurrent syncs.
+
+    A lock lives while an executor holds or waits for it.
+    """
+
+    def __init__(self):
+        self._locks = weakref.WeakValueDictionary()
+
+    def lock(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+
+class WriteExecutor:
+    """Run write operations with a bounded pool of concurrent workers.
+
+    Operations for the same key run in the order they were added, operations
+    for different keys run concurrently.  Each target is limited to its
+    ``write_concurrency`` concurrent writes; rate limits are left to the
+    clients themselves.
+
+    Operations can be added before ``execute``, or while the executor runs
+    between ``start`` and ``join``.  While running, all the operations for a
+    key must be added without awaiting in between, a key's chain is queued
+    when its first operation is added.
+
+    Executors that share ``key_locks`` run a key's chains one at a time,
+    so syncs running at once, i.e. a webhook and a watch cycle, never write
+    the same issue concurrently.
+
+    :param concurrency: maximum number of concurrent writes. Default 10.
+    :type concurrency: int
+    :param key_locks: locks shared with other executors.
+    :type key_locks: KeyLocks
+    """
+
+    def __init__(self, concurrency=10, key_locks=None):
+        self.concurrency = concurrency
+        self.key_locks = key_locks
+        self.operations = []
+        self.first_write = None
+        self._chains = {}
+        self._target_limits = {}
+        self._queue = None
+        self._workers = []
+
+    def add(self, operation):
+        self.operations.append(operation)
+        chain = self._chains.setdefault(operation.key, [])
+        chain.append(operation)
+        if self._queue and len(chain) == 1:
+            self._queue.put_nowait(chain)
+
+    def _target_limit(self, target):
+        if id(target) not in self._target_limits:
+            limit = getattr(target, 'write_concurrency', self.concurrency)
+            self._target_limits[id(target)] = asyncio.Semaphore(
+                    min(limit, self.concurrency))
+        return self._target_limits[id(target)]
+
+    async def _consume_queue(self, q):
+        while True:
+            chain = await q.get()
+            if not chain:
+                return
+            if self.key_locks is None:
+                await self._run_chain(chain)
+            else:
+                async with self.key_locks.lock(chain[0].key):
+                    await self._run_chain(chain)
+
+    async def _run_chain(self, chain):
+        for operation in chain:
+            async with self._target_limit(operation.target):
+                log.debug(f"{operation}: started.")
+                if self.first_write is None:
+                    self.first_write = time.monotonic()
+                await operation.run()
+            if operation.error:
+                log.error(f"{operation}: failed: {operation.error}",
+                          exc_info=operation.error)
+                break
+
+    def start(self, concurrency=None):
+        """Start the workers, operations added from now on run right away.
+
+        :param concurrency: workers to start. Default self.concurrency.
+        :type concurrency: int
+        """
+        self._queue = asyncio.Queue()
+        for chain in self._chains.values():
+            self._queue.put_nowait(chain)
+        self._workers = [asyncio.create_task(self._consume_queue(self._queue))
+                         for _ in range(0, concurrency or self.concurrency)]
+
+    async def join(self):
+        """Wait for all the operations added to finish.
+
+        :returns: the operations with their results and errors.
+        :rtype: list
+        """
+        for _ in self._workers:
+            await self._queue.put(None)
+        try:
+            await asyncio.gather(*self._workers)
+        finally:
+            self._queue = None
+            self._workers = []
+        return self.operations
+
+    async def execute(self):
+        """Run all operations added to the executor.
+
+        :returns: the operations with their results and errors.
+        :rtype: list
+        """
+        self.start(min(self.concurrency, len(self._chains)) or 1)
+        return await self.join()
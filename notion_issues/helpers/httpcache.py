@@ -0,0 +1,192 @@
+"""Conditional request cache for the requests sessions of issue sources.
+
+GET responses with an ETag or Last-Modified header are stored, and the
+next identical request is sent with If-None-Match or If-Modified-Since.
+When the server answers 304 Not Modified, the stored response is returned
+in its place, so unchanged resources cost a 304 instead of a full body,
+and GitHub doesn't count them against the rate limit.
+"""
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from notion_issues.logger import Logger
+
+log = Logger('notion_issues.helpers.httpcache')
+
+class HTTPCache:
+    """Responses and their validators, by request, in a SQLite file.
+
+    Requests are keyed by URL and the headers that change the response, so
+    clients with different tokens never share responses.  Entries that
+    haven't been used for ``max_age`` seconds are removed when the cache is
+    opened.
+
+    :param path: path to the cache file, ``:memory:`` for a temporary cache.
+    :type path: str
+    :param max_age: seconds an unused entry is kept. Default 7 days.
+    :type max_age: int
+    """
+
+    # request headers that change the response, part of the cache key.
+    vary_headers = ['Accept', 'Authorization']
+
+    # response headers that describe the body as sent, not as stored.
+    dropped_headers = ['Content-Encoding', 'Content-Length',
+                       'Transfer-Encoding']
+
+    def __init__(self, path, max_age=7*24*60*60):
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, url TEXT, etag TEXT, "
+                    "last_modified TEXT, headers TEXT, body BLOB, used REAL)")
+        self.prune()
+
+    def key(self, request):
+        parts = [request.method, request.url]
+        parts.extend(request.headers.get(header, '')
+                     for header in self.vary_headers)
+        return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+    def get(self, key):
+        """Get a stored response.
+
+        :returns: (etag, last modified, headers, body) or None.
+        :rtype: tuple
+        """
+        with self._lock:
+            row = self.db.execute(
+                    "SELECT etag, last_modified, headers, body "
+                    "FROM responses WHERE key = ?", (key, )).fetchone()
+        if not row:
+            return None
+        etag, last_modified, headers, body = row
+        return etag, last_modified, json.loads(headers), body
+
+    def store(self, key, response):
+        """Store a response if it has validators.
+
+        :returns: True if the response was stored.
+        :rtype: bool
+        """
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not (etag or last_modified):
+            return False
+        if 'no-store' in response.headers.get('Cache-Control', ''):
+            return False
+        headers = {name: value for name, value in response.headers.items()
+                   if name not in self.dropped_headers}
+        with self._lock, self.db:
+            self.db.execute(
+                    "INSERT OR REPLACE INTO responses "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, response.url, etag, last_modified,
+                     json.dumps(headers), response.content, time.time()))
+        return True
+
+    def touch(self, key):
+        with self._lock, self.db:
+            self.db.execute("UPDATE responses SET used = ? WHERE key = ?",
+                            (time.time(), key))
+
+    def prune(self):
+        with self._lock, self.db:
+            cursor = self.db.execute(
+                    "DELETE FROM responses WHERE used < ?",
+                    (time.time() - self.max_age, ))
+        if cursor.rowcount:
+            log.debug(f"{self}: pruned {cursor.rowcount} responses.")
+
+    def install(self, session):
+        """Send the GET requests of a session through the cache.
+
+        The session's adapters are wrapped, so retries and connection
+        pools configured by the client are kept.
+
+        :param session: the session used by a source client.
+        :type session: requests.Session
+        """
+        for prefix, adapter in list(session.adapters.items()):
+            if not isinstance(adapter, ConditionalCacheAdapter):
+                session.mount(prefix, ConditionalCacheAdapter(self, adapter))
+
+    def close(self):
+        self.db.close()
+
+    def __str__(self):
+        return f"HTTPCache({self.path})"
+
+class ConditionalCacheAdapter(BaseAdapter):
+    """A requests transport adapter that sends conditional GET requests.
+
+    Responses served from the cache after a 304 have ``revalidated`` set to
+    True, with the headers of the 304 (e.g. rate limits) over the stored
+    ones.
+
+    :param cache: the response cache.
+    :type cache: HTTPCache
+    :param adapter: the adapter that sends requests.
+    :type adapter: requests.adapters.BaseAdapter
+    """
+
+    conditional_headers = ['If-None-Match', 'If-Modified-Since']
+
+    def __init__(self, cache, adapter):
+        super().__init__()
+        self.cache = cache
+        self.adapter = adapter
+
+    def send(self, request, stream=False, **kwargs):
+        if request.method != 'GET' or stream or any(
+                h in request.headers for h in self.conditional_headers):
+            return self.adapter.send(request, stream=stream, **kwargs)
+
+        key = self.cache.key(request)
+        entry = self.cache.get(key)
+        if entry:
+            etag, last_modified, _, _ = entry
+            if etag:
+                request.headers['If-None-Match'] = etag
+            if last_modified:
+                request.headers['If-Modified-Since'] = last_modified
+
+        response = self.adapter.send(request, stream=stream, **kwargs)
+        if response.status_code == 304 and entry:
+            self.cache.touch(key)
+            return self._revalidated(response, entry)
+        if response.status_code == 200:
+            self.cache.store(key, response)
+        return response
+
+    def _revalidated(self, not_modified, entry):
+        _, _, headers, body = entry
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.headers = CaseInsensitiveDict(headers)
+        response.headers.update(not_modified.headers)
+        for header in HTTPCache.dropped_headers:
+            response.headers.pop(header, None)
+        response._content = body
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = not_modified.url
+        response.request = not_modified.request
+        response.connection = not_modified.connection
+        response.raw = not_modified.raw
+        response.revalidated = True
+        return response
+
+    def close(self):
+        self.adapter.close()
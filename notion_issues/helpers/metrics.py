@@ -0,0 +1,301 @@
+"""Per endpoint request metrics for Notion and the issue source clients.
+
+Metrics are off unless ``enable`` is called.  While off, ``recorder`` is None
+and no hooks are installed on the clients, so recording costs a single
+``is None`` check per request.
+"""
+import re
+import time
+import threading
+from collections import defaultdict
+
+from notion_issues.helpers.state import atomic_write_json, atomic_write_text
+from notion_issues.logger import Logger
+
+log = Logger('notion_issues.helpers.metrics')
+
+recorder = None
+
+def enable():
+    """Start recording request metrics.
+
+    :returns: the active recorder.
+    :rtype: RequestMetrics
+    """
+    global recorder
+    if recorder is None:
+        recorder = RequestMetrics()
+    return recorder
+
+def disable():
+    global recorder
+    recorder = None
+
+class EndpointMatcher:
+    """Map request paths back to named endpoints.
+
+    Templates use the same ``{param}`` placeholders as ``AioNotion.paths``
+    and are matched against the end of the path, so servers hosted under a
+    context path still match.  Paths that match no template are reported as
+    ``other``.
+
+    :param templates: endpoint names and path templates.
+    :type templates: dict
+    :param prefix: prefix shared by all paths, e.g. ``/v1/``.
+    :type prefix: str
+    """
+
+    unmatched = 'other'
+
+    def __init__(self, templates, prefix='/'):
+        self.patterns = []
+        for name, template in templates.items():
+            parts = re.split(r'\{[^}]+\}', template)
+            pattern = '[^/]+'.join(re.escape(part) for part in parts)
+            self.patterns.append(
+                    (name, re.compile(f"{re.escape(prefix)}{pattern}/?$")))
+
+    def match(self, path):
+        path = path.split('?', 1)[0]
+        for name, pattern in self.patterns:
+            if pattern.search(path):
+                return name
+        return self.unmatched
+
+class Histogram:
+    """A cumulative latency histogram with fixed bucket bounds."""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                break
+        else:
+            i = len(self.bounds)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def cumulative(self):
+        """Bucket upper bounds and cumulative counts, ending with +Inf."""
+        total = 0
+        buckets = []
+        for bound, count in zip(self.bounds + ('+Inf', ), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'mean': round(self.sum / self.count, 6) if self.count else 0,
+            'max': round(self.max, 6),
+            'buckets': {str(bound): count
+                        for bound, count in self.cumulative()},
+        }
+
+class RequestMetrics:
+    """Request counts, statuses, latencies, retries and throttled time.
+
+    Counters are keyed by service (notion, github, jira, bitbucket) and
+    endpoint.  Recording is thread safe, the source clients record from
+    their thread pools.
+    """
+
+    latency_buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    prefix = 'notion_issues'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.requests = defaultdict(int)
+        self.latency = {}
+        self.retries = defaultdict(int)
+        self.throttled = defaultdict(float)
+
+    def record_request(self, service, endpoint, method, status, seconds):
+        """Record a completed request attempt.
+
+        :param status: HTTP status, or ``error`` if no response was received.
+        :type status: int or str
+        :param seconds: time from sending the request to the response.
+        :type seconds: float
+        """
+        with self._lock:
+            self.requests[(service, endpoint, method.lower(), str(status))] += 1
+            key = (service, endpoint)
+            if key not in self.latency:
+                self.latency[key] = Histogram(self.latency_buckets)
+            self.latency[key].observe(seconds)
+
+    def record_retry(self, service, endpoint, count=1):
+        with self._lock:
+            self.retries[(service, endpoint)] += count
+
+    def record_throttle(self, service, seconds):
+        """Record time spent waiting on a rate limit before a request."""
+        with self._lock:
+            self.throttled[service] += seconds
+
+    def summary(self):
+        """Summarize the metrics by service and endpoint.
+
+        :returns: json serializable summary.
+        :rtype: dict
+        """
+        services = {}
+
+        def endpoint_summary(service, endpoint):
+            endpoints = services.setdefault(service, {
+                    'throttled_seconds': 0, 'endpoints': {}})['endpoints']
+            return endpoints.setdefault(endpoint, {
+                    'requests': 0, 'statuses': {}, 'retries': 0})
+
+        with self._lock:
+            for (service, endpoint, method, status), count \
+                    in self.requests.items():
+                summary = endpoint_summary(service, endpoint)
+                summary['requests'] += count
+                statuses = summary['statuses']
+                statuses[status] = statuses.get(status, 0) + count
+            for (service, endpoint), histogram in self.latency.items():
+                endpoint_summary(service, endpoint)['latency'] = \
+                        histogram.summary()
+            for (service, endpoint), count in self.retries.items():
+                endpoint_summary(service, endpoint)['retries'] = count
+            for service, seconds in self.throttled.items():
+                services.setdefault(service, {'endpoints': {}})
+                services[service]['throttled_seconds'] = round(seconds, 3)
+
+        return {
+            'started': self.started,
+            'duration_seconds': round(time.time() - self.started, 3),
+            'services': services,
+        }
+
+    def prometheus(self):
+        """Render the metrics in the Prometheus text exposition format.
+
+        :returns: metrics text.
+        :rtype: str
+        """
+        p = self.prefix
+        lines = []
+
+        def labels(**kwargs):
+            inner = ",".join(f'{k}="{v}"' for k, v in kwargs.items())
+            return f"{{{inner}}}"
+
+        with self._lock:
+            lines.append(f"# HELP {p}_requests_total HTTP requests by "
+                         f"service, endpoint, method and status.")
+            lines.append(f"# TYPE {p}_requests_total counter")
+            for (service, endpoint, method, status), count \
+                    in sorted(self.requests.items()):
+                lines.append(f"{p}_requests_total" + labels(
+                        service=service, endpoint=endpoint, method=method,
+                        status=status) + f" {count}")
+
+            lines.append(f"# HELP {p}_request_duration_seconds HTTP request "
+                         f"latency by service and endpoint.")
+            lines.append(f"# TYPE {p}_request_duration_seconds histogram")
+            for (service, endpoint), histogram in sorted(self.latency.items()):
+                name = f"{p}_request_duration_seconds"
+                for bound, count in histogram.cumulative():
+                    lines.append(f"{name}_bucket" + labels(
+                            service=service, endpoint=endpoint,
+                            le=bound) + f" {count}")
+                lines.append(f"{name}_sum" + labels(
+                        service=service, endpoint=endpoint) +
+                        f" {histogram.sum}")
+                lines.append(f"{name}_count" + labels(
+                        service=service, endpoint=endpoint) +
+                        f" {histogram.count}")
+
+            lines.append(f"# HELP {p}_request_retries_total Retried requests "
+                         f"by service and endpoint.")
+            lines.append(f"# TYPE {p}_request_retries_total counter")
+            for (service, endpoint), count in sorted(self.retries.items()):
+                lines.append(f"{p}_request_retries_total" + labels(
+                        service=service, endpoint=endpoint) + f" {count}")
+
+            lines.append(f"# HELP {p}_throttled_seconds_total Time spent "
+                         f"waiting on rate limits by service.")
+            lines.append(f"# TYPE {p}_throttled_seconds_total counter")
+            for service, seconds in sorted(self.throttled.items()):
+                lines.append(f"{p}_throttled_seconds_total" + labels(
+                        service=service) + f" {seconds}")
+
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        atomic_write_json(path, self.summary())
+        log.debug(f"wrote request metrics summary to {path}.")
+
+    def write_prometheus(self, path):
+        """Write a textfile for the node exporter textfile collector.
+
+        The file is replaced atomically so the collector never reads a
+        partial file.
+        """
+        atomic_write_text(path, self.prometheus(), mode=0o644)
+        log.debug(f"wrote prometheus metrics to {path}.")
+
+def requests_hook(service, matcher, retry_statuses=()):
+    """Build a requests response hook that records to the active recorder.
+
+    Responses with a status in retry_statuses are counted as retries, the
+    client retries them itself.  A Retry-After on a 429 is counted as
+    throttled time.  Responses served from the HTTP cache after a 304 are
+    recorded as 304s.
+
+    :param service: service name to record under.
+    :type service: str
+    :param matcher: maps request paths to endpoint names.
+    :type matcher: EndpointMatcher
+    :param retry_statuses: statuses the client retries.
+    :type retry_statuses: list
+    :returns: hook for ``requests.Session.hooks['response']``.
+    :rtype: callable
+    """
+    def record(response, *args, **kwargs):
+        if recorder is None:
+            return
+        endpoint = matcher.match(response.request.path_url)
+        status = response.status_code
+        if getattr(response, 'revalidated', False):
+            status = 304
+        recorder.record_request(service, endpoint, response.request.method,
+                                status, response.elapsed.total_seconds())
+        if response.status_code in retry_statuses:
+            recorder.record_retry(service, endpoint)
+        if response.status_code == 429:
+            try:
+                recorder.record_throttle(
+                        service, float(response.headers.get('Retry-After')))
+            except (TypeError, ValueError):
+                pass
+    return record
+
+def instrument_session(session, service, matcher, retry_statuses=()):
+    """Record requests made with a requests.Session if metrics are enabled.
+
+    :param session: the session used by a source client.
+    :type session: requests.Session
+    :returns: True if the session was instrumented.
+    :rtype: bool
+    """
+    if recorder is None:
+        return False
+    session.hooks['response'].append(
+            requests_hook(service, matcher, retry_statuses))
+    return True
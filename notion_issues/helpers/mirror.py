@@ -0,0 +1,144 @@
+import json
+import sqlite3
+from pathlib import Path
+from dateutil import parser
+
+from notion_issues.sources import ISO_UTC_FMT
+from notion_issues.logger import Logger
+
+log = Logger('notion_issues.helpers.mirror')
+
+class NotionMirror:
+    """A local SQLite mirror of the pages in Notion databases.
+
+    Pages are stored with their flattened properties and last edited time,
+    keyed by page id and issue key.  The mirror is refreshed incrementally
+    by querying for pages edited since the high-water mark.
+
+    Pages archived outside of the sync are not returned by database queries
+    and will remain in the mirror until the file is removed.
+
+    :param path: path to the sqlite database file.
+    :type path: str or pathlib.Path
+    """
+
+    schema = [
+        """CREATE TABLE IF NOT EXISTS pages (
+                page_id TEXT PRIMARY KEY,
+                database_id TEXT NOT NULL,
+                issue_key TEXT,
+                last_edited TEXT NOT NULL,
+                page TEXT NOT NULL)""",
+        """CREATE INDEX IF NOT EXISTS pages_issue_key
+                ON pages (database_id, issue_key)""",
+        ]
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.db = sqlite3.connect(self.path)
+        for statement in self.schema:
+            self.db.execute(statement)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def normalize_date(self, date):
+        # notion timestamps include milliseconds, store them in the same
+        # format as the issue dicts so they compare as strings.
+        return date.strftime(ISO_UTC_FMT)
+
+    def high_water_mark(self, database_id):
+        """Get the latest last edited time in the mirror for a database.
+
+        :param database_id: notion database id
+        :type database_id: str
+        :returns: last edited time (YYYY-mm-ddTHH:MM:SSZ) or None
+        :rtype: str
+        """
+        row = self.db.execute(
+                "SELECT MAX(last_edited) FROM pages WHERE database_id = ?",
+                (database_id, )).fetchone()
+        return row[0]
+
+    def store_pages(self, database_id, pages, issue_key_property="Issue Key"):
+        """Store pages with flattened properties in the mirror.
+
+        :param database_id: notion database id
+        :type database_id: str
+        :param pages: pages with flattened properties
+        :type pages: list
+        """
+        rows = []
+        for page in pages:
+            last_edited = parser.isoparse(page['last_edited_time'])
+            record = {
+                    'id': page['id'],
+                    'last_edited_time': page['last_edited_time'],
+                    'properties': page['properties'],
+                    }
+            rows.append((page['id'], database_id,
+                         page['properties'].get(issue_key_property),
+                         self.normalize_date(last_edited),
+                         json.dumps(record)))
+        with self.db:
+            self.db.executemany(
+                    "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)",
+                    rows)
+        log.debug(f"{database_id}: stored {len(rows)} pages in mirror.")
+
+    def remove_page(self, page_id):
+        with self.db:
+            self.db.execute("DELETE FROM pages WHERE page_id = ?", (page_id, ))
+
+    def page(self, page_id):
+        """Get a page from the mirror by id.
+
+        :returns: page with flattened properties or None
+        :rtype: dict
+        """
+        row = self.db.execute(
+                "SELECT page FROM pages WHERE page_id = ?",
+                (page_id, )).fetchone()
+        if row:
+            return json.loads(row[0])
+        return None
+
+    def page_for_key(self, database_id, key):
+        """Get a page from the mirror by issue key.
+
+        :returns: page with flattened properties or None
+        :rtype: dict
+        """
+        row = self.db.execute(
+                "SELECT page FROM pages WHERE database_id = ? "
+                "AND issue_key = ?", (database_id, key)).fetchone()
+        if row:
+            return json.loads(row[0])
+        return None
+
+    def pages(self, database_id, issue_key_filter="", since=""):
+        """Get pages from the mirror.
+
+        :param database_id: notion database id
+        :type database_id: str
+        :param issue_key_filter: only pages with keys starting with filter.
+        :type issue_key_filter: str
+        :param since: only pages edited after (YYYY-mm-ddTHH:MM:SSZ).
+        :type since: str
+        :returns: pages with flattened properties.
+        :rtype: list
+        """
+        query = "SELECT page FROM pages WHERE database_id = ?"
+        params = [database_id]
+        if issue_key_filter:
+            query = f"{query} AND substr(issue_key, 1, ?) = ?"
+            params.extend([len(issue_key_filter), issue_key_filter])
+        if since:
+            query = f"{query} AND last_edited > ?"
+            params.append(since)
+        return [json.loads(row[0])
+                for row in self.db.execute(query, params)]
+
+    def __str__(self):
+        return f"NotionMirror({self.path})"
@@ -38,54 +38,287 @@ class PropertyFetcher:
         await self._fetch_properties(page_id, properties)
         return await self.notion.flatten_property_values(self.properties)
 
+def _join_plain_text(_type):
+    def decode(property_info):
+        return " ".join([i['plain_text'] for i in property_info[_type]])
+    return decode
+
+def _decode_multi_select(property_info):
+    return [i['name'] for i in property_info['multi_select']]
+
+def _decode_select(property_info):
+    if property_info.get('select'):
+        return property_info['select']['name']
+    return ""
+
+def _decode_date(property_info):
+    if property_info.get('date'):
+        return property_info['date']['start']
+    return ""
+
+def _decode_url(property_info):
+    return property_info['url']
+
+class DatabaseSchema:
+    """The properties of a database: names, ids, types and select options.
+
+    A decoder is compiled for each property from its type when the schema
+    is built, so decoding a page calls the property's decoder directly
+    instead of dispatching on the type of every value.
+
+    :param database_id: notion database id.
+    :type database_id: str
+    :param properties: property names to their id, type and option names.
+    :type properties: dict
+    """
+
+    decoders = {
+            'title': _join_plain_text('title'),
+            'rich_text': _join_plain_text('rich_text'),
+            'multi_select': _decode_multi_select,
+            'select': _decode_select,
+            'date': _decode_date,
+            'url': _decode_url,
+        }
+
+    # types Notion truncates in page objects, see AioNotion.
+    truncated_types = ('title', 'rich_text')
+
+    def __init__(self, database_id, properties):
+        self.database_id = database_id
+        self.properties = properties
+        self.decoder = {}
+        self.truncatable = {}
+        for name, prop in properties.items():
+            _type = prop['type']
+            self.decoder[name] = self.decoders.get(
+                    _type, lambda property_info, _type=_type:
+                                property_info.get(_type))
+            if _type in self.truncated_types:
+                self.truncatable[name] = _type
+
+    @classmethod
+    def from_database(cls, database):
+        """Build the schema from a get_database response."""
+        properties = {}
+        for name, prop in database['properties'].items():
+            _type = prop['type']
+            options = (prop.get(_type) or {}).get('options', [])
+            properties[name] = {
+                    'id': prop['id'],
+                    'type': _type,
+                    'options': [option['name'] for option in options],
+                }
+        return cls(database['id'], properties)
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['database_id'], data['properties'])
+
+    def to_json(self):
+        return {'database_id': self.database_id,
+                'properties': self.properties}
+
+    def decode(self, notion, properties):
+        """Flatten the property values in a page object.
+
+        :param notion: instance of the AioNotion client, decodes properties
+                       added since the schema was fetched.
+        :type notion: notion_issues.services.aionotion.AioNotion
+        :param properties: properties from the page object.
+        :type properties: dict
+        :returns: property values, and the truncated properties.
+        :rtype: tuple
+        """
+        values = {}
+        truncated = {}
+        limit = notion.page_property_item_limit
+        for name, property_info in properties.items():
+            decode = self.decoder.get(name)
+            if decode is None:
+                values[name] = notion.property_value(property_info)
+                if notion.property_truncated(property_info):
+                    truncated[name] = property_info
+                continue
+            values[name] = decode(property_info)
+            _type = self.truncatable.get(name)
+            if _type and len(property_info.get(_type) or []) >= limit:
+                truncated[name] = property_info
+        return values, truncated
+
+class NotionPage(dict):
+    """A page object whose comments and truncated properties load on demand.
+
+    Property values are decoded from the page object when it is built.
+    Values Notion truncated in the page object hold the items included, and
+    are listed in ``truncated`` until they are loaded with
+    ``load_properties`` or ``property``.  Comments are fetched the first time
+    ``comments`` is awaited.  Loaded values are kept on the page.
+
+    :param notion: instance of the AioNotion client.
+    :type notion: notion_issues.services.aionotion.AioNotion
+    :param page: page object from a query or get_page.
+    :type page: dict
+    :param schema: the database schema, decodes properties without checking
+                   their types.
+    :type schema: DatabaseSchema
+    """
+
+    def __init__(self, notion, page, schema=None):
+        super().__init__(page)
+        self.notion = notion
+        if schema:
+            properties, self.truncated = schema.decode(
+                    notion, page['properties'])
+        else:
+            self.truncated = {}
+            properties = {}
+            for name, property_info in page['properties'].items():
+                properties[name] = notion.property_value(property_info)
+                if notion.property_truncated(property_info):
+                    self.truncated[name] = property_info
+        self['properties'] = properties
+
+    async def load_properties(self, names=None):
+        """Fetch the full values of truncated properties.
+
+        :param names: properties to load. Default: all truncated properties.
+        :type names: list
+        :returns: property names and flattened values.
+        :rtype: dict
+        """
+        pending = {name: property_info
+                   for name, property_info in self.truncated.items()
+                   if names is None or name in names}
+        if pending:
+            log.debug(f"{self['id']}: fetching truncated {list(pending)}")
+            property_fetcher = PropertyFetcher(self.notion)
+            self['properties'].update(await property_fetcher.fetch_properties(
+                    self['id'], pending))
+            for name in pending:
+                del self.truncated[name]
+        return self['properties']
+
+    async def property(self, name):
+        """Get a property value, fetching it if it was truncated."""
+        await self.load_properties([name])
+        return self['properties'][name]
+
+    async def comments(self):
+        """Get the page comments, fetching them on first use."""
+        if 'comments' not in self:
+            self['comments'] = await self.notion.get_comments(self['id'])
+        return self['comments']
+
 class DatabaseFetcher:
     """Fetch all pages matching a query from a database.
 
-    Fetches properties, pages, and comments concurrently.
+    Fetches pages and comments concurrently. Property values are decoded
+    from the query results, only truncated values are fetched separately.
+    Pages are yielded as NotionPage objects, so anything not loaded up
+    front can still be loaded later.
+
+    Pages are decoded while the query is still paginating, and the queues
+    between the query, the decoders and the consumer are bounded, so a slow
+    consumer holds back the query instead of the pages piling up in memory.
 
     :param notion: instance of the AioNotion client.
     :type notion: notion_issues.services.aionotion.AioNotion
+    :param schema: the database schema, if known.
+    :type schema: DatabaseSchema
     """
 
-    def __init__(self, notion):
+    # pages decoded concurrently.
+    concurrency = 10
+
+    # pages waiting to be decoded, and decoded pages waiting to be consumed.
+    queue_size = 100
+
+    def __init__(self, notion, schema=None):
         self.notion = notion
+        self.schema = schema
         self.pages = []
 
-    async def _consume_queue(self, q):
+    async def _decode_page(self, page, comments, properties=None):
+        log.debug(f"{page['id']}: decode properties")
+        page = NotionPage(self.notion, page, self.schema)
+        await page.load_properties(properties)
+        if comments:
+            await page.comments()
+        return page
+
+    async def _consume_queue(self, pending, decoded, comments,
+                             properties=None):
         try:
             while True:
-                page, comments = await q.get()
+                page = await pending.get()
                 if not page:
-                    return
-                log.debug(f"{page['id']}: call property fetcher")
-                property_fetcher = PropertyFetcher(self.notion)
-                properties = await property_fetcher.fetch_properties(
-                        page['id'], page['properties'])
-                page['properties'] = properties
-                if comments:
-                    page['comments'] = await self.notion.get_comments(page['id'])
-                self.pages.append(page)
+                    break
+                await decoded.put(
+                        await self._decode_page(page, comments, properties))
         except Exception as e:
             log.error(f"_consume_queue failed: {e}", exc_info=True)
+            await decoded.put(e)
+        await decoded.put(None)
 
-    async def _fetch_database(self, database_id, _filter, comments):
-        q = asyncio.Queue()
-        concurrency = 10
-
-        pages = await self.notion.database_query(database_id, _filter)
-        log.debug(f"pages: {pages}")
-        if not pages['results']:
-            log.info(f"{pformat(pages)} entries in DB")
-        async for page in pages['results']:
-            log.debug(f'putting page {page} on queue.')
-            await q.put((page, comments))
-        for _ in range(0, concurrency):
-            await q.put((None, None))
+    async def _produce_pages(self, pending, decoded, database_id, _filter):
+        try:
+            # results are read once, front to back, all of them.
+            pages = await self.notion.database_query(
+                    database_id, _filter, window=1, prefetch=True)
+            async for page in pages['results']:
+                await pending.put(page)
+        except Exception as e:
+            log.error(f"query {database_id} failed: {e}", exc_info=True)
+            await decoded.put(e)
+        for _ in range(0, self.concurrency):
+            await pending.put(None)
 
-        executors = [self._consume_queue(q) for _ in range(0, concurrency)]
-        await asyncio.gather(*executors)
+    async def stream(self, database_id, _filter, comments=False,
+                     properties=None):
+        """Yield matching pages as they are decoded.
+
+        Pages are yielded in the order they finish decoding, not query
+        order.
+
+        :param database_id: notion database id
+        :type database_id: str
+        :param filter: notion database filter (see https://developers.notion.com/reference/post-database-query-filter)
+        :type filter: dict
+        :param comments: fetch comments for all pages?
+        :type comments: bool
+        :param properties: truncated properties to load before yielding.
+                           Default: all of them.
+        :type properties: list
+        :raises: the first error raised by the query or a decoder.
+        :returns: async generator of pages with properties and comments in
+                  line.
+        """
+        pending = asyncio.Queue(self.queue_size)
+        decoded = asyncio.Queue(self.queue_size)
+        tasks = [asyncio.create_task(self._produce_pages(
+                        pending, decoded, database_id, _filter))]
+        tasks.extend(asyncio.create_task(
+                        self._consume_queue(
+                            pending, decoded, comments, properties))
+                     for _ in range(0, self.concurrency))
+        try:
+            running = self.concurrency
+            while running:
+                page = await decoded.get()
+                if page is None:
+                    running -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield page
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
-    async def fetch_database(self, database_id, _filter, comments=False):
+    async def fetch_database(self, database_id, _filter, comments=False,
+                             properties=None):
         """Fetch all matching pages, properties, and comments for a database.
         :param database_id: notion database id
         :type database_id: str
@@ -93,9 +326,11 @@ class DatabaseFetcher:
         :type filter: dict
         :param comments: fetch comments for all pages?
         :type comments: bool
+        :param properties: truncated properties to load. Default: all.
+        :type properties: list
         :returns: database contents with properties and comments in line.
         :rtype: dict
         """
-
-        await self._fetch_database(database_id, _filter, comments)
+        self.pages = [page async for page in
+                      self.stream(database_id, _filter, comments, properties)]
         return self.pages
@@ -0,0 +1,153 @@
+import time
+import random
+import asyncio
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from notion_issues.logger import Logger
+
+log = Logger('notion_issues.helpers.ratelimit')
+
+def parse_retry_after(value, default=None):
+    """Parse a Retry-After header into seconds.
+
+    :param value: header value, seconds or an HTTP date.
+    :type value: str or None
+    :param default: returned if the value is missing or malformed.
+    :type default: float
+    :returns: seconds to wait.
+    :rtype: float
+    """
+    if value is None:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+        return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return default
+
+def backoff_with_jitter(attempt, base=0.5, cap=30):
+    """Exponential backoff with jitter.
+
+    Half of the delay is fixed and half random, so clients that failed
+    together don't retry together.
+
+    :param attempt: the number of failed attempts so far.
+    :type attempt: int
+    :returns: seconds to sleep before the next attempt.
+    :rtype: float
+    """
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class AdaptiveRateLimiter:
+    """A token bucket whose rate adapts to throttling, AIMD style.
+
+    Each successful request adds ``increase`` requests per second to the
+    rate, spread over a second's worth of requests.  A throttled request
+    multiplies the rate by ``decrease`` and pauses all requests for the
+    Retry-After time.  The rate a throttle happened at is remembered, and
+    increases slow down near it, so the rate settles just under the limit
+    rather than repeatedly overshooting it.
+
+    :param rate: starting requests per second.
+    :type rate: float
+    :param burst: most tokens that can accumulate.
+    :type burst: int
+    :param minimum: lowest rate.
+    :type minimum: float
+    :param maximum: highest rate. Default: twice the starting rate.
+    :type maximum: float
+    :param increase: requests per second added per second of success.
+    :type increase: float
+    :param decrease: rate multiplier after a throttle.
+    :type decrease: float
+    """
+
+    # fraction of the last throttled rate where increases slow down.
+    ceiling_margin = 0.9
+
+    # increases near the ceiling are divided by this.
+    ceiling_damping = 10
+
+    def __init__(self, rate=3, burst=10, minimum=0.5, maximum=None,
+                 increase=0.1, decrease=0.7):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.minimum = min(minimum, self.rate)
+        self.maximum = max(maximum or self.rate * 2, self.rate)
+        self.increase = increase
+        self.decrease = decrease
+        self.ceiling = None
+        self._tokens = float(self.burst)
+        self._filled = time.monotonic()
+        self._paused_until = 0
+        self._last_decrease = 0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        if now <= self._filled:
+            return
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._filled) * self.rate)
+        self._filled = now
+
+    async def acquire(self):
+        """Wait for a token.
+
+        Waiters are served in order, and nobody gets a token while a
+        Retry-After pause is in effect.
+        """
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def succeeded(self):
+        """Additively increase the rate after a successful request."""
+        increase = self.increase / self.rate
+        if self.ceiling and self.rate >= self.ceiling * self.ceiling_margin:
+            increase /= self.ceiling_damping
+        self._set_rate(min(self.maximum, self.rate + increase))
+
+    def throttled(self, retry_after=None):
+        """Decrease the rate and pause after a throttled request.
+
+        Requests already in flight when the limit was hit are usually
+        throttled too, so the rate is only decreased once per pause.
+
+        :param retry_after: seconds the server asked us to wait.
+        :type retry_after: float or None
+        """
+        now = time.monotonic()
+        if retry_after:
+            self._paused_until = max(self._paused_until, now + retry_after)
+        self._tokens = 0
+        self._filled = max(now, self._paused_until)
+        if now - self._last_decrease < max(retry_after or 0, 1 / self.rate):
+            return
+        self._last_decrease = now
+        self.ceiling = self.rate
+        self._set_rate(max(self.minimum, self.rate * self.decrease))
+        log.info(f"throttled at {self.ceiling:.2f} req/s, "
+                 f"now {self.rate:.2f} req/s, "
+                 f"retry after {retry_after or 0:.1f}s.")
+
+    def _set_rate(self, rate):
+        self._refill(time.monotonic())
+        self.rate = rate
+
+    def __str__(self):
+        return (f"AdaptiveRateLimiter({self.rate:.2f} req/s, "
+                f"burst={self.burst}, {self.minimum}-{self.maximum})")
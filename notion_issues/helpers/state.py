@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import tempfile
+from pathlib import Path
+from dateutil import parser
+from datetime import datetime, timedelta, timezone
+
+from notion_issues.logger import Logger
+
+log = Logger('notion_issues.helpers.state')
+
+def atomic_write_text(path, text, mode=None):
+    """Write text to a file atomically.
+
+    The text is written to a temporary file in the same directory and moved
+    into place so readers never see a partial file.
+
+    :param path: path to write to.
+    :type path: str or pathlib.Path
+    :param text: file contents.
+    :type text: str
+    :param mode: file permissions, temporary files are only readable by the
+                 owner by default.
+    :type mode: int
+    """
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+def atomic_write_json(path, data):
+    """Write data to a json file atomically.
+
+    :param path: path to write to.
+    :type path: str or pathlib.Path
+    :param data: json serializable data.
+    :type data: dict or list
+    """
+    atomic_write_text(path, json.dumps(data, indent=2, sort_keys=True))
+
+class SyncWatermarks:
+    """Persist the start time of the last successful run of each sync job.
+
+    Jobs are identified by source, repo or project, and Notion database.
+    The next run of a job syncs issues changed since its watermark, less an
+    overlap to absorb clock skew between this host and the services.
+
+    :param path: path to the watermark json file.
+    :type path: str or pathlib.Path
+    :param overlap: seconds to subtract from the watermark. Default 300.
+    :type overlap: int
+    """
+
+    def __init__(self, path, overlap=300):
+        self.path = Path(path)
+        self.overlap = timedelta(seconds=overlap)
+
+    @staticmethod
+    def job_key(source, target, database):
+        return f"{source}:{target}:{database}"
+
+    def _load(self):
+        if not self.path.exists():
+            return {}
+        with self.path.open('r') as f:
+            return json.load(f)
+
+    def since(self, job, default=None):
+        """Get the time to sync a job from.
+
+        :param job: job key.
+        :type job: str
+        :param default: returned if the job has never completed.
+        :type default: datetime.datetime
+        :returns: last start time less the overlap, or default.
+        :rtype: datetime.datetime
+        """
+        watermark = self._load().get(job)
+        if not watermark:
+            log.info(f"{job}: no watermark, syncing from {default}.")
+            return default
+        since = parser.isoparse(watermark) - self.overlap
+        since = min(since, datetime.now(timezone.utc))
+        log.info(f"{job}: syncing from watermark {since}.")
+        return since
+
+    def record(self, job, started):
+        """Record the start time of a successful run for a job.
+
+        The watermark never moves backwards.
+
+        :param job: job key.
+        :type job: str
+        :param started: time the run started.
+        :type started: datetime.datetime
+        """
+        watermarks = self._load()
+        current = watermarks.get(job)
+        if current and parser.isoparse(current) >= started:
+            return
+        watermarks[job] = started.isoformat()
+        atomic_write_json(self.path, watermarks)
+        log.debug(f"{job}: recorded watermark {started}.")
+
+class DatabaseMetadataCache:
+    """Cache Notion database ids and schemas, on disk if given a path.
+
+    Entries are keyed by database name and hold the database id and its
+    schema.  An entry older than the ttl is stale: its id can still be used,
+    but the schema should be checked against the database again.
+
+    :param path: path to the cache json file, None to cache in memory only.
+    :type path: str or pathlib.Path
+    :param ttl: seconds an entry is fresh for. Default 3600.
+    :type ttl: int
+    """
+
+    def __init__(self, path=None, ttl=3600):
+        self.path = Path(path) if path else None
+        self.ttl = ttl
+        self._entries = None
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = {}
+            if self.path and self.path.exists():
+                try:
+                    with self.path.open('r') as f:
+                        self._entries = json.load(f)
+                except ValueError as e:
+                    log.warning(f"{self.path}: ignoring bad cache: {e}")
+        return self._entries
+
+    def get(self, name):
+        """Get the cache entry for a database.
+
+        :param name: notion database name.
+        :type name: str
+        :returns: entry with the ``id``, ``schema`` and ``fetched`` time,
+                  or None.
+        :rtype: dict
+        """
+        return self._load().get(name)
+
+    def fresh(self, entry):
+        return bool(entry) and time.time() - entry['fetched'] < self.ttl
+
+    def put(self, name, database_id, schema):
+        """Store the id and schema of a database.
+
+        :param schema: json serializable schema.
+        :type schema: dict
+        """
+        entries = self._load()
+        entries[name] = {'id': database_id, 'schema': schema,
+                         'fetched': time.time()}
+        if self.path:
+            atomic_write_json(self.path, entries)
+        log.debug(f"{name}: cached database metadata.")
+
+    def remove(self, name):
+        entries = self._load()
+        if entries.pop(name, None) and self.path:
+            atomic_write_json(self.path, entries)
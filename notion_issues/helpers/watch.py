@@ -0,0 +1,97 @@
+import signal
+import asyncio
+
+from notion_issues.logger import Logger
+
+log = Logger('notion_issues.helpers.watch')
+
+class AdaptiveInterval:
+    """A polling interval that adapts to how often changes are found.
+
+    The interval halves after a cycle that found changes and doubles after
+    one that didn't, within the minimum and maximum.
+
+    :param minimum: shortest interval in seconds.
+    :type minimum: int or float
+    :param maximum: longest interval in seconds.
+    :type maximum: int or float
+    """
+
+    def __init__(self, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.interval = minimum
+
+    def update(self, changes):
+        """Update the interval after a cycle.
+
+        :param changes: number of changes made in the cycle.
+        :type changes: int
+        :returns: seconds to wait before the next cycle.
+        :rtype: float
+        """
+        if changes:
+            self.interval = max(self.minimum, self.interval / 2)
+        else:
+            self.interval = min(self.maximum, self.interval * 2)
+        return self.interval
+
+class Watcher:
+    """Run a coroutine repeatedly until SIGTERM or SIGINT is received.
+
+    The current cycle is allowed to finish before stopping.
+
+    :param cycle: async callable that runs one cycle and returns the number
+                  of changes it made.
+    :type cycle: callable
+    :param interval: the polling interval.
+    :type interval: AdaptiveInterval
+    """
+
+    signals = [signal.SIGTERM, signal.SIGINT]
+
+    def __init__(self, cycle, interval):
+        self.cycle = cycle
+        self.interval = interval
+        self.stopping = asyncio.Event()
+
+    def stop(self):
+        log.info("stop requested, finishing cycle.")
+        self.stopping.set()
+
+    def _add_signal_handlers(self):
+        loop = asyncio.get_running_loop()
+        for sig in self.signals:
+            loop.add_signal_handler(sig, self.stop)
+
+    def _remove_signal_handlers(self):
+        loop = asyncio.get_running_loop()
+        for sig in self.signals:
+            loop.remove_signal_handler(sig)
+
+    async def wait(self):
+        """Wait for SIGTERM or SIGINT without running cycles."""
+        self._add_signal_handlers()
+        try:
+            await self.stopping.wait()
+        finally:
+            self._remove_signal_handlers()
+
+    async def run(self):
+        self._add_signal_handlers()
+        try:
+            while not self.stopping.is_set():
+                changes = 0
+                try:
+                    changes = await self.cycle()
+                except Exception as e:
+                    log.error(f"watch cycle failed: {e}", exc_info=True)
+                wait = self.interval.update(changes)
+                log.info(f"{changes} changes, next cycle in {wait:.0f}s.")
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._remove_signal_handlers()
+        log.info("watch stopped.")
@@ -0,0 +1,149 @@
+import hmac
+import json
+import asyncio
+from aiohttp import web
+
+from notion_issues.logger import Logger
+
+log = Logger('notion_issues.helpers.webhook')
+
+class WebhookReceiver:
+    """Receive issue change webhooks and sync the changed issues.
+
+    Accepts Github ``issues``, Jira ``jira:issue_updated``, and Bitbucket
+    ``issue:updated`` payloads on ``POST /webhook``.  Each payload is matched
+    to a source and its issue key is queued for a single issue sync.  Keys
+    already waiting in the queue are not queued again.  Writes share the
+    syncer's key locks, so they never overlap a cycle's writes to the same
+    issue.
+
+    :param syncer: the syncer to sync issues with.
+    :type syncer: notion_issues.IssueSync
+    :param notion_source: the notion source to sync with.
+    :type notion_source: notion_issues.sources.notion.NotionSource
+    :param sources: the sources to accept payloads for.
+    :type sources: list
+    :param secret: shared secret for payload signatures. When set, payloads
+                   without a valid signature are rejected.
+    :type secret: str
+    :param queue_size: maximum issues waiting to sync. Default 100.
+    :type queue_size: int
+    :param workers: concurrent issue syncs. Default 2.
+    :type workers: int
+    """
+
+    path = '/webhook'
+
+    # github uses the first, bitbucket and jira cloud the second.
+    signature_headers = ['X-Hub-Signature-256', 'X-Hub-Signature']
+    signature_algorithms = ['sha256', 'sha1']
+    event_headers = ['X-GitHub-Event', 'X-Event-Key']
+
+    def __init__(self, syncer, notion_source, sources, secret=None,
+                 queue_size=100, workers=2):
+        self.syncer = syncer
+        self.notion_source = notion_source
+        self.sources = sources
+        self.secret = secret
+        self.queue = asyncio.Queue(queue_size)
+        self.workers = workers
+        self.pending = set()
+        self._runner = None
+        self._tasks = []
+        if not secret:
+            log.warning("no webhook secret, payloads will not be verified.")
+
+    def verify(self, body, headers):
+        """Check a payload's HMAC signature against the secret.
+
+        The signature is ``<algorithm>=<hex digest>``, github signs with
+        sha256 in X-Hub-Signature-256 and sha1 in X-Hub-Signature.
+
+        :returns: True if the signature is valid or there is no secret.
+        :rtype: bool
+        """
+        if not self.secret:
+            return True
+        for header in self.signature_headers:
+            signature = headers.get(header)
+            if signature:
+                break
+        else:
+            log.debug(f"rejecting webhook without a signature header.")
+            return False
+        algorithm, _, _ = signature.partition('=')
+        if algorithm not in self.signature_algorithms:
+            log.debug(f"rejecting webhook signed with {algorithm}.")
+            return False
+        digest = hmac.new(self.secret.encode(), body, algorithm)
+        expected = f"{algorithm}={digest.hexdigest()}"
+        return hmac.compare_digest(expected, signature)
+
+    def _event(self, headers):
+        for header in self.event_headers:
+            if headers.get(header):
+                return headers[header]
+        return None
+
+    async def handle(self, request):
+        body = await request.read()
+        if not self.verify(body, request.headers):
+            log.warning(f"rejected webhook with a bad signature.")
+            return web.Response(status=401, text="bad signature")
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return web.Response(status=400, text="payload is not json")
+
+        event = self._event(request.headers)
+        for source in self.sources:
+            key = source.webhook_issue_key(event, payload)
+            if key:
+                break
+        else:
+            log.debug(f"ignoring webhook event {event}.")
+            return web.Response(status=200, text="ignored")
+
+        if (source, key) in self.pending:
+            log.debug(f"{key}: already queued.")
+            return web.Response(status=202, text="queued")
+
+        try:
+            self.queue.put_nowait((source, key))
+        except asyncio.QueueFull:
+            log.warning(f"{key}: webhook queue full, rejecting.")
+            return web.Response(status=503, text="queue full")
+
+        self.pending.add((source, key))
+        log.info(f"{key}: queued from {event or 'webhook'}.")
+        return web.Response(status=202, text="queued")
+
+    async def _consume_queue(self):
+        while True:
+            source, key = await self.queue.get()
+            self.pending.discard((source, key))
+            try:
+                await self.syncer.sync_issue(self.notion_source, source, key)
+            except Exception as e:
+                log.error(f"{key}: webhook sync failed: {e}", exc_info=True)
+            finally:
+                self.queue.task_done()
+
+    async def start(self, host, port):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        self._tasks = [asyncio.create_task(self._consume_queue())
+                       for _ in range(0, self.workers)]
+        log.info(f"listening for webhooks on http://{host}:{port}{self.path}")
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
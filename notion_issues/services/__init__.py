@@ -1,95 +1,165 @@
+import asyncio
 import logging
+import itertools
+from bisect import bisect_right
 from pprint import pprint
 
 from notion_issues.logger import Logger
 
 log = Logger('notion_issues.services.paginated_list')
 
-class PaginatedList:
-    """It should act like a list."""
+def _discard_result(task):
+    """Retrieve a prefetch result nobody awaited so it isn't logged."""
+    if not task.cancelled():
+        task.exception()
 
-    def __init__(self, client, method, url, params={}, body={}, last_resp={}):
+class PaginatedList:
+    """It should act like a list.
+
+    Results are fetched a page at a time as they are indexed or iterated.
+    With prefetch, the next page is fetched in the background while a page
+    is being consumed.
+
+    :param window: number of pages of results to keep, None to keep them
+                   all.  Pages wholly before the most recently requested
+                   index are dropped beyond the window, so a forward scan
+                   uses constant memory.  Indexing a dropped result raises
+                   IndexError.
+    :type window: int or None
+    :param prefetch: fetch the next page while the current one is consumed.
+                     Only worth it when every page will be read, a lookup
+                     that stops early wastes the prefetched request.
+    :type prefetch: bool
+    """
+
+    def __init__(self, client, method, url, params={}, body={}, last_resp={},
+                 window=None, prefetch=False):
         self._client = client
         self._method = method.lower()
         self._base_url = url
         self._base_params = params
         self._base_body = body
-        self._last_resp = last_resp
-        self._list = []
-        if self._last_resp:
-            self._list.extend(self._last_resp['results'])
+        self.window = window
+        self.prefetch = prefetch
+        # start index and results of each page held.
+        self._starts = []
+        self._pages = []
+        self._length = 0
+        self._fetched = False
+        self._has_more = False
+        self._next_cursor = None
+        self._prefetch_task = None
+        self._lock = asyncio.Lock()
+        if last_resp:
+            self._add_page(last_resp)
         log.debug(f"{self}")
 
     def __str__(self):
         return (f"PaginatedList({self._client}, {self._method}, {self._base_url}, "
-                f"{self._base_params}, {self._base_body}) [{len(self._list)}]")
-
-    @property
-    def __fetched(self):
-        return bool(self._last_resp)
-
-    async def __has_more(self):
-        if not self._last_resp:
-            await self.__fetch_next()
-        return bool(self._last_resp.get("has_more"))
-
-    def _has_index(self, index):
-        return index < len(self._list)
-
-    @property
-    def __next_cursor(self):
-        return self._last_resp.get('next_cursor')
+                f"{self._base_params}, {self._base_body}) [{self._length}]")
 
-    async def __fetch_next(self):
+    async def _request(self, cursor):
         if self._method == 'get':
             params = self._base_params.copy()
-            if self.__next_cursor:
-                params['start_cursor'] = self.__next_cursor
-            log.debug(f'getting next ({self._method} {self._url}?{params}).')
-            self._last_resp = await self._client._request_manager.request(
+            if cursor:
+                params['start_cursor'] = cursor
+            log.debug(f'getting next ({self._method} {self._base_url}?{params}).')
+            return await self._client._request_manager.request(
                     self._method, self._base_url, params=params)
         elif self._method == 'post':
             body = self._base_body.copy()
-            if self.__next_cursor:
-                body['start_cursor'] = self.__next_cursor
+            if cursor:
+                body['start_cursor'] = cursor
             log.debug(f'posting next ({self._method} {self._base_url} {body}).')
-            self._last_resp = await self._client._request_manager.request(
+            return await self._client._request_manager.request(
                     self._method, self._base_url, json=body)
-        else:
-            raise RuntimeError(
-                    f"{self._method} is not supported by paginated list")
-
-        results = self._last_resp.get('results', [])
+        raise RuntimeError(
+                f"{self._method} is not supported by paginated list")
+
+    def _add_page(self, resp):
+        self._fetched = True
+        self._has_more = bool(resp.get('has_more'))
+        self._next_cursor = resp.get('next_cursor')
+        results = resp.get('results', [])
         if results:
-            self._list.extend(self._last_resp['results'])
-
+            self._starts.append(self._length)
+            self._pages.append(results)
+            self._length += len(results)
+        if self.prefetch and self._has_more and not self._prefetch_task:
+            self._prefetch_task = asyncio.create_task(
+                    self._request(self._next_cursor))
+            self._prefetch_task.add_done_callback(_discard_result)
         return results
 
-    async def __fetch_to(self, index):
-        has_more = await self.__has_more()
-        while has_more and len(self._list) < index:
-            await self.__fetch_next()
-            has_more = await self.__has_more
-        return len(self._list) > index
+    async def _fetch_next(self):
+        if self._prefetch_task:
+            task, self._prefetch_task = self._prefetch_task, None
+            resp = await task
+        else:
+            resp = await self._request(self._next_cursor)
+        return self._add_page(resp)
+
+    def _trim(self, index):
+        """Drop pages before index that are outside the window."""
+        if not self.window:
+            return
+        while len(self._pages) > self.window and \
+                self._starts[1] <= index:
+            del self._starts[0]
+            del self._pages[0]
+
+    async def _fetch_to(self, index):
+        """Fetch pages until index is available.
+
+        :returns: True if the list has an item at index.
+        :rtype: bool
+        """
+        async with self._lock:
+            if not self._fetched:
+                await self._fetch_next()
+            while index >= self._length and self._has_more:
+                await self._fetch_next()
+            self._trim(index)
+        return index < self._length
+
+    def _page_for(self, index):
+        """Get the page holding index and the offset of index in it."""
+        i = bisect_right(self._starts, index) - 1
+        if i < 0:
+            raise IndexError(
+                    f"{self} index {index} is before the page window")
+        return self._pages[i], index - self._starts[i]
+
+    def _item(self, index):
+        page, offset = self._page_for(index)
+        return page[offset]
+
+    async def length(self):
+        """Fetch every page and return the number of results."""
+        await self._fetch_to(float('inf'))
+        return self._length
+
+    async def close(self):
+        """Cancel a prefetch that is no longer needed."""
+        if self._prefetch_task:
+            self._prefetch_task.cancel()
+            self._prefetch_task = None
 
     async def __aiter__(self):
-        if not self.__fetched:
-            await self.__fetch_next()
-        for l in self._list:
-            yield l
-        has_more = await self.__has_more()
-        while has_more:
-            new = await self.__fetch_next()
-            for n in new:
-                yield n
-            has_more = await self.__has_more()
-        return
+        index = 0
+        while await self._fetch_to(index):
+            # hold the page so trimming can't drop it mid-iteration.
+            page, offset = self._page_for(index)
+            for item in itertools.islice(page, offset, None):
+                yield item
+            index += len(page) - offset
 
     async def __getitem__(self, index):
         if isinstance(index, int):
-            fetched_to_index = await self.__fetch_to(index)
-            if fetched_to_index:
-                return self._list[index]
+            if index < 0:
+                index += await self.length()
+            if index >= 0 and await self._fetch_to(index):
+                return self._item(index)
             raise IndexError(f"{self} doesn't have index {index}")
         elif isinstance(index, slice):
             return PaginatedSlice(self, index)
@@ -97,30 +167,39 @@ class PaginatedList:
             raise IndexError(f"cannot get index {index} {type(index)}")
 
 class PaginatedSlice():
+    """An async iterable slice of a PaginatedList.
+
+    Slices with negative bounds or a negative step fetch the whole list
+    first to find its length.
+    """
 
     def __init__(self, paginated_list, _slice):
         self._list = paginated_list
-        self.__start = _slice.start or 0
-        self.__stop = _slice.stop
-        self.__step = _slice.step or 1
-        log.debug(f"new paginated slice {paginated_list}[{slice}]")
+        self._slice = _slice
+        if _slice.step == 0:
+            raise ValueError("slice step cannot be zero")
+        log.debug(f"new paginated slice {paginated_list}[{_slice}]")
+
+    def _needs_length(self):
+        _slice = self._slice
+        return any(v is not None and v < 0
+                   for v in (_slice.start, _slice.stop, _slice.step))
 
     async def __aiter__(self):
-        log.debug('in __aiter__')
-        index = self.__start
-        while not self.__finished(index):
-            if self._list._has_index(index):
+        if self._needs_length():
+            length = await self._list.length()
+            for index in range(*self._slice.indices(length)):
                 yield await self._list[index]
-            elif self._list.__has_more():
-                fetched_to_index = self._list.__fetch_to(index)
-                if fetched_to_index:
-                    yield await self._list[index]
-                else:
-                    return
-            index += self.__step
+            return
 
-    def __finished(self, index):
-        return self.__stop is not None and index >= self.__stop
+        index = self._slice.start or 0
+        step = self._slice.step or 1
+        stop = self._slice.stop
+        while stop is None or index < stop:
+            if not await self._list._fetch_to(index):
+                return
+            yield self._list._item(index)
+            index += step
 
 async def main():
     import os
@@ -139,7 +218,7 @@ async def main():
         pprint(f"some: {item['id']}")
     l2 = await _list[2]
     print(l2['id'])
-    pprint([l['id'] for l in _list._list])
+    pprint([l['id'] async for l in _list])
 
 if __name__ == '__main__':
     import asyncio
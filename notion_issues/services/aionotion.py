@@ -1,12 +1,18 @@
 import os
+import time
 import urllib
 import logging
 import asyncio
+import aiohttp
 import argparse
 from pprint import pformat, pprint
 
-from aio_api_sm import AioApiSessionManager
+from aio_api_sm import AioApiSessionManager, RetriesExceededError
 from notion_issues.services import PaginatedList
+from notion_issues.helpers import metrics
+from notion_issues.helpers.notion import NotionPage
+from notion_issues.helpers.ratelimit import (
+        AdaptiveRateLimiter, backoff_with_jitter, parse_retry_after)
 from notion_issues.logger import Logger
 
 log = Logger('notion_issues.services.aionotion')
@@ -16,7 +22,176 @@ defaults = {
         'notion_database_id': 'unset',
         }
 
+def is_transient_error(error):
+    """Is a request error likely to succeed if the request is repeated?
+
+    :param error: exception raised by a request.
+    :type error: Exception
+    :rtype: bool
+    """
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in NotionSessionManager.retry_statuses
+    return isinstance(error, (aiohttp.ClientConnectionError,
+                              aiohttp.ClientPayloadError,
+                              asyncio.TimeoutError))
+
+class NotionSessionManager(AioApiSessionManager):
+    """An AioApiSessionManager with an adaptive rate limit.
+
+    The fixed token bucket of the base manager is replaced by an
+    AdaptiveRateLimiter.  429 and 503 responses slow the limiter down and
+    pause requests for the Retry-After time.
+
+    Idempotent requests are retried with backoff and jitter after throttles,
+    5XX responses, timeouts and connection errors.  Creates are only retried
+    after a 429, which Notion rejects before doing any work; other failures
+    are raised so the caller can check whether the page was created.
+
+    When metrics are enabled each attempt is timed with an aiohttp trace,
+    time waiting for a token is counted as throttled, and throttled
+    attempts are counted as retries.
+
+    :param endpoints: maps request paths to endpoint names.
+    :type endpoints: notion_issues.helpers.metrics.EndpointMatcher
+    :param limiter: the rate limiter shared by all requests.
+    :type limiter: notion_issues.helpers.ratelimit.AdaptiveRateLimiter
+    """
+
+    service = 'notion'
+
+    throttle_statuses = [429, 503]
+
+    retry_statuses = [429, 500, 502, 503, 504]
+
+    # POST endpoints that only read.
+    idempotent_posts = ['search', 'database.query']
+
+    # seconds to pause after a throttle without a Retry-After.
+    default_retry_after_delay = 1
+
+    # the limiter replaces the base manager's token task.
+    _rate_manager = None
+
+    def __init__(self, api_base, endpoints, limiter, **kwargs):
+        self.endpoints = endpoints
+        self.limiter = limiter
+        if metrics.recorder is not None:
+            kwargs['trace_configs'] = [self._trace_config()]
+        kwargs.setdefault('backoff', backoff_with_jitter)
+        super().__init__(api_base, rate_limit=0, **kwargs)
+
+    def idempotent(self, method, path):
+        """Can the request be repeated without changing the outcome?"""
+        if method.lower() != 'post':
+            return True
+        return self.endpoints.match(path) in self.idempotent_posts
+
+    def _trace_config(self):
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_request_end.append(self._on_request_end)
+        trace_config.on_request_exception.append(self._on_request_exception)
+        return trace_config
+
+    async def _on_request_start(self, session, context, params):
+        context.start = time.monotonic()
+
+    def _record(self, context, params, status):
+        if metrics.recorder is None:
+            return
+        metrics.recorder.record_request(
+                self.service, self.endpoints.match(params.url.path),
+                params.method, status, time.monotonic() - context.start)
+
+    async def _on_request_end(self, session, context, params):
+        self._record(context, params, params.response.status)
+
+    async def _on_request_exception(self, session, context, params):
+        self._record(context, params, 'error')
+
+    async def _get_token(self):
+        if metrics.recorder is None:
+            return await self.limiter.acquire()
+        start = time.monotonic()
+        await self.limiter.acquire()
+        metrics.recorder.record_throttle(
+                self.service, time.monotonic() - start)
+
+    def _throttled(self, method, path, resp):
+        retry_after = parse_retry_after(
+                resp.headers.get('Retry-After'),
+                self.default_retry_after_delay)
+        self.limiter.throttled(retry_after)
+        log.warning(f"{method} {path}: {resp.status}, "
+                    f"retry after {retry_after:.1f}s.")
+
+    def _record_retry(self, path):
+        if metrics.recorder is not None:
+            metrics.recorder.record_retry(
+                    self.service, self.endpoints.match(path))
+
+    async def request(self, method, path, *args, **kwargs):
+        """Send a rate limited request, retrying when it is safe to.
+
+        :param method: the HTTP method to use (get, post, patch, etc.)
+        :type method: str
+        :param path: the path (/path) of the API endpoint
+        :type path: str
+        :raises: aiohttp.ClientResponseError for error responses,
+                 aiohttp.ClientError or asyncio.TimeoutError if the request
+                 could not be completed,
+                 RetriesExceededError if still throttled after retries.
+        :returns: the response json.
+        :rtype: dict
+        """
+        self._requests += 1
+        idempotent = self.idempotent(method, path)
+        for attempt in range(1, self.retries + 1):
+            await self._get_token()
+            try:
+                async with self.session.request(
+                        method, path, *args, headers=self.headers,
+                        **kwargs) as resp:
+                    if resp.status in self.throttle_statuses:
+                        self._throttled(method, path, resp)
+                        if resp.status == 429 or idempotent:
+                            self._record_retry(path)
+                            continue
+                    resp.raise_for_status()
+                    resp_json = await resp.json(loads=self.json_deserialize)
+            except Exception as e:
+                if not (idempotent and is_transient_error(e)) \
+                        or attempt == self.retries:
+                    raise
+                delay = self.backoff(attempt)
+                log.warning(f"{method} {path}: {e!r}, "
+                            f"retry {attempt} in {delay:.1f}s.")
+                self._record_retry(path)
+                await asyncio.sleep(delay)
+                continue
+            self.limiter.succeeded()
+            return resp_json
+
+        raise RetriesExceededError(
+                f"{method} {path}: still failing after {self.retries} "
+                f"attempts.")
+
 class AioNotion:
+    """An async Notion API client.
+
+    :param token: notion integration token.
+    :type token: str
+    :param rate_limit: starting requests per second, notion allows an
+                       average of 3.  The rate adapts to throttling.
+    :type rate_limit: float
+    :param burst_limit: most requests sent at once after a quiet period.
+    :type burst_limit: int
+    :param api_base: api root, used to point at a fake server.
+    :type api_base: str
+    :param max_rate_limit: highest rate to probe up to.
+                           Default: twice rate_limit.
+    :type max_rate_limit: float
+    """
 
     api_version = '2022-06-28'
     api_base = "https://api.notion.com/"
@@ -30,16 +205,32 @@ class AioNotion:
                 'comments': 'comments'
             }
 
-    limit_per_host = 10 # notion rate limits at 3 requests/second
+    limit_per_host = 10
     ttl_dns_cache = 60
 
-    def __init__(self, token, rate_limit=5, burst_limit=20):
+    # seconds before a request that hasn't completed is retried.
+    request_timeout = 60
+
+    # page objects include at most this many items for array properties,
+    # longer values must be fetched with the page.property endpoint.
+    page_property_item_limit = 25
+    truncated_property_types = ['title', 'rich_text']
+
+    def __init__(self, token, rate_limit=3, burst_limit=10, api_base=None,
+                 max_rate_limit=None):
         self.token = token
         self.properties_queue = asyncio.Queue()
         self.properties_cache = {}
-        self._request_manager = AioApiSessionManager(
-                self.api_base, headers=self.headers,
-                rate_limit=rate_limit, rate_limit_burst=burst_limit)
+        if api_base:
+            self.api_base = api_base
+        self.limiter = AdaptiveRateLimiter(
+                rate_limit, burst_limit, maximum=max_rate_limit)
+        self._request_manager = NotionSessionManager(
+                self.api_base, metrics.EndpointMatcher(self.paths, '/v1/'),
+                self.limiter, headers=self.headers,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.ttl_dns_cache,
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout))
         self.__session = None
 
     @property
@@ -82,7 +273,19 @@ class AioNotion:
 
         return resp_json
 
-    async def database_query(self, database_id, filters={}, sorts=[]):
+    async def database_query(self, database_id, filters={}, sorts=[],
+                             window=None, prefetch=False):
+        """Query a database.
+
+        :param window: pages of results the paginated list keeps, None to
+                       keep them all.  Use 1 for a single forward scan.
+        :type window: int or None
+        :param prefetch: fetch each next page of results in the background,
+                         for scans that read them all.
+        :type prefetch: bool
+        :returns: the first response, with a PaginatedList of all results.
+        :rtype: dict
+        """
         url = self.url('database.query', {'database_id': database_id})
 
         payload = {}
@@ -93,7 +296,8 @@ class AioNotion:
 
         resp_json = await self._request_manager.request('post', url, json=payload)
         resp_json['results'] = PaginatedList(
-                self, "post", url, body=payload, last_resp=resp_json)
+                self, "post", url, body=payload, last_resp=resp_json,
+                window=window, prefetch=prefetch)
         return resp_json
 
     async def add_page_to_database(self, database_id, properties):
@@ -115,9 +319,8 @@ class AioNotion:
 
         resp_json = await self._request_manager.request('get', url)
         if props:
-            pf = PropertyFetcher(self)
-            await pf.fetch_properties(page_id, resp_json['properties'])
-            resp_json['properties'] = pf.properties
+            resp_json['properties'] = await self.page_property_values(
+                    page_id, resp_json['properties'])
         if comments:
             resp_json['comments'] = await self.get_comments(page_id)
 
@@ -185,6 +388,56 @@ class AioNotion:
 
         return _properties
 
+    def property_truncated(self, property_info):
+        """Is the property value in a page object incomplete?
+
+        Notion truncates title and rich_text values in page objects to
+        ``page_property_item_limit`` items.
+        """
+        _type = property_info.get('type')
+        if _type not in self.truncated_property_types:
+            return False
+        items = property_info.get(_type) or []
+        return len(items) >= self.page_property_item_limit
+
+    def property_value(self, property_info):
+        """Flatten a property value from a page object."""
+        _type = property_info.get('type')
+        if _type == 'multi_select':
+            value = [i['name'] for i in property_info['multi_select']]
+        elif _type == 'url':
+            value = property_info['url']
+        elif _type == 'select':
+            value = ""
+            if property_info.get('select'):
+                value = property_info['select']['name']
+        elif _type == 'date':
+            value = ""
+            if property_info.get('date'):
+                value = property_info['date']['start']
+        elif _type in self.truncated_property_types:
+            value = " ".join([i['plain_text'] for i in property_info[_type]])
+        else:
+            value = property_info.get(_type)
+        return value
+
+    async def page_property_values(self, page_id, properties):
+        """Flatten the property values included in a page object.
+
+        Values are decoded from the page object returned by database_query
+        or get_page.  Only truncated title and rich_text values are fetched
+        from the page.property endpoint.
+
+        :param page_id: notion page id
+        :type page_id: str
+        :param properties: properties from the page object.
+        :type properties: dict
+        :returns: property names and flattened values.
+        :rtype: dict
+        """
+        page = NotionPage(self, {'id': page_id, 'properties': properties})
+        return await page.load_properties()
+
 async def test_db_fetch():
     import os
     from pprint import pprint
@@ -192,7 +445,7 @@ async def test_db_fetch():
     from notion_issues.helpers.notion import DatabaseFetcher
 
     now = datetime.now()
-    notion = AioNotion(os.environ.get("NOTION_TOKEN"), rate_limit=5, burst_limit=30)
+    notion = AioNotion(os.environ.get("NOTION_TOKEN"))
     dbid = await notion.database_id_for_name("Issues")
     print(dbid)
     _filter = { "property": "Issue Key",
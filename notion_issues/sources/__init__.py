@@ -1,11 +1,151 @@
+import sys
+import time
+import asyncio
+import hashlib
+import functools
+import threading
 from abc import ABC
 from dateutil import parser
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
 
 ISO_UTC_FMT = "%Y-%m-%dT%H:%M:%SZ"
 ISO_UTC_MIN_FMT = "%Y-%m-%dT%H:%M:00Z"
 
+def iso_to_epoch(value):
+    """Convert a normalized ISO UTC date to epoch seconds, None if empty."""
+    if not value:
+        return None
+    if isinstance(value, int):
+        return value
+    date = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return int(date.timestamp())
+
+def epoch_to_iso(value):
+    """Convert epoch seconds to a normalized ISO UTC date, "" if None."""
+    if value is None:
+        return ""
+    return time.strftime(ISO_UTC_FMT, time.gmtime(value))
+
+class Issue:
+    """An issue as read from a source, the unit the sync engine compares.
+
+    Status, people and labels are interned, so the few distinct values are
+    shared across all issues, and dates are stored as epoch seconds.  The
+    fingerprint covers the fields that are synced, everything but
+    ``ignore_fields``, so two issues are in sync if their fingerprints match.
+
+    Issues can be read like the issue dicts sources used to return, with the
+    dates as normalized ISO strings, e.g. ``issue['updated_on']``.
+
+    :param labels: label names, order matters.
+    :type labels: list
+    :param due_on: normalized ISO date, epoch seconds, or "".
+    :type due_on: str or int
+    """
+
+    __slots__ = ('title', 'status', 'assignee', 'reporter', 'labels',
+                 'due', 'opened', 'updated', 'link', 'fingerprint')
+
+    fields = ['title', 'status', 'assignee', 'reporter', 'labels', 'due_on',
+              'opened_on', 'updated_on', 'link']
+
+    # fields that don't make issues differ.
+    ignore_fields = ['updated_on', 'opened_on', 'reporter', 'link']
+
+    def __init__(self, title, status, assignee, reporter, labels, due_on,
+                 opened_on, updated_on, link):
+        intern = sys.intern
+        self.title = title
+        self.status = intern(status) if status else status
+        self.assignee = intern(assignee) if assignee else assignee
+        self.reporter = intern(reporter) if reporter else reporter
+        self.labels = tuple(intern(l) for l in labels or ())
+        self.due = iso_to_epoch(due_on)
+        self.opened = iso_to_epoch(opened_on)
+        self.updated = iso_to_epoch(updated_on)
+        self.link = link
+        self.fingerprint = self._fingerprint()
+
+    @classmethod
+    def coerce(cls, issue):
+        """Get an Issue for an issue dict, or the issue if it is one."""
+        if issue is None or isinstance(issue, cls):
+            return issue
+        return cls(**{field: issue.get(field) for field in cls.fields})
+
+    def _fingerprint(self):
+        values = [repr(self[field]) for field in self.fields
+                  if field not in self.ignore_fields]
+        return hashlib.blake2b("\x1f".join(values).encode(),
+                               digest_size=16).digest()
+
+    @property
+    def due_on(self):
+        return epoch_to_iso(self.due)
+
+    @property
+    def opened_on(self):
+        return epoch_to_iso(self.opened)
+
+    @property
+    def updated_on(self):
+        return epoch_to_iso(self.updated)
+
+    def __getitem__(self, field):
+        if field not in self.fields:
+            raise KeyError(field)
+        value = getattr(self, field)
+        return list(value) if field == 'labels' else value
+
+    def diff(self, other):
+        """The synced fields whose values differ from another issue.
+
+        :param other: the issue to compare with.
+        :type other: Issue
+        :returns: changed field names, empty if the issues are in sync.
+        :rtype: list
+        """
+        if self.fingerprint == other.fingerprint:
+            return []
+        return [field for field in self.fields
+                if field not in self.ignore_fields
+                and self[field] != other[field]]
+
+    def get(self, field, default=None):
+        try:
+            return self[field]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self.fields)
+
+    def items(self):
+        return [(field, self[field]) for field in self.fields]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return f"Issue({self.to_dict()!r})"
+
 class IssueSource(ABC):
 
+    # maximum concurrent writes to the source during a sync.
+    write_concurrency = 1
+
+    # threads used to run a blocking source off the event loop.
+    thread_pool_size = 4
+
+    # the HTTP cache the source's clients send requests through, if any.
+    http_cache = None
+
+    # with an HTTP cache, polls round since down to this many seconds.
+    cached_since_granularity = 60*60
+
     def __init__(self, *args, **kwargs):
         raise NotImplementedError("Implement in child.")
 
@@ -29,6 +169,41 @@ class IssueSource(ABC):
         """
         raise NotImplementedError('Implement in child.')
 
+    def webhook_issue_key(self, event, payload):
+        """Get the key of the issue a webhook payload is about.
+
+        :param event: the event name from the payload headers, if any.
+        :type event: str
+        :param payload: the webhook payload.
+        :type payload: dict
+        :returns: issue key if the payload is an issue change for this
+                  source, else None.
+        :rtype: str
+        """
+        return None
+
+    def poll_since(self, since):
+        """The since to request issues with, and the epoch to filter by.
+
+        A watermark moves every cycle, so requests built from it never
+        repeat and the HTTP cache can't revalidate them.  With a cache,
+        since is rounded down to ``cached_since_granularity`` so polls send
+        the same request until the next boundary, and issues updated before
+        the real since are filtered out after fetching.
+
+        :param since: sync issues changed since.
+        :type since: datetime.datetime
+        :returns: (since to request, epoch seconds issues must be updated
+                  at or after, or None to keep them all).
+        :rtype: tuple
+        """
+        if not (since and self.http_cache):
+            return since, None
+        epoch = since.timestamp()
+        rounded = since - timedelta(
+                seconds=epoch % self.cached_since_granularity)
+        return rounded, int(epoch)
+
     def normalize_date(self, date, granularity='seconds'):
         if not date:
             return ""
@@ -54,16 +229,159 @@ class IssueSource(ABC):
         """
         raise NotImplementedError("Implement in child.")
 
-    def update_issue(self, issue_key, issues_dict):
+    def iter_issues(self, **kwargs):
+        """Generate issues as they are fetched.
+
+        Sources that page through results override this so a sync can start
+        on the first page, the default fetches them all with get_issues.
+
+        :param kwargs: filter properties for the source.
+        :type kwargs: key=value pairs.
+        :returns: generator of (issue key, issue dict).
+        """
+        yield from self.get_issues(**kwargs).items()
+
+    def update_issue(self, issue_key, issues_dict, fields=None):
         """
         :param issue_key: unique issue key.
         :type issue_key: str
         :param issues_dict: issues dict containing issues to update.
         :type issues_dict: dict
+        :param fields: the fields that changed, only these are written.
+                       Default: all fields.
+        :type fields: list
         """
         raise NotImplementedError("Implement in child.")
 
     def __str__(self):
         raise NotImplementedError("Implement in child.")
 
+class AsyncIssueSource(IssueSource):
+    """An issue source with coroutine methods, safe to use on the loop."""
+
+    async def key_to_id(self, key):
+        raise NotImplementedError('Implement in child.')
+
+    async def get_issue(self, _id):
+        raise NotImplementedError("Implement in child.")
+
+    async def get_issues(self, **kwargs):
+        raise NotImplementedError("Implement in child.")
+
+    async def stream_issues(self, **kwargs):
+        """Yield issues as they are fetched.
+
+        :param kwargs: filter properties for the source.
+        :type kwargs: key=value pairs.
+        :returns: async generator of (issue key, issue dict).
+        """
+        issues = await self.get_issues(**kwargs)
+        for item in issues.items():
+            yield item
+
+    async def update_issue(self, issue_key, issues_dict, fields=None):
+        raise NotImplementedError("Implement in child.")
+
+class ThreadedIssueSource(AsyncIssueSource):
+    """Run a blocking issue source in a thread pool.
+
+    Wraps sources built on synchronous clients so their requests can overlap
+    with Notion I/O instead of blocking the event loop.
+
+    :param source: the blocking issue source.
+    :type source: notion_issues.sources.IssueSource
+    :param max_workers: threads in the pool. Default source.thread_pool_size.
+    :type max_workers: int
+    """
+
+    # issues buffered between the source thread and the event loop.
+    stream_buffer = 100
+
+    def __init__(self, source, max_workers=None):
+        self.source = source
+        self.max_workers = max_workers or source.thread_pool_size
+        self.closed_statuses = source.closed_statuses
+        self.write_concurrency = source.write_concurrency
+        self.executor = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix=source.__class__.__name__)
+
+    async def _run(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+                self.executor, functools.partial(method, *args, **kwargs))
+
+    def id_to_key(self, _id):
+        return self.source.id_to_key(_id)
+
+    def webhook_issue_key(self, event, payload):
+        return self.source.webhook_issue_key(event, payload)
+
+    async def key_to_id(self, key):
+        return self.source.key_to_id(key)
+
+    async def get_issue(self, _id):
+        return Issue.coerce(await self._run(self.source.get_issue, _id))
+
+    async def get_issues(self, **kwargs):
+        issues = await self._run(self.source.get_issues, **kwargs)
+        return {key: Issue.coerce(issue) for key, issue in issues.items()}
+
+    async def stream_issues(self, **kwargs):
+        """Yield issues from the source's iter_issues as the thread fetches.
+
+        The thread blocks when ``stream_buffer`` issues are waiting, so a
+        slow consumer holds back the source's paging.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(self.stream_buffer)
+        stopping = threading.Event()
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def produce():
+            try:
+                for key, issue in self.source.iter_issues(**kwargs):
+                    if stopping.is_set():
+                        break
+                    put((key, Issue.coerce(issue)))
+            except Exception as e:
+                put(e)
+            put(None)
+
+        producer = loop.run_in_executor(self.executor, produce)
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stopping.set()
+            # drain the queue so the producer can't block on a full queue.
+            while not producer.done():
+                while not queue.empty():
+                    queue.get_nowait()
+                await asyncio.sleep(0.01)
+
+    async def update_issue(self, issue_key, issues_dict, fields=None):
+        return await self._run(
+                self.source.update_issue, issue_key, issues_dict, fields)
+
+    async def close(self):
+        self.executor.shutdown(wait=False)
+
+    def __getattr__(self, attr):
+        return getattr(self.source, attr)
+
+    def __str__(self):
+        return str(self.source)
 
+def as_async_source(source):
+    """Get an AsyncIssueSource for source, wrapping it if it blocks."""
+    if isinstance(source, AsyncIssueSource):
+        return source
+    return ThreadedIssueSource(source)
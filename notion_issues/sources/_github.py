@@ -1,25 +1,128 @@
 import os
 import sys
+import time
+import functools
 from pprint import pprint
 from github import Github
+from github.GithubRetry import GithubRetry
+from github.Requester import HTTPSRequestsConnectionClass
 
 from notion_issues import unassigned_user
-from notion_issues.sources import IssueSource, ISO_UTC_FMT
+from notion_issues.sources import IssueSource, Issue, ISO_UTC_FMT
+from notion_issues.helpers import metrics
 from notion_issues.logger import Logger
 
 log = Logger('notion_issues.sources._github')
 
+metric_endpoints = metrics.EndpointMatcher({
+        'repo': 'repos/{owner}/{repo}',
+        'issues': 'repos/{owner}/{repo}/issues',
+        'issue': 'repos/{owner}/{repo}/issues/{number}',
+        'issue.comments': 'repos/{owner}/{repo}/issues/{number}/comments',
+        'graphql': 'graphql',
+    })
+
+# the fields _graphql_to_issue_dict reads, pull requests aren't issues in
+# the graphql schema.
+ISSUES_QUERY = """
+query($owner: String!, $name: String!, $first: Int!, $cursor: String,
+      $since: DateTime, $assignee: String) {
+  repository(owner: $owner, name: $name) {
+    issues(first: $first, after: $cursor,
+           filterBy: {since: $since, assignee: $assignee},
+           orderBy: {field: UPDATED_AT, direction: ASC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number
+        title
+        state
+        url
+        createdAt
+        updatedAt
+        author { login }
+        assignees(first: 1) { nodes { login } }
+        labels(first: 100, orderBy: {field: NAME, direction: ASC}) {
+          nodes { name }
+        }
+        milestone { dueOn }
+      }
+    }
+  }
+}
+"""
+
+class MetricsRetry(GithubRetry):
+    """GithubRetry that records retries and the time slept before them.
+
+    urllib3 retries below the requests session, so its response hooks
+    never see the retried attempts.
+    """
+
+    def increment(self, method=None, url=None, *args, **kwargs):
+        if metrics.recorder is not None:
+            metrics.recorder.record_retry(
+                    'github', metric_endpoints.match(url or ''))
+        return super().increment(method, url, *args, **kwargs)
+
+    def sleep(self, response=None):
+        start = time.monotonic()
+        super().sleep(response)
+        if metrics.recorder is not None:
+            metrics.recorder.record_throttle(
+                    'github', time.monotonic() - start)
+
+class InstrumentedConnection(HTTPSRequestsConnectionClass):
+    """A PyGithub connection whose requests session records metrics and
+    sends conditional requests through the HTTP cache."""
+
+    def __init__(self, *args, http_cache=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        metrics.instrument_session(self.session, 'github', metric_endpoints)
+        if http_cache:
+            http_cache.install(self.session)
+
 class GithubSource(IssueSource):
 
     include_pull_requests = False
 
     closed_statuses = ['closed']
 
-    def __init__(self, github_token, github_repo, use_path=False):
-        self.github = Github(github_token)
+    # issues per graphql query, the most github allows.
+    graphql_page_size = 100
+
+    def __init__(self, github_token, github_repo, use_path=False,
+                 use_graphql=False, http_cache=None):
+        if metrics.recorder is not None:
+            self.github = Github(github_token, retry=MetricsRetry())
+        else:
+            self.github = Github(github_token)
+        if metrics.recorder is not None or http_cache:
+            self._instrument_connections(http_cache)
+        self.http_cache = http_cache
         self.repo_path = github_repo
         self.repo = self.github.get_repo(self.repo_path)
-        self.use_path = False
+        self.use_path = use_path
+        self.use_graphql = use_graphql
+
+    # the private PyGithub attribute holding the https connection class.
+    connection_class_attribute = '_Requester__connectionClass'
+
+    def _instrument_connections(self, http_cache):
+        """Swap in a connection class that instruments its session.
+
+        PyGithub has no request hooks, so this relies on a private
+        attribute.  If a release renames it, metrics and the HTTP cache are
+        skipped with a warning rather than silently doing nothing.
+        """
+        requester = self.github.requester
+        if not hasattr(requester, self.connection_class_attribute):
+            log.warning(f"PyGithub has no {self.connection_class_attribute}, "
+                        f"github requests won't be recorded or cached.")
+            return False
+        setattr(requester, self.connection_class_attribute,
+                functools.partial(InstrumentedConnection,
+                                  http_cache=http_cache))
+        return True
 
     def key_to_id(self, key):
         return int(key.split('#')[-1])
@@ -31,6 +134,16 @@ class GithubSource(IssueSource):
             key = f"{self.repo_path.rsplit('/', 1)[-1]}#{_id}"
         return key
 
+    def webhook_issue_key(self, event, payload):
+        if event != 'issues':
+            return None
+        if payload.get('repository', {}).get('full_name') != self.repo_path:
+            return None
+        issue = payload.get('issue', {})
+        if issue.get('pull_request') and not self.include_pull_requests:
+            return None
+        return self.id_to_key(issue['number'])
+
     def map_unassigned_user(self, user):
         if user == unassigned_user:
             return ""
@@ -49,30 +162,80 @@ class GithubSource(IssueSource):
 
         labels = [l.name for l in issue.labels]
 
-        output = {
-              "title": issue.title,
-              "status": issue.state,
-              "assignee": assignee,
-              "reporter": issue.user.login,
-              "labels": labels,
-              "due_on": self.normalize_date(due_on, granularity='minutes'),
-              "opened_on": self.normalize_date(
+        output = Issue(
+              title=issue.title,
+              status=issue.state,
+              assignee=assignee,
+              reporter=issue.user.login,
+              labels=labels,
+              due_on=self.normalize_date(due_on, granularity='minutes'),
+              opened_on=self.normalize_date(
                     issue.created_at, granularity='minutes'),
-              "updated_on": self.normalize_date(issue.updated_at),
-              "link": issue.html_url
-        }
+              updated_on=self.normalize_date(issue.updated_at),
+              link=issue.html_url)
+
+        return output
+
+    def _graphql_to_issue_dict(self, node):
+        assignees = node['assignees']['nodes']
+        due_on = (node.get('milestone') or {}).get('dueOn') or ""
+
+        output = Issue(
+              title=node['title'],
+              status=node['state'].lower(),
+              assignee=assignees[0]['login'] if assignees else unassigned_user,
+              reporter=(node.get('author') or {}).get('login', 'ghost'),
+              labels=[label['name'] for label in node['labels']['nodes']],
+              due_on=self.normalize_date(due_on, granularity='minutes'),
+              opened_on=self.normalize_date(
+                    node['createdAt'], granularity='minutes'),
+              updated_on=self.normalize_date(node['updatedAt']),
+              link=node['url'])
 
         return output
 
+    def _iter_graphql_issues(self, since=None, assignee=None):
+        """Generate issues with one graphql query per page of issues.
+
+        Only the fields used are selected, and pull requests are never
+        returned.
+        """
+        owner, name = self.repo_path.split('/', 1)
+        variables = {
+                'owner': owner,
+                'name': name,
+                'first': self.graphql_page_size,
+                'cursor': None,
+                'since': self.normalize_date(since) or None,
+                'assignee': assignee,
+            }
+        while True:
+            _, data = self.github.requester.graphql_query(
+                    ISSUES_QUERY, variables)
+            issues = data['data']['repository']['issues']
+            for node in issues['nodes']:
+                key = self.id_to_key(node['number'])
+                yield key, self._graphql_to_issue_dict(node)
+            if not issues['pageInfo']['hasNextPage']:
+                return
+            variables['cursor'] = issues['pageInfo']['endCursor']
+
     def get_issue(self, _id):
         issue = self.repo.get_issue(_id)
         return self._issue_to_issue_dict(issue)
 
     def get_issues(self, since=None, assignee=None):
-        output = {}
+        return dict(self.iter_issues(since, assignee))
+
+    def iter_issues(self, since=None, assignee=None):
+        # graphql returns no pull requests, use rest to include them.
+        if self.use_graphql and not self.include_pull_requests:
+            yield from self._iter_graphql_issues(since, assignee)
+            return
 
         get_issues_args = { 'state': 'all' }
 
+        since, updated_after = self.poll_since(since)
         if since:
             get_issues_args['since'] = since
         if assignee:
@@ -83,18 +246,27 @@ class GithubSource(IssueSource):
                 continue
 
             key = self.id_to_key(issue.number)
+            issue_dict = self._issue_to_issue_dict(issue)
+            if updated_after and (issue_dict.updated or 0) < updated_after:
+                continue
 
-            output[key] = self._issue_to_issue_dict(issue)
-
-        return output
+            yield key, issue_dict
 
-    def update_issue(self, key, issue_dict):
+    def update_issue(self, key, issue_dict, fields=None):
+        changes = {}
+        if fields is None or 'title' in fields:
+            changes['title'] = issue_dict['title']
+        if fields is None or 'status' in fields:
+            changes['state'] = issue_dict['status']
+        if fields is None or 'assignee' in fields:
+            changes['assignee'] = self.map_unassigned_user(
+                    issue_dict['assignee'])
+        if not changes:
+            log.debug(f"{key}: no changes github can store in {fields}.")
+            return
         issue_number = int(key.rsplit("#", 1)[1])
         issue = self.repo.get_issue(issue_number)
-        result = issue.edit(title=issue_dict['title'],
-                            state=issue_dict['status'],
-                            assignee=self.map_unassigned_user(
-                                issue_dict['assignee']))
+        result = issue.edit(**changes)
 
     def __str__(self):
         return f"Github Source: {self.repo_path}"
@@ -2,37 +2,83 @@ import jira
 from jira.exceptions import JIRAError
 
 from notion_issues import unassigned_user
-from notion_issues.sources import IssueSource
+from notion_issues.sources import IssueSource, Issue
+from notion_issues.helpers import metrics
 from notion_issues.logger import Logger
 
 JIRA_TIMEFMT = "%Y-%m-%d %H:%M"
 log = Logger('notion_issues.sources.jira')
 
+metric_endpoints = metrics.EndpointMatcher({
+        'serverInfo': 'rest/api/{version}/serverInfo',
+        'field': 'rest/api/{version}/field',
+        'status': 'rest/api/{version}/status',
+        'search': 'rest/api/{version}/search',
+        'search.jql': 'rest/api/{version}/search/jql',
+        'issue': 'rest/api/{version}/issue/{issue_key}',
+        'issue.transitions': 'rest/api/{version}/issue/{issue_key}/transitions',
+    })
+
 class JiraSource(IssueSource):
 
     closed_statuses = ['closed', 'resolved']
 
-    def __init__(self, jira_token, jira_project, jira_server):
+    # statuses the jira ResilientSession retries
+    retry_statuses = [429, 503]
+
+    webhook_events = ['jira:issue_created', 'jira:issue_updated']
+
+    # the only fields read into issues, searches don't request the rest.
+    search_fields = ['summary', 'status', 'assignee', 'creator', 'priority',
+                     'issuetype', 'duedate', 'created', 'updated']
+
+    # issues per search request.
+    search_page_size = 100
+
+    def __init__(self, jira_token, jira_project, jira_server,
+                 http_cache=None, notify_users=True):
         self.jira = jira.JIRA(options={'server': jira_server},
                          token_auth=jira_token)
+        metrics.instrument_session(self.jira._session, 'jira',
+                                   metric_endpoints, self.retry_statuses)
+        if http_cache:
+            http_cache.install(self.jira._session)
+        self.http_cache = http_cache
+        # jira only lets project admins turn update notifications off.
+        self.notify_users = notify_users
         self.project = jira_project
         self.__status_map = {}
+        self.__status_index = {}
+        # issue key: (issue type, status) as last read or written.
+        self._issue_states = {}
+        # (project, issue type, status): {target status: transition id}
+        self._transitions = {}
+
+    def _load_statuses(self):
+        self.__status_map = { s.name: s.name.lower()
+                              for s in self.jira.statuses() }
+        # notion status to the first jira status that maps to it.
+        self.__status_index = {}
+        for jira_status, notion_status in self.__status_map.items():
+            self.__status_index.setdefault(notion_status, jira_status)
 
     @property
     def _status_map(self):
         if not self.__status_map:
-            self.__status_map = { s.name: s.name.lower()
-                                  for s in self.jira.statuses() }
+            self._load_statuses()
         return self.__status_map
 
+    @property
+    def _status_index(self):
+        if not self.__status_map:
+            self._load_statuses()
+        return self.__status_index
+
     def status_to_notion(self, status):
         return self._status_map.get(status, '')
 
     def status_to_source(self, status):
-        for jira_status, notion_status in self._status_map.items():
-            if status == notion_status:
-                return jira_status
-        return ""
+        return self._status_index.get(status, "")
 
     def id_to_key(self, _id):
         return _id
@@ -40,84 +86,191 @@ class JiraSource(IssueSource):
     def key_to_id(self, key):
         return key
 
+    def webhook_issue_key(self, event, payload):
+        if payload.get('webhookEvent') not in self.webhook_events:
+            return None
+        issue = payload.get('issue', {})
+        project = issue.get('fields', {}).get('project', {}).get('key')
+        if project != self.project:
+            return None
+        return self.id_to_key(issue['key'])
+
     def map_unassigned_user(self, user):
         if user == unassigned_user:
             return None
         return user
 
     def _issue_to_issue_dict(self, issue):
-        if issue.fields.assignee:
-            assignee = issue.fields.assignee.name.lower()
+        return self._json_to_issue_dict(issue.raw)
+
+    def _json_to_issue_dict(self, raw):
+        """Build an issue from the raw json of a search or issue response.
+
+        :param raw: issue json with at least the search_fields.
+        :type raw: dict
+        :returns: the issue.
+        :rtype: notion_issues.sources.Issue
+        """
+        fields = raw['fields']
+        self._issue_states[raw['key']] = (fields['issuetype']['name'],
+                                          fields['status']['name'])
+        if fields.get('assignee'):
+            assignee = fields['assignee']['name'].lower()
         else:
             assignee = unassigned_user
 
-        output = {
-              "title": issue.fields.summary,
-              "status": self.status_to_notion(issue.fields.status.name),
-              "assignee": assignee,
-              "reporter": issue.fields.creator.key,
-              "labels": [issue.fields.priority.name,
-                         issue.fields.issuetype.name],
-              "due_on": self.normalize_date(
-                            issue.fields.duedate, granularity='minutes'),
-              "opened_on": self.normalize_date(
-                            issue.fields.created, granularity='minutes'),
-              "updated_on": self.normalize_date(issue.fields.updated),
-              "link": issue.permalink()
-        }
+        output = Issue(
+              title=fields['summary'],
+              status=self.status_to_notion(fields['status']['name']),
+              assignee=assignee,
+              reporter=(fields.get('creator') or {}).get('key', ''),
+              labels=[(fields.get('priority') or {}).get('name', ''),
+                      fields['issuetype']['name']],
+              due_on=self.normalize_date(
+                            fields.get('duedate'), granularity='minutes'),
+              opened_on=self.normalize_date(
+                            fields['created'], granularity='minutes'),
+              updated_on=self.normalize_date(fields['updated']),
+              link=f"{self.jira.server_url}/browse/{raw['key']}")
 
         return output
 
     def get_issue(self, _id):
-        issue = self.jira.issue(_id)
+        issue = self.jira.issue(_id, fields=",".join(self.search_fields))
         return self._issue_to_issue_dict(issue)
 
+    def _search_pages(self, query):
+        """Generate the raw json of each page of search results.
+
+        Only the search_fields are requested, and results are left as json
+        rather than built into jira Issue resources.
+
+        :param query: JQL query.
+        :type query: str
+        :returns: generator of lists of raw issue json.
+        """
+        if self.jira._is_cloud:
+            token = None
+            while True:
+                resp = self.jira.enhanced_search_issues(
+                        query, nextPageToken=token,
+                        maxResults=self.search_page_size,
+                        fields=list(self.search_fields), json_result=True)
+                yield resp.get('issues', [])
+                token = resp.get('nextPageToken')
+                if not token or resp.get('isLast'):
+                    return
+
+        start = 0
+        while True:
+            resp = self.jira.search_issues(
+                    query, startAt=start, maxResults=self.search_page_size,
+                    fields=list(self.search_fields), json_result=True)
+            issues = resp.get('issues', [])
+            yield issues
+            start += len(issues)
+            if not issues or start >= resp.get('total', 0):
+                return
+
     def get_issues(self, since=None, assignee=None):
-        output = {}
+        return dict(self.iter_issues(since, assignee))
+
+    def iter_issues(self, since=None, assignee=None):
         query = f'project={self.project}'
+        since, updated_after = self.poll_since(since)
         if since:
             since_str = since.strftime(JIRA_TIMEFMT)
             query = f'{query} and (updated > "{since_str}" or created > "{since_str}")'
         if assignee:
             query = f'{query} and assignee = {assignee}'
 
-        for issue in self.jira.search_issues(query):
-            key = self.id_to_key(issue.key)
-            output[key] = self._issue_to_issue_dict(issue)
-        return output
+        for issues in self._search_pages(query):
+            for raw in issues:
+                key = self.id_to_key(raw['key'])
+                issue_dict = self._json_to_issue_dict(raw)
+                if updated_after and (issue_dict.updated or 0) < updated_after:
+                    continue
+                yield key, issue_dict
 
-    def update_issue(self, key, issue_dict):
+    def update_issue(self, key, issue_dict, fields=None):
         """
         Note: jira doesn't care if user names are in the correct case.
+
+        Only the changed fields are sent, and the issue is only transitioned
+        if its status changed, to avoid no-op edits and notifications.
+        Watchers are notified of field edits unless notify_users is False.
+
+        :raises: JIRAError if the edit or transition fails.
         """
-        issue = self.jira.issue(key)
-        fields = {
-                "summary": issue_dict['title'],
-                "assignee": {
+        changed = fields
+        fields = {}
+        if changed is None or 'title' in changed:
+            fields["summary"] = issue_dict['title']
+        if changed is None or 'assignee' in changed:
+            fields["assignee"] = {
                   "name": self.map_unassigned_user(issue_dict['assignee'])
-                },
-            }
+                }
         if issue_dict['due_on']:
-            fields["duedate"] = issue_dict['due_on']
+            if changed is None or 'due_on' in changed:
+                fields["duedate"] = issue_dict['due_on']
+        elif changed and 'due_on' in changed:
+            fields["duedate"] = None
+        transition = changed is None or 'status' in changed
 
-        try:
-            issue.update(fields=fields)
+        if not fields and not transition:
+            log.debug(f"{key}: no changes jira can store in {changed}.")
+            return
+
+        if fields:
+            # the smallest issue that can be edited, its state saves a
+            # lookup if the issue is transitioned too.
+            issue = self.jira.issue(key, fields="issuetype,status")
+            self._issue_states[key] = (issue.fields.issuetype.name,
+                                       issue.fields.status.name)
+            issue.update(fields=fields, notify=self.notify_users)
             log.info(f"{key}: update to {fields}")
-        except JIRAError as e:
-            log.error(f"failed to update: {e}")
-
-        status = self.status_to_source(issue_dict['status'])
-        for transition in self.jira.transitions(issue):
-            name = transition['to']['name']
-            log.debug(f'assessing transition to {name}=={status}?')
-            if name == status:
-                log.info(f'{key}: transitioning issue to {name}.')
-                try:
-                    self.jira.transition_issue(issue, transition['id'])
-                except JIRAError as e:
-                    log.error(f"failed to transition: {e}")
-                finally:
-                    break
+
+        if transition:
+            self._transition_issue(key, issue_dict['status'])
+
+    def _issue_state(self, key):
+        if key not in self._issue_states:
+            self._issue_to_issue_dict(
+                    self.jira.issue(key, fields="issuetype,status"))
+        return self._issue_states[key]
+
+    def _workflow_transitions(self, key, issue_type, status):
+        """Transition ids by target status from an issue type and status.
+
+        Transitions are the same for every issue of a type in a status, so
+        they are only fetched for the first issue seen in that state.
+        """
+        state = (self.project, issue_type, status)
+        if state not in self._transitions:
+            self._transitions[state] = {
+                    transition['to']['name']: transition['id']
+                    for transition in self.jira.transitions(key)}
+        return self._transitions[state]
+
+    def _transition_issue(self, key, notion_status):
+        status = self.status_to_source(notion_status)
+        issue_type, current = self._issue_state(key)
+        if current == status:
+            log.debug(f'{key}: already {status}.')
+            return
+        transitions = self._workflow_transitions(key, issue_type, current)
+        if status not in transitions:
+            log.warning(f'{key}: no transition from {current} to {status}.')
+            return
+        log.info(f'{key}: transitioning issue to {status}.')
+        try:
+            self.jira.transition_issue(key, transitions[status])
+            self._issue_states[key] = (issue_type, status)
+        except JIRAError:
+            # the workflow may have changed.
+            self._transitions.pop((self.project, issue_type, current), None)
+            self._issue_states.pop(key, None)
+            raise
 
     def __str__(self):
         return f"Jira Source: {self.project}"
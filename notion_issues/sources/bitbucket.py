@@ -1,22 +1,42 @@
 import requests
-from pprint import pprint
 from atlassian.bitbucket import Cloud
 
 from notion_issues import unassigned_user
-from notion_issues.sources import IssueSource
+from notion_issues.sources import IssueSource, Issue
+from notion_issues.helpers import metrics
 from notion_issues.logger import Logger
 
 log = Logger('notion_issues.sources.bitbucket')
 
+metric_endpoints = metrics.EndpointMatcher({
+        'workspace': '2.0/workspaces/{workspace}',
+        'workspace.members': '2.0/workspaces/{workspace}/members',
+        'repository': '2.0/repositories/{workspace}/{repo}',
+        'issues': '2.0/repositories/{workspace}/{repo}/issues',
+        'issue': '2.0/repositories/{workspace}/{repo}/issues/{issue_id}',
+        'issue.changes':
+            '2.0/repositories/{workspace}/{repo}/issues/{issue_id}/changes',
+    })
+
 class BitbucketSource(IssueSource):
 
     closed_statuses = ['closed', 'resolved']
 
+    thread_pool_size = 2
+
+    webhook_events = ['issue:created', 'issue:updated']
+
     def __init__(self, bitbucket_user, bitbucket_app_pass,
-                 bitbucket_repo, bitbucket_server, use_path=False):
+                 bitbucket_repo, bitbucket_server, use_path=False,
+                 http_cache=None):
         self.bitbucket = Cloud(username=bitbucket_user,
                                password=bitbucket_app_pass,
                                cloud=True)
+        metrics.instrument_session(
+                self.bitbucket._session, 'bitbucket', metric_endpoints)
+        if http_cache:
+            http_cache.install(self.bitbucket._session)
+        self.http_cache = http_cache
         self.user = bitbucket_user
         self.password = bitbucket_app_pass
         self.repo_path = bitbucket_repo
@@ -32,6 +52,9 @@ class BitbucketSource(IssueSource):
         self.repo = self.workspace.repositories.get(self.repo_name)
         self.session = requests.Session()
         self.session.auth = (self.user, self.password)
+        metrics.instrument_session(self.session, 'bitbucket', metric_endpoints)
+        if http_cache:
+            http_cache.install(self.session)
 
     def id_to_key(self, _id):
         if self.use_path:
@@ -44,6 +67,13 @@ class BitbucketSource(IssueSource):
     def key_to_id(self, key):
         return int(key.split('#')[-1])
 
+    def webhook_issue_key(self, event, payload):
+        if event not in self.webhook_events:
+            return None
+        if payload.get('repository', {}).get('full_name') != self.repo_path:
+            return None
+        return self.id_to_key(payload['issue']['id'])
+
     def map_unassigned_user(self, user):
         if user == unassigned_user:
             return ""
@@ -61,20 +91,19 @@ class BitbucketSource(IssueSource):
         else:
             reporter = ""
 
-        output = {
-              "title": issue.data['title'],
-              "status": issue.data['state'],
-              "assignee": assignee,
-              "reporter": reporter,
-              "labels": [issue.data['priority'],
-                         issue.data['type']],
-              "due_on": "",
-              "opened_on": self.normalize_date(
+        output = Issue(
+              title=issue.data['title'],
+              status=issue.data['state'],
+              assignee=assignee,
+              reporter=reporter,
+              labels=[issue.data['priority'],
+                      issue.data['type']],
+              due_on="",
+              opened_on=self.normalize_date(
                             issue.data['created_on'],
                             granularity='minutes'),
-              "updated_on": self.normalize_date(issue.data['updated_on']),
-              "link": issue.data['links']['html']['href']
-        }
+              updated_on=self.normalize_date(issue.data['updated_on']),
+              link=issue.data['links']['html']['href'])
         return output
 
     def get_issue(self, _id):
@@ -82,28 +111,38 @@ class BitbucketSource(IssueSource):
         return self._issue_to_issue_dict(issue)
 
     def get_issues(self, since=None, assignee=None):
+        return dict(self.iter_issues(since, assignee))
+
+    def iter_issues(self, since=None, assignee=None):
         query = ""
+        since, updated_after = self.poll_since(since)
         if since:
             query = f"updated_on > {since.strftime('%Y-%m-%dT%H:%M:%S')}"
         if assignee:
             query = f'{query} and assignee.nickname = "{assignee}"'
 
-        output = {}
         for issue in self.repo.issues.each(q=query):
             key = self.id_to_key(issue.data["id"])
-            output[key] = self._issue_to_issue_dict(issue)
-        return output
+            issue_dict = self._issue_to_issue_dict(issue)
+            if updated_after and (issue_dict.updated or 0) < updated_after:
+                continue
+            yield key, issue_dict
 
-    def update_issue(self, key, issue_dict):
+    def update_issue(self, key, issue_dict, fields=None):
         number = key.split("#")[1]
-        issue = self.repo.issues.get(int(number))
-        fields = {
-                "title": issue_dict['title'],
-                "state": issue_dict['status']
-            }
+        changed = fields
+        fields = {}
+        if changed is None or 'title' in changed:
+            fields["title"] = issue_dict['title']
+        if changed is None or 'status' in changed:
+            fields["state"] = issue_dict['status']
         if issue_dict['assignee']:
-            self._change_issue_assignee(number, issue_dict['assignee'])
-        pprint(fields)
+            if changed is None or 'assignee' in changed:
+                self._change_issue_assignee(number, issue_dict['assignee'])
+        if not fields:
+            return
+        issue = self.repo.issues.get(int(number))
+        log.info(f"{key}: update to {fields}")
         issue.update(**fields)
 
     def _get_workspace_members(self):
@@ -1,36 +1,153 @@
 import os
 import sys
+import asyncio
 import urllib
+import aiohttp
 import requests
 from datetime import datetime, timedelta, timezone
 from pprint import pformat, pprint
 
 from notion_issues import unassigned_user
-from notion_issues.sources import IssueSource
-from notion_issues.services.aionotion import AioNotion
-from notion_issues.helpers.notion import PropertyFetcher, DatabaseFetcher
+from notion_issues.sources import AsyncIssueSource, Issue
+from notion_issues.services.aionotion import AioNotion, is_transient_error
+from notion_issues.helpers.notion import (
+        DatabaseFetcher, DatabaseSchema, NotionPage)
+from notion_issues.helpers.mirror import NotionMirror
+from notion_issues.helpers import metrics
+from notion_issues.helpers.state import DatabaseMetadataCache
+from notion_issues.helpers.ratelimit import backoff_with_jitter
 from notion_issues.logger import Logger
 
 log = Logger('notion_issues.sources.notion')
 
-class NotionSource(IssueSource):
+class NotionSource(AsyncIssueSource):
 
     closed_statuses = ['closed', 'resolved']
 
-    def __init__(self, notion_token, notion_database):
-        self.notion = AioNotion(notion_token, rate_limit=5, burst_limit=35)
+    # writes are throttled by the AioNotion rate limiter.
+    write_concurrency = 10
+
+    # maximum number of conditions in a compound filter.
+    key_filter_chunk_size = 100
+
+    # pages written to the mirror at a time while refreshing.
+    mirror_batch_size = 500
+
+    # attempts to create a page after transient errors.
+    create_attempts = 4
+
+    # properties read into issues, only these are loaded in full when
+    # Notion truncates them.  Comments are never loaded while syncing.
+    issue_properties = ['Title', 'Status', 'Assignee', 'Reporter', 'Labels',
+                        'Due Date', 'Opened On', 'Link', 'Issue Key']
+
+    def __init__(self, notion_token, notion_database, mirror_path=None,
+                 rate_limit=3, burst_limit=10, api_base=None,
+                 max_rate_limit=None, metadata_cache=None):
+        self.notion = AioNotion(notion_token, rate_limit=rate_limit,
+                                burst_limit=burst_limit, api_base=api_base,
+                                max_rate_limit=max_rate_limit)
         self.notion_database = notion_database
         self.__notion_database_id = None
+        self.metadata_cache = metadata_cache or DatabaseMetadataCache()
+        self.schema = None
+        self._schema_lock = asyncio.Lock()
         self.page_id_map = {}
+        self.mirror = None
+        if mirror_path:
+            self.mirror = NotionMirror(mirror_path)
 
     async def notion_database_id(self):
         if not self.__notion_database_id:
-            self.__notion_database_id  = await self.notion.database_id_for_name(
-                        self.notion_database)
+            entry = self.metadata_cache.get(self.notion_database)
+            if entry:
+                self.__notion_database_id = entry['id']
+            else:
+                self.__notion_database_id = \
+                        await self.notion.database_id_for_name(
+                            self.notion_database)
         return self.__notion_database_id
 
+    async def database_schema(self):
+        """Get the database schema, from the metadata cache while fresh.
+
+        A stale schema is refetched with get_database.  If the cached
+        database id no longer works, the id is searched for again.
+
+        :returns: the database schema.
+        :rtype: notion_issues.helpers.notion.DatabaseSchema
+        """
+        async with self._schema_lock:
+            return await self._database_schema()
+
+    async def _database_schema(self):
+        entry = self.metadata_cache.get(self.notion_database)
+        if self.metadata_cache.fresh(entry):
+            if not (self.schema and
+                    self.schema.database_id == entry['id']):
+                self.schema = DatabaseSchema.from_json(entry['schema'])
+            return self.schema
+
+        db_id = await self.notion_database_id()
+        try:
+            database = await self.notion.get_database(db_id)
+        except aiohttp.ClientResponseError as e:
+            if not (entry and e.status in (400, 404)):
+                raise
+            log.warning(f"{self.notion_database}: cached id {db_id} "
+                        f"failed with {e.status}, searching again.")
+            self.metadata_cache.remove(self.notion_database)
+            self.__notion_database_id = None
+            database = await self.notion.get_database(
+                    await self.notion_database_id())
+        self.schema = DatabaseSchema.from_database(database)
+        self.metadata_cache.put(self.notion_database, self.schema.database_id,
+                                self.schema.to_json())
+        return self.schema
+
+    async def _database_fetcher(self):
+        return DatabaseFetcher(self.notion, await self.database_schema())
+
     async def close(self):
         await self.notion.close()
+        if self.mirror:
+            self.mirror.close()
+
+    async def refresh_mirror(self):
+        """Fetch pages edited since the mirror high-water mark."""
+        db_id = await self.notion_database_id()
+        high_water_mark = self.mirror.high_water_mark(db_id)
+        _filter = {}
+        if high_water_mark:
+            # notion rounds edit times to the minute, refetch the last one.
+            _filter = {
+                    "timestamp": "last_edited_time",
+                    "last_edited_time": {
+                        "on_or_after": high_water_mark
+                    }
+                }
+        log.debug(f'{self.mirror}: refresh from {high_water_mark}')
+        dbf = await self._database_fetcher()
+        count = 0
+        pages = []
+        async for page in dbf.stream(db_id, _filter):
+            pages.append(page)
+            if len(pages) >= self.mirror_batch_size:
+                self.mirror.store_pages(db_id, pages)
+                count += len(pages)
+                pages = []
+        self.mirror.store_pages(db_id, pages)
+        count += len(pages)
+        log.info(f'{self.mirror}: refreshed {count} pages.')
+
+    async def _mirror_page(self, resp):
+        """Store a page returned by a create or update in the mirror."""
+        if not (self.mirror and resp.get('object') == 'page'):
+            return
+        page = NotionPage(self.notion, resp, await self.database_schema())
+        await page.load_properties()
+        db_id = await self.notion_database_id()
+        self.mirror.store_pages(db_id, [page])
 
     def id_to_key(self, _id):
         for issue_key, page_id in self.page_id_map.values():
@@ -42,58 +159,113 @@ class NotionSource(IssueSource):
         if key in self.page_id_map:
             return self.page_id_map.get(key)
 
+        if self.mirror:
+            db_id = await self.notion_database_id()
+            page = self.mirror.page_for_key(db_id, key)
+            if page:
+                return page['id']
+            return None
+
+        db_id = await self.notion_database_id()
+        page = await self._query_page_for_key(db_id, key)
+        if page:
+            return page['id']
+
+        return None
+
+    async def _query_page_for_key(self, db_id, key):
+        """Query Notion, not the mirror, for the page with an issue key."""
         _filter = {
                 "property": "Issue Key",
                 "rich_text": {
                         "equals": key
                     }
                 }
-        db_id = await self.notion_database_id()
         results = await self.notion.database_query(db_id, _filter)
         pages = results.get('results')
         if pages:
             try:
-                page = await pages[0]
-                return page['id']
+                return await pages[0]
             except IndexError:
                 pass
 
         return None
 
     def _issue_to_issue_dict(self, page, page_properties):
-        output = {
-              "title": page_properties['Title'],
-              "status": page_properties['Status'],
-              "assignee": page_properties['Assignee'],
-              "reporter": page_properties['Reporter'],
-              "labels": page_properties['Labels'],
-              "due_on": self.normalize_date(
+        output = Issue(
+              title=page_properties['Title'],
+              status=page_properties['Status'],
+              assignee=page_properties['Assignee'],
+              reporter=page_properties['Reporter'],
+              labels=page_properties['Labels'],
+              due_on=self.normalize_date(
                                 page_properties['Due Date']),
-              "opened_on": self.normalize_date(
+              opened_on=self.normalize_date(
                                 page_properties['Opened On']),
-              "updated_on": self.normalize_date(
+              updated_on=self.normalize_date(
                                 page['last_edited_time']),
-              "link": page_properties['Link'],
-        }
+              link=page_properties['Link'])
         return output
 
     async def get_issue(self, _id):
-        page = await self.notion.get_page(_id)
-        pf = PropertyFetcher(self.notion)
-        props = await pf.fetch_properties(page['id'], page['properties'])
+        if self.mirror:
+            page = self.mirror.page(_id)
+            if page:
+                props = page['properties']
+                self.page_id_map[props['Issue Key']] = page['id']
+                return self._issue_to_issue_dict(page, props)
+
+        page = NotionPage(self.notion, await self.notion.get_page(_id),
+                          await self.database_schema())
+        props = await page.load_properties(self.issue_properties)
         self.page_id_map[props['Issue Key']] = page['id']
+        if self.mirror:
+            db_id = await self.notion_database_id()
+            self.mirror.store_pages(db_id, [{**page, 'properties': props}])
         return self._issue_to_issue_dict(page, props)
 
     async def get_issues(self, issue_key_filter="", since=None, assignee=None):
-        output = {}
+        return {key: issue_dict async for key, issue_dict in
+                self.stream_issues(issue_key_filter, since, assignee)}
+
+    async def stream_issues(self, issue_key_filter="", since=None,
+                            assignee=None):
+        """Yield issues as their pages are fetched and decoded.
+
+        :param issue_key_filter: issue key prefix, or list of prefixes.
+        :type issue_key_filter: str or list
+        :returns: async generator of (issue key, issue dict).
+        """
+        if self.mirror:
+            async for item in self._stream_mirrored_issues(
+                    issue_key_filter, since, assignee):
+                yield item
+            return
+
+        _filter = self._issues_filter(issue_key_filter, since, assignee)
+        log.debug(f'notion filter: {pformat(_filter)}')
+
+        dbf = await self._database_fetcher()
+        db_id = await self.notion_database_id()
+        async for page in dbf.stream(db_id, _filter,
+                                     properties=self.issue_properties):
+            yield self._page_to_issue(page)
+
+    def _issues_filter(self, issue_key_filter="", since=None, assignee=None):
         _filters = []
 
-        if issue_key_filter:
-            _filters.append({ "property": "Issue Key",
-                              "rich_text": {
-                                  "starts_with": issue_key_filter
-                              }
-                      })
+        if isinstance(issue_key_filter, str):
+            issue_key_filter = [issue_key_filter] if issue_key_filter else []
+
+        key_filters = [{ "property": "Issue Key",
+                         "rich_text": {
+                             "starts_with": key_filter
+                         }
+                       } for key_filter in issue_key_filter]
+        if len(key_filters) > 1:
+            _filters.append({ "or": key_filters })
+        elif key_filters:
+            _filters.append(key_filters[0])
 
         if since:
             _filters.append({
@@ -117,40 +289,180 @@ class NotionSource(IssueSource):
                 _filter = { "and": _filters }
             else:
                 _filter = _filters[0]
+        return _filter
+
+    def _page_to_issue(self, page):
+        key = page['properties']['Issue Key']
+        self.page_id_map[key] = page['id']
+        return key, self._issue_to_issue_dict(page, page['properties'])
+
+    def _pages_to_issues(self, pages):
+        return dict(self._page_to_issue(page) for page in pages)
+
+    async def _get_issues_for_chunk(self, db_id, keys):
+        _filters = [{ "property": "Issue Key",
+                      "rich_text": {
+                          "equals": key
+                      }
+                    } for key in keys]
+        _filter = _filters[0]
+        if len(_filters) > 1:
+            _filter = { "or": _filters }
+
+        dbf = await self._database_fetcher()
+        pages = await dbf.fetch_database(
+                db_id, _filter, properties=self.issue_properties)
+        return self._pages_to_issues(pages)
+
+    async def get_issues_for_keys(self, keys):
+        """Get the issues for many keys with as few queries as possible.
+
+        Keys are resolved in chunks with a compound ``or`` filter and the
+        pages are decoded from the query results.
+
+        :param keys: issue keys to get.
+        :type keys: iterable
+        :returns: issue dicts for the keys found, keyed by issue key.
+        :rtype: dict
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
 
-        log.debug(f'notion filter: {pformat(_filter)}')
-
-        dbf = DatabaseFetcher(self.notion)
         db_id = await self.notion_database_id()
-        pages = await dbf.fetch_database(db_id, _filter, comments=True)
-
         output = {}
-        for page in pages:
-            key = page['properties']['Issue Key']
-            props = self._issue_to_issue_dict(page, page['properties'])
-            output[key] = props
-            self.page_id_map[key] = page['id']
-
+        if self.mirror:
+            pages = [self.mirror.page_for_key(db_id, key) for key in keys]
+            output = self._pages_to_issues([p for p in pages if p])
+            # pages created since the mirror was refreshed, i.e. by another
+            # process, are only in Notion.
+            keys = [key for key in keys if key not in output]
+            if not keys:
+                return output
+
+        size = self.key_filter_chunk_size
+        chunks = [keys[i:i+size] for i in range(0, len(keys), size)]
+        results = await asyncio.gather(
+                *[self._get_issues_for_chunk(db_id, c) for c in chunks])
+
+        for result in results:
+            output.update(result)
         return output
 
-    async def update_issue(self, key, issue_dict):
+    async def _stream_mirrored_issues(self, issue_key_filter="", since=None,
+                                      assignee=None):
+        await self.refresh_mirror()
+        db_id = await self.notion_database_id()
+        since_str = self.normalize_date(since) if since else ""
+        if isinstance(issue_key_filter, str):
+            issue_key_filter = [issue_key_filter]
+        for key_filter in issue_key_filter or [""]:
+            for page in self.mirror.pages(db_id, key_filter, since_str):
+                if assignee and page['properties']['Assignee'] != assignee:
+                    continue
+                yield self._page_to_issue(page)
+
+    async def update_issue(self, key, issue_dict, fields=None):
+        """Update the page for an issue.
+
+        :param fields: the fields that changed, only their properties and
+                       Updated On are sent. Default: all properties.
+        :type fields: list
+        """
         properties = self._issue_dict_to_properties(key, issue_dict)
+        if fields is not None:
+            properties = self._changed_properties(issue_dict, fields,
+                                                  properties)
         page_id = self.page_id_map[key]
         resp = await self.notion.update_page(page_id, properties)
+        await self._mirror_page(resp)
 
         return resp
 
     async def create_issue(self, key, issue_dict):
+        """Create a page for an issue without creating duplicates.
+
+        If another sync created or found the page after this create was
+        planned, i.e. a webhook during a watch cycle, that page is updated
+        instead.  A create that fails with a transient error may still have
+        created the page, so before it is retried Notion is queried for the
+        issue key and an existing page is returned instead.
+        """
+        page_id = self.page_id_map.get(key)
+        if page_id:
+            log.info(f"{key}: page {page_id} exists, updating it.")
+            try:
+                return await self.update_issue(key, issue_dict)
+            except aiohttp.ClientResponseError as e:
+                if e.status not in (400, 404):
+                    raise
+                log.warning(f"{key}: page {page_id} failed with {e.status}, "
+                            f"creating a new one.")
+                self.page_id_map.pop(key, None)
+
         properties = self._issue_dict_to_properties(key, issue_dict)
         db_id = await self.notion_database_id()
-        resp = await self.notion.add_page_to_database(db_id, properties)
+        for attempt in range(1, self.create_attempts + 1):
+            try:
+                resp = await self.notion.add_page_to_database(
+                        db_id, properties)
+                break
+            except Exception as e:
+                if not is_transient_error(e) or \
+                        attempt == self.create_attempts:
+                    raise
+                delay = backoff_with_jitter(attempt)
+                log.warning(f"{key}: create failed with {e!r}, checking "
+                            f"for the page in {delay:.1f}s.")
+                if metrics.recorder is not None:
+                    metrics.recorder.record_retry('notion', 'pages')
+                await asyncio.sleep(delay)
+                page = await self._query_page_for_key(db_id, key)
+                if page:
+                    log.info(f"{key}: failed create made page {page['id']}.")
+                    resp = page
+                    break
+        self.page_id_map[key] = resp['id']
+        await self._mirror_page(resp)
         return resp
 
     async def archive_issue(self, key):
-        page_id = self.page_id_map[key]
+        page_id = self.page_id_map.pop(key)
         resp = await self.notion.update_page(page_id, archived=True)
+        if self.mirror:
+            self.mirror.remove_page(page_id)
         return resp
 
+    # the page properties written for each issue field.
+    field_properties = {
+            'title': 'Title',
+            'assignee': 'Assignee',
+            'labels': 'Labels',
+            'status': 'Status',
+            'opened_on': 'Opened On',
+            'updated_on': 'Updated On',
+            'link': 'Link',
+            'due_on': 'Due Date',
+            'reporter': 'Reporter',
+        }
+
+    def _changed_properties(self, issue_dict, fields, properties):
+        """Only the properties for the changed fields, and Updated On.
+
+        Due Date and Reporter are left out of the full properties when
+        empty, here they are cleared instead.
+        """
+        changed = {}
+        for field in list(fields) + ['updated_on']:
+            name = self.field_properties[field]
+            if name in properties:
+                changed[name] = properties[name]
+            elif name == 'Due Date':
+                changed[name] = { "date": None }
+            elif name == 'Reporter':
+                changed[name] = { "select": None }
+        return changed
+
     def _issue_dict_to_properties(self, key, issue_dict):
         properties = {
                 "Title": {
@@ -15,6 +15,8 @@ setup(
         'python-dateutil',
         'pyyaml',
         'atlassian-python-api',
+        'aiohttp',
+        'aio_api_sm',
     ],
     entry_points={
         'console_scripts': [
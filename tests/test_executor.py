@@ -0,0 +1,132 @@
+import asyncio
+import unittest
+
+from notion_issues.helpers.executor import WriteExecutor, WriteOperation, KeyLocks
+
+class RecordingTarget:
+    """Record the order of writes and the writes running at once per key."""
+
+    def __init__(self, delay=0.01, fail=()):
+        self.delay = delay
+        self.fail = set(fail)
+        self.calls = []
+        self.running = {}
+        self.max_running = {}
+
+    async def update_issue(self, key, value):
+        self.running[key] = self.running.get(key, 0) + 1
+        self.max_running[key] = max(self.max_running.get(key, 0),
+                                    self.running[key])
+        try:
+            await asyncio.sleep(self.delay)
+            if value in self.fail:
+                raise RuntimeError(f"{key}: {value} failed")
+            self.calls.append((key, value))
+            return value
+        finally:
+            self.running[key] -= 1
+
+    def __str__(self):
+        return "Recording Target"
+
+class TestWriteExecutor(unittest.TestCase):
+
+    def test_same_key_runs_in_order(self):
+        target = RecordingTarget()
+        executor = WriteExecutor(concurrency=4)
+        for value in range(5):
+            executor.add(WriteOperation('a', target, 'update_issue', value))
+            executor.add(WriteOperation('b', target, 'update_issue', value))
+
+        asyncio.run(executor.execute())
+
+        self.assertEqual([v for k, v in target.calls if k == 'a'],
+                         list(range(5)))
+        self.assertEqual([v for k, v in target.calls if k == 'b'],
+                         list(range(5)))
+        self.assertEqual(target.max_running, {'a': 1, 'b': 1})
+
+    def test_different_keys_run_concurrently(self):
+        target = RecordingTarget(delay=0.05)
+        executor = WriteExecutor(concurrency=10)
+        for key in range(10):
+            executor.add(WriteOperation(key, target, 'update_issue', key))
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            await executor.execute()
+            return loop.time() - started
+
+        self.assertLess(asyncio.run(run()), 0.05 * 5)
+        self.assertEqual(len(target.calls), 10)
+
+    def test_failure_stops_the_chain(self):
+        target = RecordingTarget(fail={1})
+        executor = WriteExecutor()
+        operations = [WriteOperation('a', target, 'update_issue', value)
+                      for value in range(3)]
+        for operation in operations:
+            executor.add(operation)
+        executor.add(WriteOperation('b', target, 'update_issue', 0))
+
+        asyncio.run(executor.execute())
+
+        self.assertEqual(target.calls, [('a', 0), ('b', 0)])
+        self.assertIsInstance(operations[1].error, RuntimeError)
+        self.assertTrue(operations[2].failed)
+        self.assertFalse(operations[2].done)
+
+    def test_operations_added_while_running(self):
+        target = RecordingTarget()
+        executor = WriteExecutor(concurrency=2)
+
+        async def run():
+            executor.start()
+            for value in range(3):
+                executor.add(WriteOperation('a', target, 'update_issue', value))
+            await asyncio.sleep(0)
+            executor.add(WriteOperation('b', target, 'update_issue', 0))
+            return await executor.join()
+
+        operations = asyncio.run(run())
+
+        self.assertEqual(len(operations), 4)
+        self.assertEqual([v for k, v in target.calls if k == 'a'], [0, 1, 2])
+        self.assertIn(('b', 0), target.calls)
+
+    def test_shared_key_locks_serialize_executors(self):
+        target = RecordingTarget()
+        key_locks = KeyLocks()
+        first = WriteExecutor(key_locks=key_locks)
+        second = WriteExecutor(key_locks=key_locks)
+        for value in range(3):
+            first.add(WriteOperation('a', target, 'update_issue', value))
+            second.add(WriteOperation('a', target, 'update_issue', value + 10))
+
+        async def run():
+            await asyncio.gather(first.execute(), second.execute())
+
+        asyncio.run(run())
+
+        self.assertEqual(target.max_running, {'a': 1})
+        values = [v for _, v in target.calls]
+        # one executor's chain runs to the end before the other's starts.
+        self.assertIn(values, ([0, 1, 2, 10, 11, 12], [10, 11, 12, 0, 1, 2]))
+
+    def test_without_shared_locks_executors_overlap(self):
+        target = RecordingTarget()
+        first = WriteExecutor()
+        second = WriteExecutor()
+        first.add(WriteOperation('a', target, 'update_issue', 0))
+        second.add(WriteOperation('a', target, 'update_issue', 1))
+
+        async def run():
+            await asyncio.gather(first.execute(), second.execute())
+
+        asyncio.run(run())
+
+        self.assertEqual(target.max_running, {'a': 2})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import json
+import hashlib
+import threading
+import unittest
+import requests
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from notion_issues.helpers.httpcache import HTTPCache
+from notion_issues.sources import IssueSource, Issue, ISO_UTC_FMT
+
+BOUNDARY = datetime(2026, 1, 1, 12, 0, tzinfo=timezone.utc)
+
+# issue number: minutes after BOUNDARY it was last updated.
+UPDATED = {1: 5, 2: 20, 3: 40}
+
+class IssuesHandler(BaseHTTPRequestHandler):
+    """Serve GET /issues?since= with ETags, like the Github issues list."""
+
+    statuses = []
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        since = datetime.strptime(query['since'][0], ISO_UTC_FMT).replace(
+                tzinfo=timezone.utc)
+        issues = [{'number': number,
+                   'updated_at': (BOUNDARY + timedelta(minutes=minutes)
+                                  ).strftime(ISO_UTC_FMT)}
+                  for number, minutes in UPDATED.items()
+                  if BOUNDARY + timedelta(minutes=minutes) >= since]
+        body = json.dumps(issues).encode()
+        etag = f'"{hashlib.sha256(body).hexdigest()}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.statuses.append(304)
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.statuses.append(200)
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class PollingSource(IssueSource):
+    """Poll the issues list the way the Github, Jira and Bitbucket
+    sources do."""
+
+    def __init__(self, url, http_cache=None):
+        self.url = url
+        self.http_cache = http_cache
+        self.session = requests.Session()
+        if http_cache:
+            http_cache.install(self.session)
+
+    def id_to_key(self, _id):
+        return f"test#{_id}"
+
+    def get_issues(self, since=None, assignee=None):
+        since, updated_after = self.poll_since(since)
+        resp = self.session.get(
+                self.url, params={'since': since.strftime(ISO_UTC_FMT)})
+        resp.raise_for_status()
+        issues = {}
+        for item in resp.json():
+            issue = Issue(title="", status="open", assignee="", reporter="",
+                          labels=[], due_on="", opened_on="",
+                          updated_on=item['updated_at'], link="")
+            if updated_after and (issue.updated or 0) < updated_after:
+                continue
+            issues[self.id_to_key(item['number'])] = issue
+        return issues
+
+    def __str__(self):
+        return f"Polling Source: {self.url}"
+
+class TestPollingWithHTTPCache(unittest.TestCase):
+
+    def setUp(self):
+        IssuesHandler.statuses = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), IssuesHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        host, port = self.server.server_address
+        self.url = f"http://{host}:{port}/issues"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_advancing_watermark_revalidates(self):
+        cache = HTTPCache(':memory:')
+        source = PollingSource(self.url, cache)
+
+        first = source.get_issues(since=BOUNDARY + timedelta(minutes=10))
+        second = source.get_issues(since=BOUNDARY + timedelta(minutes=30))
+
+        self.assertEqual(IssuesHandler.statuses, [200, 304])
+        self.assertEqual(sorted(first), ['test#2', 'test#3'])
+        self.assertEqual(sorted(second), ['test#3'])
+        cache.close()
+
+    def test_next_boundary_fetches_again(self):
+        cache = HTTPCache(':memory:')
+        source = PollingSource(self.url, cache)
+
+        source.get_issues(since=BOUNDARY - timedelta(minutes=10))
+        source.get_issues(since=BOUNDARY + timedelta(minutes=10))
+
+        self.assertEqual(IssuesHandler.statuses, [200, 200])
+        cache.close()
+
+    def test_without_cache_since_is_exact(self):
+        source = PollingSource(self.url)
+        since = BOUNDARY + timedelta(minutes=10)
+
+        self.assertEqual(source.poll_since(since), (since, None))
+        self.assertEqual(sorted(source.get_issues(since=since)),
+                         ['test#2', 'test#3'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+
+from notion_issues import IssueSync
+from notion_issues.sources import Issue, iso_to_epoch, epoch_to_iso
+
+ISSUE = {
+    "title": "Crash on start",
+    "status": "open",
+    "assignee": "alice",
+    "reporter": "bob",
+    "labels": ["bug", "major"],
+    "due_on": "2026-02-01T00:00:00Z",
+    "opened_on": "2026-01-01T09:30:00Z",
+    "updated_on": "2026-01-02T10:15:42Z",
+    "link": "https://example.com/issues/1",
+}
+
+class TestDates(unittest.TestCase):
+
+    def test_iso_round_trip(self):
+        for value in ["2026-01-02T10:15:42Z", "1970-01-01T00:00:00Z"]:
+            self.assertEqual(epoch_to_iso(iso_to_epoch(value)), value)
+
+    def test_offsets_are_normalized_to_utc(self):
+        self.assertEqual(iso_to_epoch("2026-01-02T12:15:42+02:00"),
+                         iso_to_epoch("2026-01-02T10:15:42Z"))
+        self.assertEqual(iso_to_epoch("2026-01-02T10:15:42"),
+                         iso_to_epoch("2026-01-02T10:15:42Z"))
+
+    def test_empty(self):
+        self.assertIsNone(iso_to_epoch(""))
+        self.assertIsNone(iso_to_epoch(None))
+        self.assertEqual(epoch_to_iso(None), "")
+        self.assertEqual(iso_to_epoch(1767349542), 1767349542)
+
+class TestIssue(unittest.TestCase):
+
+    def test_dict_round_trip(self):
+        issue = Issue.coerce(ISSUE)
+
+        self.assertEqual(issue.to_dict(), ISSUE)
+        self.assertEqual(Issue.coerce(issue.to_dict()).fingerprint,
+                         issue.fingerprint)
+        self.assertIs(Issue.coerce(issue), issue)
+
+    def test_empty_dates(self):
+        issue = Issue.coerce(dict(ISSUE, due_on="", opened_on=None))
+
+        self.assertIsNone(issue.due)
+        self.assertEqual(issue['due_on'], "")
+        self.assertEqual(issue['opened_on'], "")
+
+    def test_ignored_fields_keep_fingerprint(self):
+        issue = Issue.coerce(ISSUE)
+        other = Issue.coerce(dict(
+                ISSUE, updated_on="2026-03-01T00:00:00Z", reporter="carol",
+                opened_on="2025-12-01T00:00:00Z", link="https://example.com"))
+
+        self.assertEqual(issue.fingerprint, other.fingerprint)
+        self.assertEqual(issue.diff(other), [])
+
+    def test_synced_fields_change_fingerprint(self):
+        issue = Issue.coerce(ISSUE)
+        changes = {"title": "Crash on exit", "status": "closed",
+                   "assignee": "carol", "labels": ["major", "bug"],
+                   "due_on": "2026-02-01T00:00:01Z"}
+        for field, value in changes.items():
+            other = Issue.coerce(dict(ISSUE, **{field: value}))
+            self.assertNotEqual(issue.fingerprint, other.fingerprint, field)
+            self.assertEqual(issue.diff(other), [field])
+
+    def test_getitem(self):
+        issue = Issue.coerce(ISSUE)
+
+        self.assertEqual(issue['labels'], ["bug", "major"])
+        self.assertEqual(issue.get('missing', 'default'), 'default')
+        with self.assertRaises(KeyError):
+            issue['fingerprint']
+
+class TestChangedFields(unittest.TestCase):
+
+    def test_changed_fields(self):
+        syncer = IssueSync()
+        notion_issue = Issue.coerce(ISSUE)
+        other_issue = Issue.coerce(dict(
+                ISSUE, status="closed", labels=["bug"],
+                updated_on="2026-01-03T00:00:00Z"))
+
+        self.assertFalse(syncer.issues_equal(notion_issue, other_issue))
+        self.assertEqual(syncer.changed_fields(notion_issue, other_issue),
+                         ["status", "labels"])
+
+    def test_equal_issues(self):
+        syncer = IssueSync()
+        notion_issue = Issue.coerce(ISSUE)
+        other_issue = Issue.coerce(dict(ISSUE, reporter="carol"))
+
+        self.assertTrue(syncer.issues_equal(notion_issue, other_issue))
+        self.assertEqual(syncer.changed_fields(notion_issue, other_issue), [])
+
+    def test_custom_ignore_fields(self):
+        syncer = IssueSync()
+        syncer.ignore_fields = Issue.ignore_fields + ['labels']
+        notion_issue = Issue.coerce(ISSUE)
+        other_issue = Issue.coerce(dict(ISSUE, status="closed",
+                                        labels=["bug"]))
+
+        self.assertFalse(syncer.issues_equal(notion_issue, other_issue))
+        self.assertEqual(syncer.changed_fields(notion_issue, other_issue),
+                         ["status"])
+        self.assertTrue(syncer.issues_equal(
+                notion_issue, dict(ISSUE, labels=["minor"])))
+
+if __name__ == '__main__':
+    unittest.main()
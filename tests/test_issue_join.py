@@ -0,0 +1,97 @@
+import asyncio
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from notion_issues import IssueSync
+from notion_issues.benchmark import synthetic_issues, SyntheticSource
+from notion_issues.benchmark.server import FakeNotionServer
+from notion_issues.sources import iso_to_epoch
+from notion_issues.sources.notion import NotionSource
+
+# the second filter starts with the first, so its keys match both.
+PREFIXES = ["bench", "bench-extra"]
+
+class RecordingSource(SyntheticSource):
+    """A synthetic source that records the keys it is asked to update."""
+
+    def __init__(self, issues, prefix):
+        super().__init__(issues, prefix=prefix)
+        self.updated = []
+
+    def update_issue(self, key, issue_dict, fields=None):
+        super().update_issue(key, issue_dict, fields)
+        self.updated.append(key)
+
+class TestIssueJoinFilters(unittest.TestCase):
+
+    def sync(self, pipelined):
+        now = datetime.now(timezone.utc)
+        sources = []
+        notion_pages = []
+        for number, prefix in enumerate(PREFIXES):
+            source_issues, pages = synthetic_issues(
+                    20, now, existing=1, changed=1, prefix=prefix,
+                    seed=number)
+            sources.append(RecordingSource(source_issues, prefix))
+            notion_pages.extend(pages)
+
+        async def run():
+            server = FakeNotionServer()
+            database = server.add_database("Test")
+            for key, issue_dict, last_edited_time in notion_pages:
+                database.add_issue(key, issue_dict, last_edited_time)
+            url = await server.start()
+            notion_source = NotionSource("test", "Test", rate_limit=1000,
+                                         api_base=url)
+            try:
+                syncer = IssueSync(since=now - timedelta(days=30),
+                                   archive_aged=0, pipelined=pipelined)
+                results = await syncer.sync_many(
+                        notion_source,
+                        [(source, prefix, None)
+                         for source, prefix in zip(sources, PREFIXES)])
+            finally:
+                await notion_source.close()
+                await server.stop()
+            return syncer, results, server
+
+        syncer, results, server = asyncio.run(run())
+        return sources, notion_pages, syncer, results, server
+
+    def check(self, pipelined):
+        sources, notion_pages, syncer, results, server = self.sync(pipelined)
+
+        self.assertEqual(syncer.failures, 0)
+        self.assertEqual(server.duplicate_keys(), 0)
+        for source, prefix, operations in zip(sources, PREFIXES, results):
+            # every page differs, so every key is written once, to one side.
+            keys = sorted(op.key for op in operations)
+            self.assertEqual(keys, sorted(source.issues))
+            self.assertNotIn('create_issue',
+                             [op.action for op in operations])
+            for key in source.updated:
+                self.assertEqual(key.rsplit('#', 1)[0], prefix)
+
+        newer_in_notion = {key for key, issue_dict, edited in notion_pages
+                           if iso_to_epoch(edited)
+                           > iso_to_epoch(issue_dict['updated_on'])}
+        updated = {key for source in sources for key in source.updated}
+        self.assertEqual(updated, newer_in_notion)
+
+    def test_pipelined_routes_to_longest_filter(self):
+        self.check(pipelined=True)
+
+    def test_batched_routes_to_longest_filter(self):
+        self.check(pipelined=False)
+
+    def test_partition_issues(self):
+        syncer = IssueSync()
+        issues = {"bench#1": 1, "bench-extra#1": 2, "other#1": 3}
+
+        partitions = syncer._partition_issues(issues, PREFIXES)
+
+        self.assertEqual(partitions, {"bench": {"bench#1": 1},
+                                      "bench-extra": {"bench-extra#1": 2}})
+
+if __name__ == '__main__':
+    unittest.main()
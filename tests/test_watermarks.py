@@ -0,0 +1,162 @@
+import json
+import asyncio
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+from datetime import datetime, timedelta, timezone
+
+import notion_issues.__main__ as cli
+from notion_issues.helpers.executor import WriteOperation
+from notion_issues.helpers.state import SyncWatermarks
+
+STARTED = datetime(2026, 1, 1, 12, 0, tzinfo=timezone.utc)
+JOB = SyncWatermarks.job_key("github", "owner/repo", "Issues")
+
+class TestSyncWatermarks(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name) / "watermarks.json"
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_default_without_watermark(self):
+        watermarks = SyncWatermarks(self.path)
+
+        self.assertIsNone(watermarks.since(JOB))
+        self.assertEqual(watermarks.since(JOB, default=STARTED), STARTED)
+
+    def test_record_and_reload(self):
+        SyncWatermarks(self.path).record(JOB, STARTED)
+
+        watermarks = SyncWatermarks(self.path, overlap=60)
+        self.assertEqual(watermarks.since(JOB),
+                         STARTED - timedelta(seconds=60))
+        self.assertEqual(json.loads(self.path.read_text()),
+                         {JOB: STARTED.isoformat()})
+
+    def test_jobs_are_independent(self):
+        other = SyncWatermarks.job_key("github", "owner/other", "Issues")
+        watermarks = SyncWatermarks(self.path, overlap=0)
+        watermarks.record(JOB, STARTED)
+        watermarks.record(other, STARTED + timedelta(hours=1))
+
+        self.assertEqual(watermarks.since(JOB), STARTED)
+        self.assertEqual(watermarks.since(other),
+                         STARTED + timedelta(hours=1))
+
+    def test_never_moves_backwards(self):
+        watermarks = SyncWatermarks(self.path, overlap=0)
+        watermarks.record(JOB, STARTED)
+        watermarks.record(JOB, STARTED - timedelta(hours=1))
+
+        self.assertEqual(watermarks.since(JOB), STARTED)
+
+    def test_future_watermark_is_capped(self):
+        watermarks = SyncWatermarks(self.path, overlap=0)
+        watermarks.record(JOB, datetime.now(timezone.utc) + timedelta(days=1))
+
+        self.assertLessEqual(watermarks.since(JOB),
+                             datetime.now(timezone.utc))
+
+class TestSinceArguments(unittest.TestCase):
+
+    def parse_args(self, *argv, watermark_file="watermarks.json"):
+        argv = ['notion_issues', *argv, 'notion', '--archive-key', 'x#1']
+        with mock.patch.dict(cli.defaults,
+                             {'watermark_file': watermark_file}), \
+                mock.patch('sys.argv', argv):
+            return cli.parse_args()
+
+    def test_watermark_file_from_environment(self):
+        args = self.parse_args()
+
+        self.assertEqual(args.watermark_file, "watermarks.json")
+        self.assertIsNone(args.since)
+
+    def test_since_overrides_watermark_file(self):
+        args = self.parse_args('-s', '20260101T000000')
+
+        self.assertIsNone(args.watermark_file)
+        self.assertEqual(args.since, datetime(2026, 1, 1))
+
+    def test_since_file_overrides_watermark_file(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as f:
+            f.write("2026-01-01T00:00:00Z")
+            f.flush()
+            args = self.parse_args('-sf', f.name)
+
+        self.assertIsNone(args.watermark_file)
+        self.assertEqual(args.since_file, STARTED - timedelta(hours=12))
+
+    def test_since_and_watermark_file_conflict(self):
+        with mock.patch('sys.stderr'), self.assertRaises(SystemExit):
+            self.parse_args('-s', '20260101T000000', '-wf', 'other.json')
+
+class FakeSyncer:
+    """Return canned results from sync_many and record the sinces."""
+
+    def __init__(self, results):
+        self.results = results
+        self.sinces = []
+
+    async def sync_many(self, notion_source, sources):
+        self.sinces.append([since for _, _, since in sources])
+        return self.results
+
+class TestJobRunnerWatermarks(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name) / "watermarks.json"
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_jobs(self, results, watermark_file):
+        argv = ['notion_issues', '--watermark-overlap', '0', 'notion',
+                '--archive-key', 'x#1']
+        if watermark_file:
+            argv[1:1] = ['-wf', str(watermark_file)]
+        with mock.patch.dict(cli.defaults, {'watermark_file': None}), \
+                mock.patch('sys.argv', argv):
+            args = cli.parse_args()
+        syncer = FakeSyncer(results)
+        jobs = [("job-a", None, "a"), ("job-b", None, "b")]
+
+        async def run():
+            runner = cli.JobRunner(args, syncer, jobs)
+            try:
+                await runner.run()
+                await runner.run()
+            finally:
+                await runner.notion_source.close()
+
+        asyncio.run(run())
+        return syncer
+
+    def test_failed_jobs_keep_their_watermark(self):
+        failed = WriteOperation("b#1", None, "update_issue")
+        syncer = self.run_jobs([[], [failed]], self.path)
+
+        recorded = json.loads(self.path.read_text())
+        self.assertEqual(list(recorded), ["job-a"])
+        self.assertEqual(syncer.sinces[0], [cli.defaults['since']] * 2)
+        # the second run syncs job-a from the first run's watermark.
+        self.assertGreater(syncer.sinces[1][0], cli.defaults['since'])
+        self.assertLessEqual(syncer.sinces[1][0],
+                             SyncWatermarks(self.path, 0).since("job-a"))
+        self.assertEqual(syncer.sinces[1][1], cli.defaults['since'])
+
+    def test_watch_cycles_without_watermark_file(self):
+        syncer = self.run_jobs([[], RuntimeError("boom")], None)
+
+        self.assertEqual(syncer.sinces[0], [None, None])
+        self.assertIsInstance(syncer.sinces[1][0], datetime)
+        self.assertIsNone(syncer.sinces[1][1])
+        self.assertFalse(self.path.exists())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import hmac
+import json
+import asyncio
+import hashlib
+import unittest
+import aiohttp
+
+from notion_issues.benchmark import SyntheticSource
+from notion_issues.helpers.webhook import WebhookReceiver
+
+SECRET = "s3cret"
+
+class WebhookSource(SyntheticSource):
+    """Match Github style ``issues`` payloads for a repo."""
+
+    def webhook_issue_key(self, event, payload):
+        if event != 'issues':
+            return None
+        if payload.get('repository', {}).get('full_name') != self.prefix:
+            return None
+        return self.id_to_key(payload['issue']['number'])
+
+class BlockingSyncer:
+    """Record single issue syncs, holding each until released."""
+
+    def __init__(self):
+        self.synced = []
+        self.started = asyncio.Event()
+        self.release = asyncio.Event()
+
+    async def sync_issue(self, notion_source, source, key):
+        self.synced.append(key)
+        self.started.set()
+        await self.release.wait()
+        return []
+
+def sign(body, algorithm='sha256'):
+    digest = hmac.new(SECRET.encode(), body, algorithm).hexdigest()
+    return f"{algorithm}={digest}"
+
+def payload(number, repo="owner/repo"):
+    return json.dumps({'repository': {'full_name': repo},
+                       'issue': {'number': number}}).encode()
+
+class TestVerify(unittest.TestCase):
+
+    def setUp(self):
+        self.receiver = WebhookReceiver(None, None, [], secret=SECRET)
+        self.body = payload(1)
+
+    def test_sha256(self):
+        self.assertTrue(self.receiver.verify(
+                self.body, {'X-Hub-Signature-256': sign(self.body)}))
+
+    def test_sha1(self):
+        self.assertTrue(self.receiver.verify(
+                self.body, {'X-Hub-Signature': sign(self.body, 'sha1')}))
+
+    def test_bad_signature(self):
+        self.assertFalse(self.receiver.verify(
+                self.body, {'X-Hub-Signature-256': sign(payload(2))}))
+
+    def test_unsupported_algorithm(self):
+        self.assertFalse(self.receiver.verify(
+                self.body, {'X-Hub-Signature': sign(self.body, 'md5')}))
+
+    def test_missing_signature(self):
+        self.assertFalse(self.receiver.verify(self.body, {}))
+
+    def test_no_secret(self):
+        receiver = WebhookReceiver(None, None, [])
+        self.assertTrue(receiver.verify(self.body, {}))
+
+class TestHandle(unittest.TestCase):
+
+    def run_receiver(self, requests):
+        """Start a receiver with one worker and post requests to it.
+
+        The worker blocks on the first sync, so later keys stay queued.
+        """
+        source = WebhookSource({}, prefix="owner/repo")
+
+        async def run():
+            syncer = BlockingSyncer()
+            receiver = WebhookReceiver(syncer, None, [source], SECRET,
+                                       queue_size=2, workers=1)
+            await receiver.start('127.0.0.1', 0)
+            port = receiver._runner.addresses[0][1]
+            url = f"http://127.0.0.1:{port}{receiver.path}"
+            responses = []
+            try:
+                async with aiohttp.ClientSession() as session:
+                    for headers, body in requests:
+                        async with session.post(url, data=body,
+                                                headers=headers) as resp:
+                            responses.append((resp.status, await resp.text()))
+                        if resp.status == 202 and not syncer.synced:
+                            await syncer.started.wait()
+                    queued = receiver.queue.qsize()
+                    syncer.release.set()
+                    await receiver.queue.join()
+            finally:
+                await receiver.stop()
+            return responses, queued, syncer.synced
+
+        return asyncio.run(run())
+
+    def issue_event(self, number, repo="owner/repo"):
+        body = payload(number, repo)
+        return {'X-GitHub-Event': 'issues',
+                'X-Hub-Signature-256': sign(body)}, body
+
+    def test_duplicate_keys_are_queued_once(self):
+        responses, queued, synced = self.run_receiver(
+                [self.issue_event(1), self.issue_event(2),
+                 self.issue_event(2), self.issue_event(3),
+                 self.issue_event(3)])
+
+        self.assertEqual(responses, [(202, "queued")] * 5)
+        self.assertEqual(queued, 2)
+        self.assertEqual(synced,
+                         ["owner/repo#1", "owner/repo#2", "owner/repo#3"])
+
+    def test_queue_full(self):
+        responses, queued, synced = self.run_receiver(
+                [self.issue_event(number) for number in range(1, 5)])
+
+        self.assertEqual([status for status, _ in responses],
+                         [202, 202, 202, 503])
+        self.assertEqual(queued, 2)
+        self.assertEqual(len(synced), 3)
+
+    def test_key_can_be_queued_again_once_taken(self):
+        responses, queued, synced = self.run_receiver(
+                [self.issue_event(1), self.issue_event(1)])
+
+        self.assertEqual(queued, 1)
+        self.assertEqual(synced, ["owner/repo#1", "owner/repo#1"])
+
+    def test_rejected_payloads(self):
+        headers, body = self.issue_event(1)
+        responses, queued, synced = self.run_receiver([
+                ({'X-GitHub-Event': 'issues'}, body),
+                (dict(headers, **{'X-Hub-Signature-256': sign(b"{}")}), body),
+                ({'X-Hub-Signature-256': sign(b"not json")}, b"not json"),
+                self.issue_event(1, repo="owner/other"),
+                ({'X-GitHub-Event': 'push',
+                  'X-Hub-Signature-256': sign(body)}, body)])
+
+        self.assertEqual([status for status, _ in responses],
+                         [401, 401, 400, 200, 200])
+        self.assertEqual(queued, 0)
+        self.assertEqual(synced, [])
+
+if __name__ == '__main__':
+    unittest.main()